@@ -0,0 +1,164 @@
+# bench/fake_mes.py
+
+"""
+Локальная замена МЭШ для бенчмарков: отвечает на те же пути, что и octodiary
+(profile_info, family profile, events, marks), с настраиваемой задержкой и
+долей ошибок. Токен вида "bench-[<пользователь>-]<N>" соответствует ученику N.
+"""
+
+import asyncio
+import random
+import zlib
+from collections import Counter
+from datetime import date, timedelta
+
+from aiohttp import web
+
+SUBJECTS = [
+    "Математика", "Русский язык", "Литература", "Английский язык", "История",
+    "Физика", "Химия", "Биология", "География", "Информатика", "Физкультура",
+]
+# (начало, конец) уроков
+SLOTS = [
+    ("08:30", "09:15"), ("09:25", "10:10"), ("10:30", "11:15"),
+    ("11:35", "12:20"), ("12:30", "13:15"), ("13:25", "14:10"),
+]
+LESSONS_PER_DAY = 6
+
+
+class FakeMES:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.runner = None
+        self.base_url = None
+
+    # --- данные ---------------------------------------------------------
+
+    @staticmethod
+    def _student(request):
+        token = request.headers.get("Auth-Token", "")
+        try:
+            return int(token.rsplit("-", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def _day_events(self, student, day):
+        if day.weekday() >= 5:
+            return []
+        events = []
+        for n, (start, finish) in enumerate(SLOTS[:LESSONS_PER_DAY]):
+            # Детерминированно по (ученик, дата, номер урока)
+            h = zlib.crc32(f"{student}:{day.isoformat()}:{n}".encode())
+            subject = SUBJECTS[h % len(SUBJECTS)]
+            event = {
+                "id": h,
+                "source": "PLAN",
+                "subject_name": subject,
+                "start_at": f"{day.isoformat()}T{start}:00",
+                "finish_at": f"{day.isoformat()}T{finish}:00",
+                "room_number": str(100 + h % 300),
+                "lesson_theme": f"{subject}: тема {h % 40 + 1}",
+                "homework": {
+                    "descriptions": [f"Параграф {h % 30 + 1}, упражнения {h % 7 + 1}-{h % 7 + 5}"],
+                },
+                "materials": [{"uuid": f"m-{h}"}] if h % 4 == 0 else None,
+                "marks": [{"id": h, "value": str(3 + h % 3), "weight": 1}] if h % 5 == 0 else None,
+            }
+            events.append(event)
+        return events
+
+    # --- обработчики ----------------------------------------------------
+
+    async def _common(self, request, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[name] += 1
+            raise web.HTTPInternalServerError(text='{"type": "bench", "description": "injected"}',
+                                              content_type="application/json")
+        student = self._student(request)
+        if student is None:
+            raise web.HTTPUnauthorized(text='{"type": "auth", "description": "bad token"}',
+                                       content_type="application/json")
+        return student
+
+    async def profile_info(self, request):
+        student = await self._common(request, "profile_info")
+        return web.json_response([{"id": student, "type": "parent"}])
+
+    async def family_profile(self, request):
+        student = await self._common(request, "family_profile")
+        return web.json_response({
+            "profile": {"id": student, "type": "parent", "first_name": "Родитель"},
+            "children": [{
+                "id": student,
+                "first_name": f"Ученик {student}",
+                "contingent_guid": f"guid-{student}",
+                "class_name": "5-А",
+            }],
+        })
+
+    async def events(self, request):
+        student = await self._common(request, "events")
+        begin = date.fromisoformat(request.query["begin_date"])
+        end = date.fromisoformat(request.query["end_date"])
+        items = []
+        day = begin
+        while day <= end:
+            items.extend(self._day_events(student, day))
+            day += timedelta(days=1)
+        return web.json_response({"total_count": len(items), "response": items})
+
+    async def marks(self, request):
+        student = await self._common(request, "marks")
+        begin = date.fromisoformat(request.query["from"])
+        end = date.fromisoformat(request.query["to"])
+        payload = []
+        day = begin
+        while day <= end:
+            for ev in self._day_events(student, day):
+                if ev["marks"]:
+                    payload.append({
+                        "id": ev["id"], "value": ev["marks"][0]["value"], "weight": 1,
+                        "date": day.isoformat(), "subject_name": ev["subject_name"],
+                    })
+            day += timedelta(days=1)
+        return web.json_response({"payload": payload})
+
+    # --- запуск ---------------------------------------------------------
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/acl/api/users/profile_info", self.profile_info)
+        app.router.add_get("/api/family/mobile/v1/profile", self.family_profile)
+        app.router.add_get("/api/eventcalendar/v1/api/events", self.events)
+        app.router.add_get("/api/family/mobile/v1/marks", self.marks)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+def install(base_url):
+    """
+    Направляет octodiary (система MES) на base_url вместо school.mos.ru / dnevnik.mos.ru.
+    """
+    from octodiary.urls import BaseURLs
+    BaseURLs.MES.SCHOOL = base_url
+    BaseURLs.MES.DNEVNIK = base_url
+    BaseURLs.MES.SCHOOL_API = base_url + "/api"
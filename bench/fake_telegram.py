@@ -0,0 +1,107 @@
+# bench/fake_telegram.py
+
+"""
+Локальная замена Telegram Bot API для бенчмарков: принимает вызовы вида
+/bot<token>/<method>, считает их и отвечает правдоподобными объектами,
+чтобы python-telegram-bot мог их разобрать.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.bytes_in = 0
+        self._message_ids = itertools.count(1000)
+        self.runner = None
+        self.base_url = None
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        body = await request.read()
+        self.bytes_in += len(body)
+        if request.content_type == "application/json":
+            params = json.loads(body or b"{}")
+        elif request.content_type == "multipart/form-data":
+            params = _parse_multipart_fields(request.headers["Content-Type"], body)
+        else:
+            params = dict(parse_qsl(body.decode()))
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params.get("chat_id", 0), text=params.get("text", ""))
+        elif method in ("sendPhoto", "sendDocument"):
+            extra = {"caption": params.get("caption", "")}
+            if method == "sendPhoto":
+                extra["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+            else:
+                extra["document"] = {"file_id": f"doc-{self.calls[method]}", "file_unique_id": "doc"}
+            result = self._message(params.get("chat_id", 0), **extra)
+        elif method == "getUpdates":
+            result = []
+        else:
+            # deleteMessage, answerCallbackQuery, deleteWebhook, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}/bot"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+def _parse_multipart_fields(content_type, body):
+    """
+    Минимальный разбор multipart/form-data: только небольшие текстовые поля
+    (chat_id, caption). Файлы пропускаем.
+    """
+    boundary = content_type.split("boundary=", 1)[-1].strip('"') if "boundary=" in content_type else None
+    fields = {}
+    if not boundary:
+        return fields
+    for part in body.split(b"--" + boundary.encode()):
+        head, _, value = part.partition(b"\r\n\r\n")
+        if b"filename=" in head or b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        fields[name] = value.rstrip(b"\r\n").decode(errors="replace")
+    return fields
@@ -0,0 +1,291 @@
+# bench/load.py
+
+"""
+Генератор нагрузки и soak-тест стека хендлеров.
+
+Синтезирует апдейты (команды и нажатия кнопок календаря, уроков и «назад») с заданной
+частотой от тысяч пользователей и подаёт их прямо в Application, собранный
+так же, как в main(). Параллельно в отдельном потоке крутится
+update_all_schedules (как в APScheduler), чтобы ловить конкуренцию за SQLite.
+Раз в --report-every секунд печатает JSON-строку: RSS, лаг event loop,
+время в БД и ожидания блокировок SQLite, ошибки, размер context.user_data.
+
+Запуск из корня репозитория (например, на 4 часа):
+    python -m bench.load --users 5000 --rate 200 --duration 14400
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from bench.run import prepare_environment, seed_users
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный/soak-тест хендлеров")
+    parser.add_argument("--users", type=int, default=2000, help="число синтетических пользователей")
+    parser.add_argument("--rate", type=float, default=100.0, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность, сек")
+    parser.add_argument("--max-inflight", type=int, default=2000, help="предел одновременно обрабатываемых апдейтов")
+    parser.add_argument("--report-every", type=float, default=10.0, help="период отчёта, сек")
+    parser.add_argument("--sweep-interval", type=float, default=60.0,
+                        help="пауза между проходами update_all_schedules, сек (0 — не запускать)")
+    parser.add_argument("--mes-latency", type=float, default=0.05, help="задержка ответа МЭШ, сек")
+    parser.add_argument("--mes-error-rate", type=float, default=0.01, help="доля ответов МЭШ с ошибкой 500")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="задержка ответа Bot API, сек")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None)
+    return parser.parse_args(argv)
+
+
+def rss_bytes():
+    """
+    Текущий RSS процесса (Linux: /proc/self/statm), иначе — пиковый из getrusage.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class UserSimulator:
+    """
+    Каждый синтетический пользователь ходит по правдоподобному маршруту:
+    /start → /schedule → листает дни → открывает урок → назад ...
+    Следующий шаг зависит от предыдущего, чтобы не слать lesson_X без списка уроков.
+    """
+
+    def __init__(self, users, rng):
+        self.users = users
+        self.rng = rng
+        self.state = {}
+
+    def next_update(self):
+        from bench import updates
+        from bot.router import callback_data
+
+        user_id = self.rng.randint(1, self.users)
+        state = self.state.get(user_id, "new")
+        r = self.rng.random()
+
+        if state == "new":
+            self.state[user_id] = "started"
+            return "start", updates.command(user_id, "/start")
+        if state == "started" or r < 0.05:
+            self.state[user_id] = "calendar"
+            return "schedule", updates.command(user_id, "/schedule")
+        if state == "calendar":
+            if r < 0.2:
+                offset = self.rng.choice([2, 7, 12])
+                kind = self.rng.choice(["p", "n"])
+                return f"cal_{kind}", updates.callback(user_id, callback_data(kind, offset))
+            self.state[user_id] = "day"
+            return "day", updates.callback(user_id, callback_data("d", self.rng.randint(0, 20)))
+        if state == "day":
+            self.state[user_id] = "lesson"
+            return "lesson", updates.callback(user_id, callback_data("l", self.rng.randint(0, 3)))
+        # state == "lesson"
+        if r < 0.5:
+            self.state[user_id] = "day"
+            return "back_to_lessons", updates.callback(user_id, callback_data("bl"))
+        self.state[user_id] = "calendar"
+        return "back_to_schedule", updates.callback(user_id, callback_data("bs"))
+
+
+class Stats:
+    def __init__(self):
+        self.sent = Counter()
+        self.done = 0
+        self.errors = Counter()
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self.lag_samples = 0
+        self.sweeps = 0
+        self.sweep_seconds = 0.0
+
+    def reset_interval(self):
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self.lag_samples = 0
+
+
+async def loop_lag_sampler(stats, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        stats.lag_max = max(stats.lag_max, lag)
+        stats.lag_sum += lag
+        stats.lag_samples += 1
+
+
+def sweeper(stop_event, interval, stats):
+    import main as bot_main
+    while not stop_event.wait(interval):
+        started = time.perf_counter()
+        try:
+            # min_age=0: каждый проход обновляет всех, как худший случай для SQLite
+            bot_main.update_all_schedules(min_age=0)
+        except Exception as e:
+            stats.errors[f"sweep:{type(e).__name__}"] += 1
+        stats.sweeps += 1
+        stats.sweep_seconds += time.perf_counter() - started
+
+
+def db_totals(snap):
+    count = total = 0
+    for (name, _), (c, s) in snap["histograms"].items():
+        if name == "db_seconds":
+            count += c
+            total += s
+    return count, total
+
+
+async def amain(args):
+    from telegram import Update
+    from bench.fake_mes import FakeMES, install
+    from bench.fake_telegram import FakeTelegram
+    from bot.database import init_db
+    from bot.logs import setup_logging
+    from bot.metrics import snapshot
+    import main as bot_main
+
+    setup_logging(level="WARNING")
+    init_db()
+    seed_users(args.users)
+
+    mes = FakeMES(latency=args.mes_latency, error_rate=args.mes_error_rate, seed=args.seed)
+    install(await mes.start())
+    telegram = FakeTelegram(latency=args.tg_latency)
+    await telegram.start()
+
+    stats = Stats()
+    application = bot_main.build_application(base_url=telegram.base_url)
+
+    async def on_error(update, context):
+        error = context.error
+        if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+            stats.errors["sqlite_locked"] += 1
+        else:
+            stats.errors[type(error).__name__] += 1
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+
+    stop_event = threading.Event()
+    sweep_thread = None
+    if args.sweep_interval > 0:
+        sweep_thread = threading.Thread(target=sweeper, args=(stop_event, args.sweep_interval, stats),
+                                        name="bench-sweeper", daemon=True)
+        sweep_thread.start()
+
+    lag_task = asyncio.create_task(loop_lag_sampler(stats))
+    simulator = UserSimulator(args.users, random.Random(args.seed))
+    inflight = set()
+
+    async def process(update):
+        try:
+            await application.process_update(update)
+        finally:
+            stats.done += 1
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    next_report = started + args.report_every
+    prev_db = db_totals(snapshot())
+    prev_done = 0
+    rss_start = rss_bytes()
+    period = 1.0 / args.rate
+    next_send = started
+    dropped = 0
+
+    try:
+        while loop.time() - started < args.duration:
+            now = loop.time()
+            # Открытая модель нагрузки: шлём по расписанию, не дожидаясь ответов
+            while next_send <= now:
+                next_send += period
+                if len(inflight) >= args.max_inflight:
+                    dropped += 1
+                    continue
+                kind, data = simulator.next_update()
+                stats.sent[kind] += 1
+                task = asyncio.create_task(process(Update.de_json(data, application.bot)))
+                inflight.add(task)
+                task.add_done_callback(inflight.discard)
+
+            if now >= next_report:
+                db_count, db_time = db_totals(snapshot())
+                user_data = application.user_data
+                report = {
+                    "t": round(now - started, 1),
+                    "rss_mb": round(rss_bytes() / 2**20, 1),
+                    "rss_growth_mb": round((rss_bytes() - rss_start) / 2**20, 1),
+                    "updates_per_s": round((stats.done - prev_done) / args.report_every, 1),
+                    "inflight": len(inflight),
+                    "dropped": dropped,
+                    "loop_lag_max_ms": round(stats.lag_max * 1000, 1),
+                    "loop_lag_mean_ms": round(stats.lag_sum / max(1, stats.lag_samples) * 1000, 2),
+                    "db_calls": db_count - prev_db[0],
+                    "db_mean_ms": round((db_time - prev_db[1]) / max(1, db_count - prev_db[0]) * 1000, 3),
+                    "errors": dict(stats.errors),
+                    "sweeps": stats.sweeps,
+                    "user_data_users": len(user_data),
+                    "user_data_lessons": sum(len(d.get("lessons") or ()) for d in user_data.values()),
+                }
+                print(json.dumps(report, ensure_ascii=False), flush=True)
+                prev_db = (db_count, db_time)
+                prev_done = stats.done
+                stats.reset_interval()
+                next_report += args.report_every
+
+            await asyncio.sleep(min(period, 0.01))
+
+        if inflight:
+            await asyncio.wait(inflight, timeout=30)
+    finally:
+        lag_task.cancel()
+        stop_event.set()
+        if sweep_thread:
+            await asyncio.to_thread(sweep_thread.join)
+        await application.shutdown()
+        await telegram.stop()
+        await mes.stop()
+
+    summary = {
+        "summary": True,
+        "duration_s": round(loop.time() - started, 1),
+        "sent": dict(stats.sent),
+        "processed": stats.done,
+        "dropped": dropped,
+        "errors": dict(stats.errors),
+        "error_rate": round(sum(stats.errors.values()) / max(1, stats.done), 4),
+        "rss_growth_mb": round((rss_bytes() - rss_start) / 2**20, 1),
+        "sweeps": stats.sweeps,
+        "sweep_mean_s": round(stats.sweep_seconds / max(1, stats.sweeps), 3),
+        "mes_calls": dict(mes.calls),
+        "telegram_calls": dict(telegram.calls),
+    }
+    print(json.dumps(summary, ensure_ascii=False), flush=True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prepare_environment(args.workdir or tempfile.mkdtemp(prefix="meshload-"))
+    logging.getLogger("asyncio").setLevel(logging.WARNING)
+    asyncio.run(amain(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# bench/run.py
+
+"""
+Офлайн-бенчмарк: поднимает фейковые МЭШ и Telegram Bot API, прогоняет
+сценарии пользователей (start → schedule → day → lesson → back) через
+хендлеры бота и полный update_all_schedules по N синтетическим пользователям.
+Печатает JSON-отчёт: пропускная способность, перцентили задержек,
+количество обращений к БД, МЭШ и Telegram.
+
+Запуск из корня репозитория:
+    python -m bench.run --sessions 200 --concurrency 20 --sweep-users 500
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    parser.add_argument("--sessions", type=int, default=100, help="число сценариев пользователей")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременных сценариев")
+    parser.add_argument("--sweep-users", type=int, default=200, help="пользователей в update_all_schedules (0 — пропустить)")
+    parser.add_argument("--subscribers", type=int, default=1, help="пользователей на одного ученика (родители + ученик)")
+    parser.add_argument("--mes-latency", type=float, default=0.0, help="задержка ответа МЭШ, сек")
+    parser.add_argument("--mes-error-rate", type=float, default=0.0, help="доля ответов МЭШ с ошибкой 500")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка ответа Bot API, сек")
+    parser.add_argument("--workdir", default=None, help="каталог для users.db/ключа (по умолчанию временный)")
+    parser.add_argument("--out", default=None, help="записать отчёт в файл")
+    return parser.parse_args(argv)
+
+
+def prepare_environment(workdir):
+    """
+    Направляет бота на отдельные БД и ключ. Должно выполняться
+    до импорта config.settings / bot.*.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "users.db")
+    os.environ["ENCRYPTION_KEY_PATH"] = os.path.join(workdir, "encryption.key")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+    os.chdir(REPO_ROOT)  # хендлеры открывают bot/photo/*.jpg относительным путём
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p90_ms": round(pick(0.90) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def db_calls(before, after):
+    """
+    Разница числа вызовов DB-функций (гистограмма db_seconds) между двумя snapshot().
+    """
+    result = defaultdict(int)
+    for (name, labels), (count, _) in after["histograms"].items():
+        if name != "db_seconds":
+            continue
+        prev = before["histograms"].get((name, labels), (0, 0))[0]
+        if count - prev:
+            result[dict(labels)["fn"]] += count - prev
+    return dict(result)
+
+
+def diff_counter(before, after):
+    return {k: after[k] - before.get(k, 0) for k in after if after[k] - before.get(k, 0)}
+
+
+def seed_users(count, subscribers=1):
+    """
+    Создаёт пользователей 1..count с токенами "bench-<id>-<ученик>" (их понимает
+    FakeMES); на каждого ученика приходится subscribers пользователей подряд.
+    """
+    from bot.auth import encrypt_token, save_token_db
+    for user_id in range(1, count + 1):
+        student = (user_id - 1) // subscribers + 1
+        save_token_db(user_id, encrypt_token(f"bench-{user_id}-{student}"))
+
+
+def session_script(user_id):
+    """
+    Сценарий одного пользователя: список (шаг, апдейт).
+    """
+    from bench import updates
+    from bot.router import callback_data
+    day_index = 7 + min(date.today().weekday(), 4)  # сегодня (или пятница на выходных)
+    return [
+        ("start", updates.command(user_id, "/start")),
+        ("schedule", updates.command(user_id, "/schedule")),
+        ("day", updates.callback(user_id, callback_data("d", day_index))),
+        ("lesson", updates.callback(user_id, callback_data("l", 0))),
+        ("back", updates.callback(user_id, callback_data("bs"))),
+    ]
+
+
+async def run_sessions(application, sessions, concurrency):
+    from telegram import Update
+
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user_id):
+        async with semaphore:
+            for step, data in session_script(user_id):
+                update = Update.de_json(data, application.bot)
+                start = time.perf_counter()
+                await application.process_update(update)
+                latencies[step].append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in range(1, sessions + 1)))
+    return latencies, time.perf_counter() - started
+
+
+async def amain(args):
+    from bench.fake_mes import FakeMES, install
+    from bench.fake_telegram import FakeTelegram
+    from bot.database import init_db
+    from bot.logs import setup_logging
+    from bot.metrics import snapshot
+    import main as bot_main
+
+    setup_logging(level="WARNING")
+    init_db()
+    total_users = max(args.sessions, args.sweep_users)
+    seed_users(total_users, args.subscribers)
+
+    mes = FakeMES(latency=args.mes_latency, error_rate=args.mes_error_rate)
+    install(await mes.start())
+    telegram = FakeTelegram(latency=args.tg_latency)
+    await telegram.start()
+
+    report = {"params": vars(args)}
+    errors = []
+
+    application = bot_main.build_application(base_url=telegram.base_url)
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+    try:
+        # 1) Сценарии пользователей через хендлеры
+        if args.sessions:
+            snap, mes_calls, tg_calls = snapshot(), dict(mes.calls), dict(telegram.calls)
+            latencies, elapsed = await run_sessions(application, args.sessions, args.concurrency)
+            steps = sum(len(v) for v in latencies.values())
+            report["sessions"] = {
+                "elapsed_s": round(elapsed, 3),
+                "sessions_per_s": round(args.sessions / elapsed, 2),
+                "updates_per_s": round(steps / elapsed, 2),
+                "latency": {step: percentiles(values) for step, values in latencies.items()},
+                "db_calls": db_calls(snap, snapshot()),
+                "mes_calls": diff_counter(mes_calls, mes.calls),
+                "telegram_calls": diff_counter(tg_calls, telegram.calls),
+                "errors": len(errors),
+            }
+
+        # 2) Полный проход update_all_schedules (в своём потоке, как в APScheduler)
+        if args.sweep_users:
+            snap, mes_calls = snapshot(), dict(mes.calls)
+            started = time.perf_counter()
+            await asyncio.to_thread(bot_main.update_all_schedules)
+            elapsed = time.perf_counter() - started
+            report["sweep"] = {
+                "users": total_users,
+                "students": -(-total_users // args.subscribers),
+                "elapsed_s": round(elapsed, 3),
+                "users_per_s": round(total_users / elapsed, 2),
+                "db_calls": db_calls(snap, snapshot()),
+                "mes_calls": diff_counter(mes_calls, mes.calls),
+                "mes_errors": dict(mes.errors),
+            }
+    finally:
+        await application.shutdown()
+        await telegram.stop()
+        await mes.stop()
+
+    if errors:
+        report["error_samples"] = errors[:5]
+    return report
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="meshbench-")
+    prepare_environment(workdir)
+    logging.getLogger("asyncio").setLevel(logging.WARNING)
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# bench/updates.py
+
+"""
+Сборка синтетических Telegram-апдейтов (команды и нажатия инлайн-кнопок)
+в виде словарей Bot API — их можно превратить в Update через Update.de_json.
+"""
+
+import itertools
+import time
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def _chat(user_id):
+    return {"id": user_id, "type": "private"}
+
+
+def command(user_id, text):
+    """
+    Сообщение-команда от пользователя, например command(42, "/schedule").
+    """
+    cmd = text.split()[0]
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd)}],
+        },
+    }
+
+
+def text(user_id, value):
+    """
+    Обычное текстовое сообщение (ответ в диалоге /login и т.п.).
+    """
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _user(user_id),
+            "text": value,
+        },
+    }
+
+
+def callback(user_id, data):
+    """
+    Нажатие инлайн-кнопки с callback_data=data под сообщением бота.
+    """
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": _chat(user_id),
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": "bench",
+            },
+        },
+    }
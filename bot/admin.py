@@ -0,0 +1,142 @@
+# bot/admin.py
+
+import asyncio
+import io
+import logging
+import os
+import time
+from functools import wraps
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from config.settings import ADMIN_IDS, DATABASE_PATH, PROFILE_MAX_SECONDS
+from .database import sql_select_counts
+from .metrics import snapshot, timed
+from .profiler import profiler
+from .repository import repository
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_SECONDS = 30
+
+
+def admin_only(handler):
+    """
+    Хендлер выполняется только для ADMIN_IDS; остальным бот не отвечает
+    (команды не должны быть заметны обычным пользователям).
+    """
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None or update.effective_user.id not in ADMIN_IDS:
+            return
+        return await handler(update, context)
+    return wrapper
+
+
+def _mb(path):
+    try:
+        return os.path.getsize(path) / 1024 / 1024
+    except OSError:
+        return 0.0
+
+
+@timed('handler_seconds')
+@admin_only
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /stats — состояние живого процесса: пользователи, память (кэши и
+    user_data), проход обновления, размер БД, задержка event loop.
+    """
+    counts = await repository.read(sql_select_counts)
+    metrics = snapshot()
+    gauges = metrics['gauges']
+
+    def gauge(name, default=0):
+        return gauges.get((name, ()), default)
+
+    user_data = context.application.user_data
+    lines = ['Пользователи:']
+    lines += [f'  {key[6:]}: {n}' for key, n in sorted(counts.items()) if key.startswith('users_')]
+    lines.append(f"Ученики: {counts['students']}, уроков в БД: {counts['lessons']}")
+
+    lines += ['', 'Память:']
+    lines.append(f'  user_data: {len(user_data)}, с клиентом МЭШ: '
+                 f"{sum(1 for data in user_data.values() if data.get('api') is not None)}")
+    lines.append(f"  сессий входа: {gauge('login_sessions_live')}")
+    for (name, labels), value in sorted(gauges.items()):
+        if name == 'cache_size':
+            lines.append(f"  кэш {dict(labels).get('cache')}: {value}")
+
+    lines += ['', 'Обновление расписаний:']
+    finished = gauge('sweep_last_finished_timestamp', None)
+    if gauge('sweep_running'):
+        lines.append(f"  идёт, осталось учеников: {gauge('sweep_students_left')}")
+    else:
+        lines.append('  не идёт')
+    if finished:
+        lines.append(f'  последний завершён {int(time.time() - finished) // 60} мин назад')
+    reclaimed = gauge('token_check_reclaimed_seconds', None)
+    if reclaimed is not None:
+        lines.append(f'  проверка токенов сэкономила до {reclaimed:.1f} с на проход')
+
+    lines += ['', 'Процесс:']
+    lines.append(f'  БД: {_mb(DATABASE_PATH):.1f} МБ (+ WAL {_mb(DATABASE_PATH + "-wal"):.1f} МБ), '
+                 f"очередь запросов: {gauge('db_queue_depth')}")
+    count, total = metrics['histograms'].get(('loop_lag_seconds', ()), (0, 0.0))
+    lines.append(f"  задержка event loop: сейчас {gauge('loop_lag_last_seconds', 0.0) * 1000:.0f} мс, "
+                 f"средняя {(total / count if count else 0.0) * 1000:.0f} мс")
+    if profiler.running:
+        lines.append('  идёт профилирование (/profile stop)')
+
+    await update.message.reply_text('\n'.join(lines))
+
+
+@timed('handler_seconds')
+@admin_only
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile [секунды|stop] — снять профиль живого процесса (по умолчанию
+    DEFAULT_PROFILE_SECONDS, не дольше PROFILE_MAX_SECONDS) и прислать отчёт файлом.
+    """
+    arg = context.args[0].lower() if context.args else None
+    chat_id = update.effective_chat.id
+
+    if arg == 'stop':
+        report = await asyncio.to_thread(profiler.stop)
+        if report is None:
+            await update.message.reply_text('Профилирование не запущено.')
+        else:
+            await _send_report(context.bot, chat_id, report)
+        return
+
+    try:
+        seconds = int(arg) if arg else DEFAULT_PROFILE_SECONDS
+    except ValueError:
+        await update.message.reply_text('Использование: /profile [секунды] или /profile stop')
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if not profiler.start():
+        await update.message.reply_text('Профилирование уже идёт. Остановить: /profile stop')
+        return
+    logger.info("Профилирование запущено на %s с (user_id=%s)", seconds, update.effective_user.id)
+    await update.message.reply_text(f'Профилирование запущено на {seconds} с.')
+    context.application.create_task(_finish(context.bot, chat_id, seconds, profiler.started_at))
+
+
+async def _finish(bot, chat_id, seconds, started_at):
+    await asyncio.sleep(seconds)
+    # Профилирование могли остановить вручную (и запустить заново) — чужой запуск не трогаем
+    if profiler.started_at != started_at:
+        return
+    report = await asyncio.to_thread(profiler.stop)
+    if report is not None:
+        await _send_report(bot, chat_id, report)
+
+
+async def _send_report(bot, chat_id, report: str):
+    document = io.BytesIO(report.encode('utf-8'))
+    document.name = 'profile.txt'
+    await bot.send_document(chat_id=chat_id, document=document, filename='profile.txt',
+                            caption='Отчёт профилирования')
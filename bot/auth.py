@@ -2,73 +2,370 @@
 
 import os
 import json
+import base64
+import asyncio
 import logging
-from cryptography.fernet import Fernet
-from octodiary.apis import AsyncMobileAPI
-from octodiary.urls import Systems
-from .database import get_db_connection
-from config.settings import ENCRYPTION_KEY_PATH
+import threading
+import time
+import hashlib
+import re
+from .database import (
+    get_db_connection,
+    sql_select_token,
+    sql_upsert_token,
+    sql_update_token,
+    sql_delete_identity,
+    sql_select_expiring_tokens,
+    sql_mark_needs_relogin,
+    sql_mark_expired_tokens,
+    sql_select_unchecked_tokens,
+    sql_record_token_checks,
+)
+from .cache import token_cache
+from .metrics import timed, observe, inc, set_gauge
+from .executor import run_blocking
+from .repository import repository
+from config.settings import (
+    ENCRYPTION_KEY_PATH,
+    KEY_ROTATION_BATCH_SIZE,
+    KEY_ROTATION_RATE,
+    TOKEN_RENEW_AHEAD,
+    TOKEN_CHECK_CONCURRENCY,
+    TOKEN_CHECK_RATE,
+    TOKEN_CHECK_MAX_AGE,
+)
 
 logger = logging.getLogger(__name__)
 
+# Числа в path (id оценок и т.п.) схлопываем, чтобы не плодить метки
+_DIGITS_RE = re.compile(r'\d+')
+
+# cryptography и octodiary тяжёлые, поэтому импортируются лениво:
+# ключи читаются при первом шифровании/расшифровке, а не при импорте модуля.
+#
+# Файл ключей может содержать несколько ключей Fernet, по одному на строку.
+# Первый — текущий (им шифруем), остальные — старые, ими только расшифровываем
+# до тех пор, пока reencrypt_tokens() не перешифрует все строки users.
+_cipher_suite = None
+_current_key_id = None
+_cipher_lock = threading.Lock()
+
+def _key_id(key: bytes) -> str:
+    return hashlib.sha256(key).hexdigest()[:16]
+
 def get_cipher_suite():
-    if os.path.exists(ENCRYPTION_KEY_PATH):
-        with open(ENCRYPTION_KEY_PATH, 'rb') as f:
-            key = f.read()
-    else:
-        key = Fernet.generate_key()
-        with open(ENCRYPTION_KEY_PATH, 'wb') as f:
-            f.write(key)
-    return Fernet(key)
+    global _cipher_suite, _current_key_id
+    if _cipher_suite is not None:
+        return _cipher_suite
+    with _cipher_lock:
+        if _cipher_suite is None:
+            from cryptography.fernet import Fernet, MultiFernet
+            if os.path.exists(ENCRYPTION_KEY_PATH):
+                with open(ENCRYPTION_KEY_PATH, 'rb') as f:
+                    keys = [line.strip() for line in f.read().splitlines() if line.strip()]
+            else:
+                keys = [Fernet.generate_key()]
+                with open(ENCRYPTION_KEY_PATH, 'wb') as f:
+                    f.write(keys[0])
+            _current_key_id = _key_id(keys[0])
+            _cipher_suite = MultiFernet([Fernet(key) for key in keys])
+    return _cipher_suite
+
+def current_key_id() -> str:
+    """
+    Идентификатор (отпечаток) текущего ключа шифрования — пишется в users.key_id.
+    """
+    get_cipher_suite()
+    return _current_key_id
+
+_api_class = None
+_user_agent = None
+
+def _get_user_agent():
+    """
+    User-Agent для запросов к МЭШ — выбирается один раз на процесс.
+    octodiary на каждый запрос создаёт fake_useragent.UserAgent(), а тот
+    заново читает и разбирает свою базу браузеров (~0.1 с CPU на запрос).
+    """
+    global _user_agent
+    if _user_agent is None:
+        from fake_useragent.fake import UserAgent
+        _user_agent = UserAgent().random
+    return _user_agent
+
+def _get_api_class():
+    """
+    Подкласс AsyncMobileAPI, замеряющий каждый HTTP-запрос к МЭШ
+    (гистограмма mes_request_seconds по path) и не пересоздающий User-Agent
+    на каждый запрос. Создаётся при первом вызове,
+    чтобы octodiary не импортировался при старте.
+    """
+    global _api_class
+    if _api_class is None:
+        from octodiary.apis import AsyncMobileAPI
+
+        class InstrumentedMobileAPI(AsyncMobileAPI):
+            @property
+            def user_agent(self) -> str:
+                return _get_user_agent()
+
+            async def request(self, method, base_url, path, *args, **kwargs):
+                start = time.perf_counter()
+                status = 'ok'
+                try:
+                    return await super().request(method, base_url, path, *args, **kwargs)
+                except BaseException:
+                    status = 'error'
+                    raise
+                finally:
+                    observe('mes_request_seconds', time.perf_counter() - start,
+                            path=_DIGITS_RE.sub(':id', path), status=status)
+
+        _api_class = InstrumentedMobileAPI
+    return _api_class
+
+def new_api(token=None):
+    """
+    Создаёт клиент AsyncMobileAPI для МЭШ (с токеном, если передан).
+    token — строка токена или словарь из token_bundle() (тогда клиент
+    умеет refresh_token()).
+    """
+    from octodiary.urls import Systems
+    api = _get_api_class()(system=Systems.MES)
+    if isinstance(token, dict):
+        api.token = token.get('token')
+        api.token_for_refresh = token.get('refresh_token')
+        api.client_id = token.get('client_id')
+        api.client_secret = token.get('client_secret')
+    elif token:
+        api.token = token
+    return api
+
+def token_bundle(api) -> dict:
+    """
+    Всё, что нужно сохранить после входа, чтобы потом продлевать токен без SMS.
+    """
+    return {
+        'token': api.token,
+        'refresh_token': getattr(api, 'token_for_refresh', None),
+        'client_id': getattr(api, 'client_id', None),
+        'client_secret': getattr(api, 'client_secret', None),
+    }
+
+def jwt_expiry(token_data):
+    """
+    Срок действия токена МЭШ (claim exp, unix time) или None, если это не JWT.
+    Подпись не проверяется — нужен только срок.
+    """
+    token = token_data.get('token') if isinstance(token_data, dict) else token_data
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return int(exp) if exp else None
+    except Exception:
+        return None
 
-cipher_suite = get_cipher_suite()
+def is_auth_error(error) -> bool:
+    """
+    МЭШ отверг токен (401/403) — повторять запрос с ним бессмысленно.
+    """
+    return getattr(error, 'status_code', None) in (401, 403)
 
 def encrypt_token(token_data):
     token_json = json.dumps(token_data).encode()
-    return cipher_suite.encrypt(token_json)
+    return get_cipher_suite().encrypt(token_json)
 
 def decrypt_token(encrypted_token):
-    decrypted_bytes = cipher_suite.decrypt(encrypted_token)
+    decrypted_bytes = get_cipher_suite().decrypt(encrypted_token)
     return json.loads(decrypted_bytes.decode())
 
-def save_token_db(telegram_user_id, encrypted_token):
+@timed('db_seconds')
+def save_token_db(telegram_user_id, encrypted_token, expires_at=None):
+    """
+    Токен после нового входа: аккаунт mos.ru мог смениться, поэтому привязка
+    к ученику сбрасывается. Для продления — renew_token_db.
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        REPLACE INTO users (telegram_user_id, encrypted_token)
-        VALUES (?, ?)
-    ''', (telegram_user_id, encrypted_token))
+    sql_upsert_token(conn, telegram_user_id, encrypted_token, current_key_id(), expires_at)
+    sql_delete_identity(conn, telegram_user_id)
     conn.commit()
     conn.close()
+    token_cache.invalidate(telegram_user_id)
+
+@timed('db_seconds')
+def renew_token_db(telegram_user_id, old_encrypted_token, encrypted_token, expires_at=None) -> bool:
+    """
+    Продлённый токен того же аккаунта: меняется только сам токен, привязка
+    к ученику (лента, сводки, поиск, локальное расписание) остаётся.
+    Не пишет, если пользователь успел заново войти. True, если записано.
+    """
+    conn = get_db_connection()
+    try:
+        updated = sql_update_token(conn, telegram_user_id, encrypted_token, current_key_id(),
+                                   expires_at, expected=old_encrypted_token)
+        conn.commit()
+    finally:
+        conn.close()
+    token_cache.invalidate(telegram_user_id)
+    return updated
 
+@timed('db_seconds')
 def load_token_db(telegram_user_id):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT encrypted_token FROM users WHERE telegram_user_id = ?
-    ''', (telegram_user_id,))
-    row = cursor.fetchone()
+    encrypted_token = sql_select_token(conn, telegram_user_id)
     conn.close()
-    if row:
-        return row[0]
-    return None
+    return encrypted_token
+
+def get_token(telegram_user_id, encrypted_token=None, version=None):
+    """
+    Возвращает расшифрованный токен пользователя (или None, если токена нет).
+    Сначала смотрим в token_cache, иначе берём encrypted_token
+    (если не передан — из БД), расшифровываем и кладём в кэш.
+    version — token_cache.version(telegram_user_id) на момент чтения
+    encrypted_token из БД: если с тех пор токен этого пользователя сохраняли
+    заново, старый в кэш не кладём.
+    Ошибки расшифровки пробрасываются вызывающему коду.
+    """
+    token_data = token_cache.get(telegram_user_id)
+    if token_data is not None:
+        return token_data
+
+    if encrypted_token is None:
+        version = token_cache.version(telegram_user_id)
+        encrypted_token = load_token_db(telegram_user_id)
+    if not encrypted_token:
+        return None
+
+    token_data = decrypt_token(encrypted_token)
+    token_cache.set(telegram_user_id, token_data, version)
+    return token_data
+
+async def get_token_async(telegram_user_id):
+    """
+    То же, что get_token, но для корутин: при попадании в кэш отвечаем сразу,
+    чтение идёт через bot.repository, а расшифровка — в пуле потоков (bot.executor).
+    """
+    token_data = token_cache.get(telegram_user_id)
+    if token_data is not None:
+        return token_data
+    version = token_cache.version(telegram_user_id)
+    encrypted_token = await repository.load_encrypted_token(telegram_user_id)
+    if not encrypted_token:
+        return None
+    return await run_blocking(get_token, telegram_user_id, encrypted_token, version)
+
+async def save_token_async(telegram_user_id, token_data):
+    """
+    Шифрует токен (в пуле потоков) и сохраняет его через bot.repository.
+    """
+    encrypted_token = await run_blocking(encrypt_token, token_data)
+    await repository.save_token(telegram_user_id, encrypted_token, current_key_id(), jwt_expiry(token_data))
+
+async def mark_needs_relogin(telegram_user_id):
+    """
+    Токен пользователя мёртв: до нового /login обновление расписания его пропускает.
+    """
+    await repository.write(sql_mark_needs_relogin, telegram_user_id)
+    token_cache.invalidate(telegram_user_id)
+    inc('tokens_dead_total')
+
+async def resolve_identity(telegram_user_id, api):
+    """
+    Возвращает (student_id, person_guid, mes_role) ученика, к которому привязан
+    пользователь (student_id — ключ его расписания в БД, общий для всех подписчиков).
+    Берётся из таблицы identity; при отсутствии один раз запрашивается у МЭШ
+    (get_users_profile_info + get_family_profile) и сохраняется.
+    Если профиля или детей нет — None.
+    """
+    row = await repository.load_identity(telegram_user_id)
+    if row and row[3]:
+        return row[3], row[1], row[2]
+
+    profiles = await api.get_users_profile_info()
+    if not profiles:
+        return None
+    profile_id = profiles[0].id
+    family = await api.get_family_profile(profile_id=profile_id)
+    if not family.children:
+        return None
+    person_guid = family.children[0].contingent_guid
+    if not person_guid:
+        return None
+    mes_role = family.profile.type
+    student_id = await repository.save_identity(telegram_user_id, profile_id, person_guid, mes_role)
+    return student_id, person_guid, mes_role
+
+def reencrypt_tokens(batch_size=KEY_ROTATION_BATCH_SIZE, rate=KEY_ROTATION_RATE):
+    """
+    Фоновое перешифрование users.encrypted_token текущим ключом после ротации.
+    Идём по users небольшими пачками (каждая — отдельная короткая транзакция)
+    и ограничиваем скорость rate строк/сек, чтобы не мешать хендлерам и
+    обновлению расписаний. Строку обновляем, только если токен не поменялся
+    с момента чтения (иначе его уже перезаписал save_token_db новым ключом).
+    Возвращает количество перешифрованных строк.
+    """
+    cipher = get_cipher_suite()
+    key_id = current_key_id()
+    last_id = None
+    total = 0
+
+    while True:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT telegram_user_id, encrypted_token FROM users
+                WHERE (key_id IS NULL OR key_id != ?)
+                  AND encrypted_token IS NOT NULL
+                  AND (? IS NULL OR telegram_user_id > ?)
+                ORDER BY telegram_user_id
+                LIMIT ?
+            ''', (key_id, last_id, last_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for tg_id, enc_token in rows:
+                try:
+                    updates.append((cipher.rotate(enc_token), key_id, tg_id, enc_token))
+                except Exception as e:
+                    # Ключа для этой строки нет ни в одном из файлов — оставляем как есть
+                    logger.warning("Не удалось перешифровать токен пользователя %s: %s", tg_id, e)
+            cur.executemany('''
+                UPDATE users SET encrypted_token = ?, key_id = ?
+                WHERE telegram_user_id = ? AND encrypted_token = ?
+            ''', updates)
+            conn.commit()
+            total += cur.rowcount if cur.rowcount > 0 else 0
+        finally:
+            conn.close()
+
+        last_id = rows[-1][0]
+        if rate > 0:
+            time.sleep(len(rows) / rate)
+
+    if total:
+        logger.info("Перешифровано токенов текущим ключом: %s", total)
+    return total
 
 async def is_user_logged_in(telegram_user_id):
     """
     Проверяет, есть ли у пользователя валидный токен.
     Если да, пытается вызвать get_users_profile_info().
     """
-    api = AsyncMobileAPI(system=Systems.MES)
-    encrypted_token = load_token_db(telegram_user_id)
-    if encrypted_token:
-        try:
-            token_data = decrypt_token(encrypted_token)
-            api.token = token_data
+    try:
+        token_data = await get_token_async(telegram_user_id)
+        if token_data:
+            api = new_api(token_data)
             profiles = await api.get_users_profile_info()
             if profiles:
                 return True
-        except Exception as e:
-            logger.error("Сохранённый токен недействителен для пользователя %s: %s", telegram_user_id, e)
+    except Exception as e:
+        logger.warning("Сохранённый токен недействителен для пользователя %s: %s", telegram_user_id, e)
+        if is_auth_error(e):
+            await mark_needs_relogin(telegram_user_id)
     return False
 
 async def get_api_client(telegram_user_id, username=None, password=None):
@@ -76,19 +373,20 @@ async def get_api_client(telegram_user_id, username=None, password=None):
     Возвращает пару (api, sms_code_obj).
     Если sms_code_obj не None, нужна двухфакторная аутентификация.
     """
-    api = AsyncMobileAPI(system=Systems.MES)
-    encrypted_token = load_token_db(telegram_user_id)
-
     # 1) Пробуем использовать сохранённый токен
-    if encrypted_token:
-        try:
-            token_data = decrypt_token(encrypted_token)
-            api.token = token_data
+    try:
+        token_data = await get_token_async(telegram_user_id)
+        if token_data:
+            api = new_api(token_data)
             profiles = await api.get_users_profile_info()
             if profiles:
                 return api, None
-        except Exception as e:
-            logger.error("Недействительный токен для пользователя %s: %s", telegram_user_id, e)
+    except Exception as e:
+        logger.warning("Недействительный токен для пользователя %s: %s", telegram_user_id, e)
+        if is_auth_error(e):
+            await mark_needs_relogin(telegram_user_id)
+
+    api = new_api()
 
     # 2) Если нет токена или он невалиден, делаем полную авторизацию
     if username and password:
@@ -100,3 +398,161 @@ async def get_api_client(telegram_user_id, username=None, password=None):
             return None, None
     else:
         return None, None
+
+def renew_tokens(ahead=TOKEN_RENEW_AHEAD):
+    """
+    Фоновая задача (поток APScheduler): продлевает токены, которые истекают
+    в ближайшие ahead секунд, через refresh_token МЭШ. Токены без данных для
+    продления (сохранены до появления token_bundle) или отвергнутые МЭШ
+    переводятся в needs_relogin — их больше не пытается обновлять sweep.
+    Сетевые ошибки не меняют статус: попробуем в следующий раз.
+    Возвращает число продлённых токенов.
+    """
+    now = int(time.time())
+    conn = get_db_connection()
+    try:
+        expired = sql_mark_expired_tokens(conn, now)
+        conn.commit()
+        rows = sql_select_expiring_tokens(conn, now + ahead)
+    finally:
+        conn.close()
+    if expired:
+        inc('tokens_dead_total', expired)
+        logger.info("Истёк срок токенов (нужен повторный /login): %s", expired)
+    if not rows:
+        return 0
+
+    loop = asyncio.new_event_loop()
+    renewed = 0
+    try:
+        for tg_id, enc_token in rows:
+            try:
+                token_data = decrypt_token(enc_token)
+            except Exception as e:
+                logger.warning("Не удалось расшифровать токен пользователя %s: %s", tg_id, e)
+                continue
+            if not isinstance(token_data, dict) or not token_data.get('refresh_token'):
+                continue  # продлить нечем — после истечения станет needs_relogin
+
+            api = new_api(token_data)
+            try:
+                loop.run_until_complete(api.refresh_token())
+            except Exception as e:
+                if is_auth_error(e):
+                    loop.run_until_complete(mark_needs_relogin(tg_id))
+                inc('tokens_renewed_total', status='error')
+                logger.warning("Не удалось продлить токен пользователя %s: %s", tg_id, e)
+                continue
+
+            bundle = token_bundle(api)
+            if not renew_token_db(tg_id, enc_token, encrypt_token(bundle), jwt_expiry(bundle)):
+                continue  # пользователь заново вошёл, пока продлевали
+            renewed += 1
+            inc('tokens_renewed_total', status='ok')
+    finally:
+        loop.close()
+    if renewed:
+        logger.info("Продлено токенов: %s", renewed)
+    return renewed
+
+# Результаты проверки токенов пишем пачками — меньше транзакций
+CHECK_BATCH = 100
+
+def validate_tokens(concurrency=TOKEN_CHECK_CONCURRENCY, rate=TOKEN_CHECK_RATE, max_age=TOKEN_CHECK_MAX_AGE):
+    """
+    Фоновая задача (поток APScheduler): проверяет у МЭШ все активные токены,
+    не проверявшиеся max_age секунд, — до concurrency запросов одновременно
+    и не больше rate запросов в секунду. Отвергнутые МЭШ (401/403) и
+    нерасшифровываемые токены переводятся в needs_relogin, так что проход
+    update_all_schedules больше не тратит на них запросы; сетевые ошибки
+    статус не меняют. Результаты пишутся пачками через bot.repository.
+    Возвращает число найденных мёртвых токенов.
+    """
+    now = int(time.time())
+    conn = get_db_connection()
+    try:
+        rows = sql_select_unchecked_tokens(conn, now - max_age)
+    finally:
+        conn.close()
+    if not rows:
+        return 0
+
+    start = time.perf_counter()
+    loop = asyncio.new_event_loop()
+    try:
+        dead, reclaimed, errors = loop.run_until_complete(_check_tokens(rows, concurrency, rate, now))
+    finally:
+        loop.close()
+
+    # Столько времени проход обновления тратил бы на запросы с этими токенами
+    set_gauge('token_check_reclaimed_seconds', reclaimed)
+    observe('token_check_seconds', time.perf_counter() - start)
+    logger.info(
+        "Проверено токенов: %s, мёртвых: %s, ошибок сети: %s, за %.1f с; "
+        "проход обновления расписаний сэкономит до %.1f с",
+        len(rows), dead, errors, time.perf_counter() - start, reclaimed,
+    )
+    return dead
+
+async def _check_token(tg_id, enc_token):
+    """
+    'alive', 'dead' или 'error' (сеть/МЭШ недоступен) и длительность запроса.
+    """
+    try:
+        token_data = await run_blocking(decrypt_token, enc_token)
+    except Exception as e:
+        # Не расшифровывается ни одним ключом — пользоваться им нельзя
+        logger.warning("Не удалось расшифровать токен пользователя %s: %s", tg_id, e)
+        return 'dead', 0.0
+    start = time.perf_counter()
+    try:
+        await new_api(token_data).get_users_profile_info()
+        return 'alive', time.perf_counter() - start
+    except Exception as e:
+        if is_auth_error(e):
+            return 'dead', time.perf_counter() - start
+        logger.warning("Не удалось проверить токен пользователя %s: %s", tg_id, e)
+        return 'error', time.perf_counter() - start
+
+async def _check_tokens(rows, concurrency, rate, now):
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1 / rate if rate > 0 else 0
+    next_start = time.monotonic()
+    results = {'alive': [], 'dead': []}
+    writes = []
+    reclaimed = 0.0
+    errors = 0
+
+    def flush():
+        alive, dead = results['alive'], results['dead']
+        results['alive'], results['dead'] = [], []
+        writes.append(repository.submit_write(sql_record_token_checks, alive, dead, now))
+        for tg_id, _ in dead:
+            token_cache.invalidate(tg_id)
+
+    async def check(tg_id, enc_token):
+        nonlocal next_start, reclaimed, errors
+        async with semaphore:
+            # Темп: запросы стартуют не чаще rate в секунду
+            started = max(time.monotonic(), next_start)
+            next_start = started + interval
+            await asyncio.sleep(started - time.monotonic())
+            status, seconds = await _check_token(tg_id, enc_token)
+        inc('tokens_checked_total', status=status)
+        if status == 'error':
+            errors += 1
+            return
+        results[status].append((tg_id, enc_token))
+        if status == 'dead':
+            reclaimed += seconds
+        if len(results['alive']) + len(results['dead']) >= CHECK_BATCH:
+            flush()
+
+    await asyncio.gather(*(check(tg_id, enc_token) for tg_id, enc_token in rows))
+    flush()
+    marked = 0
+    for future in writes:
+        marked += await asyncio.wrap_future(future)
+    if marked:
+        inc('tokens_dead_total', marked)
+    return marked, reclaimed, errors
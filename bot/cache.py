@@ -0,0 +1,99 @@
+# bot/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+from config.settings import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, FEED_CACHE_SIZE, FEED_VERSION_TTL
+from .metrics import register_callback
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Простой потокобезопасный LRU-кэш с ограничением размера и временем жизни записей.
+    Используется и из event loop (хендлеры), и из потока APScheduler (обновление расписаний),
+    поэтому все операции идут под блокировкой.
+    Если задан name, попадания/промахи/размер экспортируются в метрики
+    (cache_hits_total, cache_misses_total, cache_size с меткой cache=name).
+
+    У каждого ключа есть версия, которая растёт при его инвалидации. Кто
+    читает источник данных не мгновенно (БД, расшифровка), запоминает
+    version(key) до чтения и передаёт её в set: если за это время этот ключ
+    инвалидировали, прочитанное могло устареть, и в кэш оно не попадёт.
+    Инвалидация других ключей на запись не влияет.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._versions = {}  # ключ -> число инвалидаций (только для инвалидированных)
+        if name:
+            register_callback('cache_hits_total', 'counter', lambda: self.hits, cache=name)
+            register_callback('cache_misses_total', 'counter', lambda: self.misses, cache=name)
+            register_callback('cache_size', 'gauge', lambda: len(self._data), cache=name)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def version(self, key) -> int:
+        return self._versions.get(key, 0)
+
+    def versions(self) -> dict:
+        """
+        Снимок версий всех ключей — для тех, кто читает из источника сразу много ключей.
+        """
+        with self._lock:
+            return dict(self._versions)
+
+    def set(self, key, value, version=None):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if version is not None and version != self._versions.get(key, 0):
+                return
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Расшифрованные токены МЭШ по telegram_user_id.
+# Инвалидируется из save_token_db и delete_user_data.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, name='token')
+
+# Токен ICS-ленты -> student_id (bot.feed). Инвалидируется из bot.database
+# при /feed reset, смене привязки к ученику и удалении пользователя —
+# иначе старая ссылка работала бы ещё FEED_VERSION_TTL секунд.
+feed_user_cache = TTLCache(FEED_CACHE_SIZE * 5, FEED_VERSION_TTL, name='feed_user')
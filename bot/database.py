@@ -1,34 +1,40 @@
 # bot/database.py
 
+import logging
+import secrets
 import sqlite3
-from config.settings import DATABASE_PATH
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from config.settings import (
+    DATABASE_PATH,
+    SCHEDULE_RETENTION_DAYS,
+    SCHEDULE_PRUNE_BATCH,
+    TOKEN_PURGE_AFTER,
+    TOKEN_PURGE_BATCH,
+)
+from .cache import token_cache, feed_user_cache
+from .lessons import Lesson, pack_event
+from .metrics import timed, inc
+
+logger = logging.getLogger(__name__)
 
 def get_db_connection():
     return sqlite3.connect(DATABASE_PATH)
 
-def init_db():
-    """
-    Создаёт таблицу users (если нет) для хранения токенов.
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+# Миграции схемы: N-й элемент списка переводит БД с версии N на N+1.
+# Текущая версия хранится в PRAGMA user_version.
+MIGRATIONS = [
+    # 1: таблица users (токены) и schedule (уроки) с полями
+    #    homework_text, room_number, lesson_theme.
+    (
+        '''
         CREATE TABLE IF NOT EXISTS users (
             telegram_user_id INTEGER PRIMARY KEY,
             encrypted_token BLOB
         )
-    ''')
-    conn.commit()
-    conn.close()
-def init_schedule_db():
-    """
-    Создает таблицу schedule, если ее нет.
-    Включаем дополнительные поля:
-      homework_text, room_number, lesson_theme.
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS schedule (
             user_id INTEGER,
             date TEXT,
@@ -40,39 +46,817 @@ def init_schedule_db():
             room_number TEXT,
             lesson_theme TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
-
+        ''',
+    ),
+    # 2: отпечаток ключа, которым зашифрован токен (для ротации ключей)
+    (
+        'ALTER TABLE users ADD COLUMN key_id TEXT',
+    ),
+    # 3: привязка пользователя к профилю и ученику МЭШ, чтобы не запрашивать
+    #    get_users_profile_info/get_family_profile на каждое действие
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS identity (
+            telegram_user_id INTEGER PRIMARY KEY,
+            profile_id INTEGER,
+            person_guid TEXT,
+            mes_role TEXT,
+            updated_at TEXT
+        )
+        ''',
+    ),
+    # 4: индексы по дате — чтение дня/диапазона пользователя и удаление
+    #    старой истории идут по индексу, а не полным просмотром schedule
+    (
+        'CREATE INDEX IF NOT EXISTS idx_schedule_user_date ON schedule (user_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_schedule_date ON schedule (date)',
+    ),
+    # 5: полнотекстовый индекс FTS5 по ДЗ и темам уроков (external content —
+    #    текст хранится только в schedule, индекс ведут триггеры).
+    #    user_id индексируется как токен, чтобы фильтр по пользователю шёл
+    #    внутри FTS. rowid schedule не должен меняться: после VACUUM нужен
+    #    INSERT INTO schedule_fts(schedule_fts) VALUES('rebuild').
+    (
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS schedule_fts USING fts5(
+            user_id, subject_name, homework_text, lesson_theme,
+            content='schedule', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ai AFTER INSERT ON schedule BEGIN
+            INSERT INTO schedule_fts (rowid, user_id, subject_name, homework_text, lesson_theme)
+            VALUES (new.rowid, new.user_id, new.subject_name, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ad AFTER DELETE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, user_id, subject_name, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.user_id, old.subject_name, old.homework_text, old.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_au AFTER UPDATE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, user_id, subject_name, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.user_id, old.subject_name, old.homework_text, old.lesson_theme);
+            INSERT INTO schedule_fts (rowid, user_id, subject_name, homework_text, lesson_theme)
+            VALUES (new.rowid, new.user_id, new.subject_name, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        "INSERT INTO schedule_fts (schedule_fts) VALUES ('rebuild')",
+    ),
+    # 6: версия расписания пользователя — растёт при каждом реальном изменении
+    #    его строк в schedule (ключ кэшей экспорта и ETag ICS-ленты)
+    (
+        'ALTER TABLE users ADD COLUMN schedule_version INTEGER NOT NULL DEFAULT 0',
+    ),
+    # 7: секретный токен ICS-ленты пользователя (часть URL подписки)
+    (
+        'ALTER TABLE users ADD COLUMN feed_token TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_feed_token ON users (feed_token)',
+    ),
+    # 8: жизненный цикл токена: срок действия (unix time из JWT exp) и статус
+    #    active / needs_relogin (токен мёртв — обновление расписания его пропускает)
+    (
+        'ALTER TABLE users ADD COLUMN token_expires_at INTEGER',
+        "ALTER TABLE users ADD COLUMN token_status TEXT NOT NULL DEFAULT 'active'",
+        'CREATE INDEX IF NOT EXISTS idx_users_token_expiry ON users (token_status, token_expires_at)',
+    ),
+    # 9: расписание хранится один раз на ученика (students), а не на каждого
+    #    телеграм-пользователя: родители и сам ученик — подписчики одной копии
+    #    (identity.student_id). Из старых копий остаётся одна на ученика.
+    #    Строки пользователей, чей ученик ещё не известен (например, БД старше
+    #    таблицы identity), переезжают к временному ученику 'user:<id>' —
+    #    sql_upsert_identity перенесёт их к настоящему, когда его определит
+    #    обновление расписания. Версия расписания переезжает в students.
+    (
+        'DROP TRIGGER IF EXISTS schedule_fts_ai',
+        'DROP TRIGGER IF EXISTS schedule_fts_ad',
+        'DROP TRIGGER IF EXISTS schedule_fts_au',
+        'DROP TABLE IF EXISTS schedule_fts',
+        '''
+        CREATE TABLE IF NOT EXISTS students (
+            student_id INTEGER PRIMARY KEY,
+            person_guid TEXT NOT NULL UNIQUE,
+            schedule_version INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'ALTER TABLE identity ADD COLUMN student_id INTEGER',
+        '''
+        INSERT OR IGNORE INTO students (person_guid)
+        SELECT person_guid FROM identity WHERE person_guid IS NOT NULL ORDER BY telegram_user_id
+        ''',
+        '''
+        UPDATE identity SET student_id = (
+            SELECT student_id FROM students s WHERE s.person_guid = identity.person_guid
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_identity_student ON identity (student_id)',
+        '''
+        INSERT OR IGNORE INTO students (person_guid)
+        SELECT DISTINCT 'user:' || s.user_id FROM schedule s
+        JOIN users u ON u.telegram_user_id = s.user_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM identity i WHERE i.telegram_user_id = s.user_id AND i.student_id IS NOT NULL
+        )
+        ''',
+        '''
+        UPDATE students SET schedule_version = (
+            SELECT COALESCE(MAX(u.schedule_version), 0) FROM users u
+            JOIN identity i ON i.telegram_user_id = u.telegram_user_id
+            WHERE i.student_id = students.student_id
+        )
+        ''',
+        '''
+        DELETE FROM schedule WHERE user_id NOT IN (
+            SELECT user_id FROM (
+                SELECT user_id, MAX(n) FROM (
+                    SELECT s.user_id, i.student_id, COUNT(*) AS n
+                    FROM schedule s JOIN identity i ON i.telegram_user_id = s.user_id
+                    WHERE i.student_id IS NOT NULL
+                    GROUP BY s.user_id
+                ) GROUP BY student_id
+            )
+        ) AND 'user:' || user_id NOT IN (SELECT person_guid FROM students)
+        ''',
+        '''
+        UPDATE schedule SET user_id = COALESCE(
+            (SELECT student_id FROM identity i WHERE i.telegram_user_id = schedule.user_id),
+            (SELECT student_id FROM students s WHERE s.person_guid = 'user:' || schedule.user_id)
+        )
+        ''',
+        'DROP INDEX IF EXISTS idx_schedule_user_date',
+        'ALTER TABLE schedule RENAME COLUMN user_id TO student_id',
+        'CREATE INDEX IF NOT EXISTS idx_schedule_student_date ON schedule (student_id, date)',
+        'ALTER TABLE users DROP COLUMN schedule_version',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS schedule_fts USING fts5(
+            student_id, subject_name, homework_text, lesson_theme,
+            content='schedule', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ai AFTER INSERT ON schedule BEGIN
+            INSERT INTO schedule_fts (rowid, student_id, subject_name, homework_text, lesson_theme)
+            VALUES (new.rowid, new.student_id, new.subject_name, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ad AFTER DELETE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, student_id, subject_name, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.student_id, old.subject_name, old.homework_text, old.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_au AFTER UPDATE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, student_id, subject_name, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.student_id, old.subject_name, old.homework_text, old.lesson_theme);
+            INSERT INTO schedule_fts (rowid, student_id, subject_name, homework_text, lesson_theme)
+            VALUES (new.rowid, new.student_id, new.subject_name, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        "INSERT INTO schedule_fts (schedule_fts) VALUES ('rebuild')",
+    ),
+    # 10: компактное хранение: предметы, кабинеты и пары «начало–конец»
+    #     вынесены в справочники (subjects, rooms, slots), в schedule — только
+    #     их id; дата — число дней с 1970-01-01 (колонка day). В FTS остаются
+    #     только ДЗ и тема. Освободившиеся страницы переиспользуются SQLite
+    #     (VACUUM не делаем: он может поменять rowid, на которые ссылается FTS).
+    (
+        'DROP TRIGGER IF EXISTS schedule_fts_ai',
+        'DROP TRIGGER IF EXISTS schedule_fts_ad',
+        'DROP TRIGGER IF EXISTS schedule_fts_au',
+        'DROP TABLE IF EXISTS schedule_fts',
+        'CREATE TABLE IF NOT EXISTS subjects (subject_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS rooms (room_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        '''
+        CREATE TABLE IF NOT EXISTS slots (
+            slot_id INTEGER PRIMARY KEY,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            UNIQUE (start_time, end_time)
+        )
+        ''',
+        "INSERT OR IGNORE INTO subjects (name) SELECT DISTINCT COALESCE(subject_name, '') FROM schedule",
+        "INSERT OR IGNORE INTO rooms (name) SELECT DISTINCT COALESCE(room_number, '') FROM schedule",
+        '''
+        INSERT OR IGNORE INTO slots (start_time, end_time)
+        SELECT DISTINCT COALESCE(start_time, ''), COALESCE(end_time, '') FROM schedule
+        ''',
+        '''
+        CREATE TABLE schedule_v10 (
+            student_id INTEGER,
+            day INTEGER,
+            lesson_id INTEGER,
+            subject_id INTEGER,
+            slot_id INTEGER,
+            room_id INTEGER,
+            homework_text TEXT,
+            lesson_theme TEXT
+        )
+        ''',
+        '''
+        INSERT INTO schedule_v10
+        SELECT s.student_id, CAST(julianday(s.date) - 2440587.5 AS INTEGER), s.lesson_id,
+               sub.subject_id, sl.slot_id, r.room_id, s.homework_text, s.lesson_theme
+        FROM schedule s
+        JOIN subjects sub ON sub.name = COALESCE(s.subject_name, '')
+        JOIN rooms r ON r.name = COALESCE(s.room_number, '')
+        JOIN slots sl ON sl.start_time = COALESCE(s.start_time, '') AND sl.end_time = COALESCE(s.end_time, '')
+        ORDER BY s.rowid
+        ''',
+        'DROP TABLE schedule',
+        'ALTER TABLE schedule_v10 RENAME TO schedule',
+        'CREATE INDEX IF NOT EXISTS idx_schedule_student_day ON schedule (student_id, day)',
+        'CREATE INDEX IF NOT EXISTS idx_schedule_day ON schedule (day)',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS schedule_fts USING fts5(
+            student_id, homework_text, lesson_theme,
+            content='schedule', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ai AFTER INSERT ON schedule BEGIN
+            INSERT INTO schedule_fts (rowid, student_id, homework_text, lesson_theme)
+            VALUES (new.rowid, new.student_id, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_ad AFTER DELETE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, student_id, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.student_id, old.homework_text, old.lesson_theme);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS schedule_fts_au AFTER UPDATE ON schedule BEGIN
+            INSERT INTO schedule_fts (schedule_fts, rowid, student_id, homework_text, lesson_theme)
+            VALUES ('delete', old.rowid, old.student_id, old.homework_text, old.lesson_theme);
+            INSERT INTO schedule_fts (rowid, student_id, homework_text, lesson_theme)
+            VALUES (new.rowid, new.student_id, new.homework_text, new.lesson_theme);
+        END
+        ''',
+        "INSERT INTO schedule_fts (schedule_fts) VALUES ('rebuild')",
+    ),
+    # 11: когда расписание ученика последний раз обновлялось (unix time):
+    #     целиком (refreshed_at) и с дальним горизонтом (far_refreshed_at).
+    #     Проход update_all_schedules идёт от самых давних, пропуская свежие,
+    #     поэтому после рестарта он продолжается с того места, где прервался
+    (
+        'ALTER TABLE students ADD COLUMN refreshed_at INTEGER',
+        'ALTER TABLE students ADD COLUMN far_refreshed_at INTEGER',
+    ),
+    # 12: утренняя сводка (opt-in): во сколько присылать (минуты от полуночи,
+    #     NULL — выключена) и за какой день (schedule.day) она уже отправлена
+    (
+        'ALTER TABLE users ADD COLUMN digest_at INTEGER',
+        'ALTER TABLE users ADD COLUMN digest_sent_on INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_users_digest ON users (digest_at) WHERE digest_at IS NOT NULL',
+    ),
+    # 13: проверка токенов (validate_tokens): когда токен последний раз
+    #     проверялся у МЭШ и с какого момента он мёртв (needs_relogin) —
+    #     по нему purge_dead_users удаляет давно не вернувшихся пользователей
+    (
+        'ALTER TABLE users ADD COLUMN token_checked_at INTEGER',
+        'ALTER TABLE users ADD COLUMN token_dead_at INTEGER',
+        "UPDATE users SET token_dead_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE token_status = 'needs_relogin'",
+    ),
+    # 14: упакованная нагрузка урока (bot.lessons.pack_event): описания ДЗ
+    #     по отдельности и материалы (ЦДЗ) — чтобы карточка урока из локальной
+    #     БД совпадала с живой. У старых строк NULL; обновление расписания
+    #     перезапишет их, так как строки перестанут совпадать
+    (
+        'ALTER TABLE schedule ADD COLUMN payload BLOB',
+    ),
+]
 
-def delete_user_data(telegram_user_id: int):
+@timed('db_seconds')
+def init_db():
     """
-    Удаляет данные пользователя (зашифрованный токен) из базы данных.
+    Приводит схему БД к последней версии.
+    Все недостающие миграции применяются в одной транзакции (одно подключение,
+    один commit); если схема уже актуальна — только чтение user_version.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE telegram_user_id = ?', (telegram_user_id,))
-    conn.commit()
-    conn.close()
+    conn.isolation_level = None  # транзакцией управляем сами
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        # Перечитываем под блокировкой: миграцию мог уже сделать другой процесс
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for statements in MIGRATIONS[version:]:
+            for sql in statements:
+                conn.execute(sql)
+        conn.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+# --- SQL поверх готового подключения ----------------------------------------
+# Общие для синхронных функций ниже (своё подключение на вызов) и для
+# асинхронного репозитория bot.repository (одно подключение в отдельном потоке).
 
-def clear_user_schedule(user_id: int):
+def sql_select_users(conn, active_only: bool = False, now: int = None):
     """
-    Удаляет все записи расписания пользователя user_id (телеграм-пользователя).
+    (telegram_user_id, encrypted_token) всех пользователей; при active_only —
+    только с рабочим токеном (статус active и срок не истёк к моменту now).
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM schedule WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    if not active_only:
+        return conn.execute('SELECT telegram_user_id, encrypted_token FROM users').fetchall()
+    return conn.execute('''
+        SELECT telegram_user_id, encrypted_token FROM users
+        WHERE token_status = 'active'
+          AND (token_expires_at IS NULL OR token_expires_at > ?)
+    ''', (now if now is not None else int(time.time()),)).fetchall()
 
-def save_events_in_db(user_id: int, events_response):
+def sql_select_expiring_tokens(conn, before: int):
     """
-    Сохраняет список уроков (events) для данного user_id в таблицу schedule.
-    Теперь также записываем room_number и lesson_theme.
+    Активные токены, срок которых истекает раньше before (unix time).
     """
-    items = events_response.response  # список уроков (Item)
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return conn.execute('''
+        SELECT telegram_user_id, encrypted_token FROM users
+        WHERE token_status = 'active' AND token_expires_at IS NOT NULL AND token_expires_at < ?
+        ORDER BY token_expires_at
+    ''', (before,)).fetchall()
+
+def sql_mark_needs_relogin(conn, telegram_user_id: int):
+    conn.execute('''
+        UPDATE users SET token_status = 'needs_relogin', token_dead_at = ?
+        WHERE telegram_user_id = ? AND token_status = 'active'
+    ''', (int(time.time()), telegram_user_id))
+
+def sql_mark_expired_tokens(conn, now: int) -> int:
+    """
+    Переводит в needs_relogin все активные токены с истёкшим сроком. Возвращает их число.
+    """
+    cur = conn.execute('''
+        UPDATE users SET token_status = 'needs_relogin', token_dead_at = ?
+        WHERE token_status = 'active' AND token_expires_at IS NOT NULL AND token_expires_at <= ?
+    ''', (now, now))
+    return cur.rowcount
+
+def sql_select_unchecked_tokens(conn, checked_before: int):
+    """
+    Активные токены, которые не проверялись у МЭШ с checked_before (unix time),
+    от давно проверенных к недавним: (telegram_user_id, encrypted_token).
+    """
+    return conn.execute('''
+        SELECT telegram_user_id, encrypted_token FROM users
+        WHERE token_status = 'active' AND encrypted_token IS NOT NULL
+          AND (token_checked_at IS NULL OR token_checked_at < ?)
+        ORDER BY COALESCE(token_checked_at, 0), telegram_user_id
+    ''', (checked_before,)).fetchall()
+
+def sql_record_token_checks(conn, alive, dead, now: int) -> int:
+    """
+    Записывает результаты проверки токенов: alive и dead — списки
+    (telegram_user_id, encrypted_token). Строка меняется, только если токен
+    не поменялся с момента чтения (иначе пользователь успел заново войти).
+    Возвращает число токенов, переведённых в needs_relogin.
+    """
+    conn.executemany(
+        'UPDATE users SET token_checked_at = ? WHERE telegram_user_id = ? AND encrypted_token = ?',
+        [(now, tg_id, enc_token) for tg_id, enc_token in alive]
+    )
+    cur = conn.executemany('''
+        UPDATE users SET token_status = 'needs_relogin', token_dead_at = ?, token_checked_at = ?
+        WHERE telegram_user_id = ? AND encrypted_token = ? AND token_status = 'active'
+    ''', [(now, now, tg_id, enc_token) for tg_id, enc_token in dead])
+    return cur.rowcount
+
+def sql_select_token_status(conn, telegram_user_id: int):
+    row = conn.execute(
+        'SELECT token_status FROM users WHERE telegram_user_id = ?', (telegram_user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def sql_select_token(conn, telegram_user_id: int):
+    row = conn.execute(
+        'SELECT encrypted_token FROM users WHERE telegram_user_id = ?', (telegram_user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def sql_upsert_token(conn, telegram_user_id: int, encrypted_token, key_id, expires_at: int = None):
+    conn.execute('''
+        INSERT INTO users (telegram_user_id, encrypted_token, key_id, token_expires_at, token_status)
+        VALUES (?, ?, ?, ?, 'active')
+        ON CONFLICT(telegram_user_id) DO UPDATE SET
+            encrypted_token = excluded.encrypted_token,
+            key_id = excluded.key_id,
+            token_expires_at = excluded.token_expires_at,
+            token_status = 'active',
+            token_checked_at = NULL,
+            token_dead_at = NULL
+    ''', (telegram_user_id, encrypted_token, key_id, expires_at))
+
+def sql_update_token(conn, telegram_user_id: int, encrypted_token, key_id, expires_at: int = None,
+                     expected=None) -> bool:
+    """
+    Заменяет токен существующего пользователя (продление), не трогая привязку
+    к ученику. При expected строка меняется, только если сейчас в ней именно
+    этот зашифрованный токен (пользователь не успел заново войти).
+    False, если ничего не обновлено.
+    """
+    cur = conn.execute('''
+        UPDATE users SET encrypted_token = ?, key_id = ?, token_expires_at = ?,
+            token_status = 'active', token_dead_at = NULL
+        WHERE telegram_user_id = ? AND (? IS NULL OR encrypted_token = ?)
+    ''', (encrypted_token, key_id, expires_at, telegram_user_id, expected, expected))
+    return cur.rowcount > 0
+
+def sql_delete_user(conn, telegram_user_id: int):
+    """
+    Удаляет токен и привязку пользователя; если он был последним подписчиком
+    ученика — и сохранённое расписание этого ученика.
+    """
+    student_id = sql_select_student_id(conn, telegram_user_id)
+    _forget_feed_token(conn, telegram_user_id)
+    conn.execute('DELETE FROM users WHERE telegram_user_id = ?', (telegram_user_id,))
+    conn.execute('DELETE FROM identity WHERE telegram_user_id = ?', (telegram_user_id,))
+    if student_id is not None:
+        sql_drop_orphan_students(conn, student_id)
+
+def sql_select_dead_users(conn, dead_before: int, limit: int):
+    """
+    Пользователи, чей токен мёртв с dead_before (unix time) и раньше
+    или вовсе отсутствует (не больше limit).
+    """
+    return [row[0] for row in conn.execute('''
+        SELECT telegram_user_id FROM users
+        WHERE (token_status = 'needs_relogin' AND token_dead_at < ?) OR encrypted_token IS NULL
+        LIMIT ?
+    ''', (dead_before, limit))]
+
+def sql_purge_users(conn, telegram_user_ids) -> int:
+    """
+    Удаляет пользователей вместе с привязкой, а расписание их учеников —
+    если подписчиков у ученика не осталось. Возвращает число удалённых уроков.
+    """
+    params = [(tg_id,) for tg_id in telegram_user_ids]
+    student_ids = {sql_select_student_id(conn, tg_id) for tg_id in telegram_user_ids} - {None}
+    for tg_id in telegram_user_ids:
+        _forget_feed_token(conn, tg_id)
+    conn.executemany('DELETE FROM users WHERE telegram_user_id = ?', params)
+    conn.executemany('DELETE FROM identity WHERE telegram_user_id = ?', params)
+    return sum(sql_drop_orphan_students(conn, student_id) for student_id in student_ids)
+
+def sql_select_subscribers(conn, stale_before: int = None, now: int = None):
+    """
+    Пользователи с рабочим токеном (как sql_select_users(active_only=True))
+    вместе с привязкой к ученику, сгруппированные по ученику, от давно не
+    обновлявшихся к недавним:
+    (telegram_user_id, encrypted_token, student_id, person_guid, mes_role, far_refreshed_at).
+    Если ученик ещё не определён, student_id и следующие поля — None.
+    При stale_before (unix time) ученики, обновлённые позже, пропускаются.
+    """
+    return conn.execute('''
+        SELECT u.telegram_user_id, u.encrypted_token, i.student_id, i.person_guid, i.mes_role,
+               s.far_refreshed_at
+        FROM users u
+        LEFT JOIN identity i ON i.telegram_user_id = u.telegram_user_id
+        LEFT JOIN students s ON s.student_id = i.student_id
+        WHERE u.token_status = 'active'
+          AND (u.token_expires_at IS NULL OR u.token_expires_at > ?)
+          AND (? IS NULL OR s.refreshed_at IS NULL OR s.refreshed_at < ?)
+        ORDER BY COALESCE(s.refreshed_at, 0), i.student_id, u.telegram_user_id
+    ''', (now if now is not None else int(time.time()), stale_before, stale_before)).fetchall()
+
+def sql_select_identity(conn, telegram_user_id: int):
+    """
+    (profile_id, person_guid, mes_role, student_id) или None.
+    """
+    return conn.execute(
+        'SELECT profile_id, person_guid, mes_role, student_id FROM identity WHERE telegram_user_id = ?',
+        (telegram_user_id,)
+    ).fetchone()
+
+def sql_upsert_identity(conn, telegram_user_id: int, profile_id, person_guid, mes_role):
+    """
+    Привязывает пользователя к ученику person_guid (ученик заводится в students
+    при первом подписчике). Возвращает student_id.
+    """
+    conn.execute(
+        'INSERT INTO students (person_guid) VALUES (?) ON CONFLICT(person_guid) DO NOTHING',
+        (person_guid,)
+    )
+    student_id = conn.execute(
+        'SELECT student_id FROM students WHERE person_guid = ?', (person_guid,)
+    ).fetchone()[0]
+    conn.execute('''
+        INSERT INTO identity (telegram_user_id, profile_id, person_guid, mes_role, student_id, updated_at)
+        VALUES (?, ?, ?, ?, ?, datetime('now'))
+        ON CONFLICT(telegram_user_id) DO UPDATE SET
+            profile_id = excluded.profile_id,
+            person_guid = excluded.person_guid,
+            mes_role = excluded.mes_role,
+            student_id = excluded.student_id,
+            updated_at = excluded.updated_at
+    ''', (telegram_user_id, profile_id, person_guid, mes_role, student_id))
+    _adopt_placeholder(conn, telegram_user_id, student_id)
+    _forget_feed_token(conn, telegram_user_id)
+    return student_id
+
+def _placeholder_guid(telegram_user_id: int) -> str:
+    # Временный ученик для расписания пользователя, чей ученик ещё не известен (миграция 9)
+    return f'user:{telegram_user_id}'
+
+def _adopt_placeholder(conn, telegram_user_id: int, student_id: int):
+    """
+    Переносит расписание временного ученика пользователя к настоящему student_id
+    (если у того своего расписания ещё нет) и удаляет временного.
+    """
+    row = conn.execute(
+        'SELECT student_id FROM students WHERE person_guid = ?', (_placeholder_guid(telegram_user_id),)
+    ).fetchone()
+    if row is None:
+        return
+    placeholder = row[0]
+    if conn.execute('SELECT 1 FROM schedule WHERE student_id = ? LIMIT 1', (student_id,)).fetchone() is None:
+        conn.execute('UPDATE schedule SET student_id = ? WHERE student_id = ?', (student_id, placeholder))
+        sql_bump_schedule_version(conn, student_id)
+    conn.execute('DELETE FROM schedule WHERE student_id = ?', (placeholder,))
+    conn.execute('DELETE FROM students WHERE student_id = ?', (placeholder,))
+
+def sql_delete_identity(conn, telegram_user_id: int):
+    _forget_feed_token(conn, telegram_user_id)
+    conn.execute('DELETE FROM identity WHERE telegram_user_id = ?', (telegram_user_id,))
+
+def _forget_feed_token(conn, telegram_user_id: int):
+    # Лента пользователя больше не должна отдаваться из кэша bot.feed
+    row = conn.execute(
+        'SELECT feed_token FROM users WHERE telegram_user_id = ?', (telegram_user_id,)
+    ).fetchone()
+    if row and row[0]:
+        feed_user_cache.invalidate(row[0])
+
+def sql_select_student_id(conn, telegram_user_id: int):
+    """
+    student_id ученика, к которому привязан пользователь (или его временного
+    ученика, пока настоящий не определён), или None.
+    """
+    return conn.execute('''
+        SELECT COALESCE(
+            (SELECT student_id FROM identity WHERE telegram_user_id = ?),
+            (SELECT student_id FROM students WHERE person_guid = ?)
+        )
+    ''', (telegram_user_id, _placeholder_guid(telegram_user_id))).fetchone()[0]
+
+def sql_drop_orphan_students(conn, student_id: int = None) -> int:
+    """
+    Удаляет расписание и запись учеников, у которых не осталось подписчиков
+    (только ученика student_id, если он задан). Временный ученик живёт, пока
+    есть его пользователь. Возвращает число удалённых уроков.
+    """
+    orphans = '''
+        SELECT student_id FROM students s
+        WHERE (? IS NULL OR s.student_id = ?)
+          AND NOT EXISTS (SELECT 1 FROM identity i WHERE i.student_id = s.student_id)
+          AND NOT (s.person_guid LIKE 'user:%' AND EXISTS (
+              SELECT 1 FROM users u WHERE u.telegram_user_id = CAST(substr(s.person_guid, 6) AS INTEGER)
+          ))
+    '''
+    cur = conn.execute(
+        f'DELETE FROM schedule WHERE student_id IN ({orphans})', (student_id, student_id)
+    )
+    conn.execute(f'DELETE FROM students WHERE student_id IN ({orphans})', (student_id, student_id))
+    return cur.rowcount
+
+def sql_select_schedule_version(conn, student_id: int) -> int:
+    row = conn.execute(
+        'SELECT schedule_version FROM students WHERE student_id = ?', (student_id,)
+    ).fetchone()
+    return row[0] if row else 0
+
+def sql_bump_schedule_version(conn, student_id: int):
+    conn.execute(
+        'UPDATE students SET schedule_version = schedule_version + 1 WHERE student_id = ?',
+        (student_id,)
+    )
+
+def sql_select_feed_user(conn, feed_token: str):
+    """
+    student_id ученика, чьё расписание отдаёт ICS-лента с этим токеном, или None.
+    """
+    row = conn.execute('SELECT telegram_user_id FROM users WHERE feed_token = ?', (feed_token,)).fetchone()
+    return sql_select_student_id(conn, row[0]) if row else None
+
+def sql_ensure_feed_token(conn, user_id: int, reset: bool = False):
+    """
+    Возвращает токен ICS-ленты пользователя, создавая новый, если его нет
+    (или если reset=True — старая ссылка перестаёт работать).
+    None, если пользователя нет в users.
+    """
+    row = conn.execute(
+        'SELECT feed_token FROM users WHERE telegram_user_id = ?', (user_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    if row[0] and not reset:
+        return row[0]
+    if row[0]:
+        feed_user_cache.invalidate(row[0])
+    feed_token = secrets.token_urlsafe(24)
+    conn.execute(
+        'UPDATE users SET feed_token = ? WHERE telegram_user_id = ?', (feed_token, user_id)
+    )
+    return feed_token
+
+# --- Справочники и даты ------------------------------------------------------
+# Предметы, кабинеты и слоты времени повторяются из недели в неделю и у всех
+# учеников школы, поэтому в schedule хранятся только их id. Справочники
+# маленькие и только растут (id не переиспользуются), так что целиком
+# держатся в памяти процесса: декодирование строк — поиск в словаре.
+
+_EPOCH = date(1970, 1, 1)
+
+def day_number(value) -> int:
+    """
+    Дата (date или строка YYYY-MM-DD) -> число дней с 1970-01-01 (колонка schedule.day).
+    """
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return (value - _EPOCH).days
+
+def day_str(number) -> str:
+    """
+    schedule.day -> строка YYYY-MM-DD ('' для уроков без даты).
+    """
+    if number is None:
+        return ''
+    return (_EPOCH + timedelta(days=number)).isoformat()
+
+
+class _Lookup:
+    """
+    Справочник значение <-> id поверх таблицы table.
+    Кэш в памяти заполняется чтением всей таблицы и id, вставленными в encode.
+    Если транзакция с такой вставкой откатилась, кэш нужно сбросить
+    (forget_lookups, это делает bot.repository) — иначе в нём останется id
+    несуществующей строки.
+    """
+
+    def __init__(self, table, key, columns):
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self._ids = {}     # значение -> id
+        self._values = {}  # id -> значение
+
+    def _value(self, row):
+        return row if len(self.columns) > 1 else row[0]
+
+    def reload(self, conn):
+        rows = conn.execute(
+            f'SELECT {self.key}, {", ".join(self.columns)} FROM {self.table}'
+        ).fetchall()
+        values = {row[0]: self._value(row[1:]) for row in rows}
+        # Словари подменяются целиком — читатели из других потоков не видят полусобранных
+        self._values = values
+        self._ids = {value: key for key, value in values.items()}
+        inc('lookup_reloads_total', table=self.table)
+
+    def forget(self):
+        self._values = {}
+        self._ids = {}
+
+    def encode(self, conn, value) -> int:
+        key = self._ids.get(value)
+        if key is not None:
+            return key
+        if not self._ids:
+            # Свежий процесс (или после forget): весь справочник одним запросом
+            self.reload(conn)
+            key = self._ids.get(value)
+            if key is not None:
+                return key
+        params = value if len(self.columns) > 1 else (value,)
+        where = ' AND '.join(f'{c} = ?' for c in self.columns)
+        conn.execute(
+            f'INSERT OR IGNORE INTO {self.table} ({", ".join(self.columns)}) '
+            f'VALUES ({", ".join("?" * len(self.columns))})',
+            params
+        )
+        key = conn.execute(f'SELECT {self.key} FROM {self.table} WHERE {where}', params).fetchone()[0]
+        # Новые словари вместо правки на месте — как в reload
+        self._ids = {**self._ids, value: key}
+        self._values = {**self._values, key: value}
+        return key
+
+    def decode(self, conn, key):
+        value = self._values.get(key)
+        if value is None and key is not None:
+            self.reload(conn)
+            value = self._values.get(key)
+        return value
+
+
+subjects = _Lookup('subjects', 'subject_id', ('name',))
+rooms = _Lookup('rooms', 'room_id', ('name',))
+slots = _Lookup('slots', 'slot_id', ('start_time', 'end_time'))
+
+
+def forget_lookups():
+    """
+    Сбрасывает кэши справочников (после отката транзакции, вставлявшей в них).
+    """
+    for lookup in (subjects, rooms, slots):
+        lookup.forget()
+
+
+def sql_set_digest(conn, telegram_user_id: int, minute: int = None, now: datetime = None):
+    """
+    Включает утреннюю сводку на minute минут от полуночи (None — выключает).
+    Если это время сегодня уже прошло, первая сводка придёт завтра (сегодняшний
+    день отмечается как отправленный). Возвращает день первой сводки (date;
+    сегодня или позже) или None, если пользователя нет в users.
+    """
+    now = now or datetime.now()
+    today = day_number(now.date())
+    passed = minute is not None and minute <= now.hour * 60 + now.minute
+    row = conn.execute('''
+        UPDATE users SET digest_at = ?,
+            digest_sent_on = CASE WHEN ? THEN MAX(COALESCE(digest_sent_on, 0), ?) ELSE digest_sent_on END
+        WHERE telegram_user_id = ?
+        RETURNING digest_sent_on
+    ''', (minute, passed, today, telegram_user_id)).fetchone()
+    if row is None:
+        return None
+    # Сводка за день, уже отмеченный отправленным, не придёт
+    sent_on = row[0]
+    first = today if sent_on is None or sent_on < today else sent_on + 1
+    return _EPOCH + timedelta(days=first)
+
+def sql_select_digest(conn, telegram_user_id: int):
+    row = conn.execute(
+        'SELECT digest_at FROM users WHERE telegram_user_id = ?', (telegram_user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def sql_select_digest_students(conn):
+    """
+    Ученики, у которых есть хотя бы один подписчик утренней сводки.
+    """
+    return [row[0] for row in conn.execute('''
+        SELECT DISTINCT i.student_id FROM users u
+        JOIN identity i ON i.telegram_user_id = u.telegram_user_id
+        WHERE u.digest_at IS NOT NULL AND i.student_id IS NOT NULL
+    ''')]
+
+def sql_select_due_digests(conn, minute: int, day: int):
+    """
+    Кому пора отправить сводку за день day: время сводки уже наступило
+    (digest_at <= minute), а за этот день она ещё не отправлена.
+    Список (telegram_user_id, student_id) в порядке времени сводки.
+    """
+    return conn.execute('''
+        SELECT u.telegram_user_id, i.student_id FROM users u
+        JOIN identity i ON i.telegram_user_id = u.telegram_user_id
+        WHERE u.digest_at IS NOT NULL AND u.digest_at <= ?
+          AND (u.digest_sent_on IS NULL OR u.digest_sent_on < ?)
+          AND i.student_id IS NOT NULL
+        ORDER BY u.digest_at, u.telegram_user_id
+    ''', (minute, day)).fetchall()
+
+def sql_mark_digest_sent(conn, telegram_user_ids, day: int):
+    conn.executemany(
+        'UPDATE users SET digest_sent_on = ? WHERE telegram_user_id = ?',
+        [(day, uid) for uid in telegram_user_ids]
+    )
+
+def sql_select_counts(conn):
+    """
+    Сводные счётчики для /stats: пользователи по статусу токена, с привязкой
+    к ученику и с включённой сводкой, ученики и уроки в schedule.
+    """
+    counts = {f'users_{status}': n for status, n in conn.execute(
+        'SELECT token_status, COUNT(*) FROM users GROUP BY token_status'
+    )}
+    counts['users_identity'] = conn.execute('SELECT COUNT(*) FROM identity').fetchone()[0]
+    counts['users_digest'] = conn.execute(
+        'SELECT COUNT(*) FROM users WHERE digest_at IS NOT NULL'
+    ).fetchone()[0]
+    counts['students'] = conn.execute('SELECT COUNT(*) FROM students').fetchone()[0]
+    counts['lessons'] = conn.execute('SELECT COUNT(*) FROM schedule').fetchone()[0]
+    return counts
+
+def _event_rows(conn, student_id: int, events_response, begin: str = None, end: str = None):
+    """
+    Строки для таблицы schedule из ответа get_events (уроки ученика student_id):
+    предмет, кабинет и время кодируются через справочники, дата — в day,
+    остальное для карточки урока — в payload (bot.lessons.pack_event).
+    Если заданы begin/end (YYYY-MM-DD), уроки вне диапазона пропускаются.
+    """
+    items = events_response.response or []  # список уроков (Item)
+    rows = []
 
     for event in items:
         dt_str = ""
@@ -81,6 +865,8 @@ def save_events_in_db(user_id: int, events_response):
         if event.start_at:
             dt_str = event.start_at.strftime('%Y-%m-%d')
             start_str = event.start_at.strftime('%H:%M')
+        if begin and end and not begin <= dt_str <= end:
+            continue
         if event.finish_at:
             end_str = event.finish_at.strftime('%H:%M')
 
@@ -96,31 +882,253 @@ def save_events_in_db(user_id: int, events_response):
         room = event.room_number or ""
         theme = event.lesson_theme or ""
 
-        cursor.execute('''
-            INSERT INTO schedule (
-                user_id,
-                date,
-                lesson_id,
-                subject_name,
-                start_time,
-                end_time,
-                homework_text,
-                room_number,
-                lesson_theme
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            dt_str,
+        rows.append((
+            student_id,
+            day_number(dt_str) if dt_str else None,
             lesson_id,
-            subject,
-            start_str,
-            end_str,
+            subjects.encode(conn, subject),
+            slots.encode(conn, (start_str, end_str)),
+            rooms.encode(conn, room),
             hw_text,
-            room,
-            theme
+            theme,
+            pack_event(event),
         ))
+    return rows
+
+def _insert_rows(conn, rows):
+    conn.executemany('''
+        INSERT INTO schedule (
+            student_id,
+            day,
+            lesson_id,
+            subject_id,
+            slot_id,
+            room_id,
+            homework_text,
+            lesson_theme,
+            payload
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def sql_replace_schedule(conn, student_id: int, begin: date, end: date, events_response) -> bool:
+    """
+    Заменяет уроки ученика за даты begin..end (включительно) свежими из МЭШ.
+    Более ранние и поздние даты (история) не трогаются.
+    Если за диапазон ничего не поменялось, таблица (и FTS-индекс) не
+    перезаписываются и версия расписания остаётся прежней.
+    Возвращает True, если расписание изменилось.
+    """
+    rows = _event_rows(conn, student_id, events_response, begin.isoformat(), end.isoformat())
+    first, last = day_number(begin), day_number(end)
+    # Сравниваем закодированные строки — справочники для этого не нужны
+    existing = conn.execute('''
+        SELECT student_id, day, lesson_id, subject_id, slot_id, room_id,
+               homework_text, lesson_theme, payload
+        FROM schedule
+        WHERE student_id = ? AND day BETWEEN ? AND ?
+    ''', (student_id, first, last)).fetchall()
+    if Counter(existing) == Counter(rows):
+        return False
+
+    conn.execute(
+        'DELETE FROM schedule WHERE student_id = ? AND day BETWEEN ? AND ?',
+        (student_id, first, last)
+    )
+    _insert_rows(conn, rows)
+    sql_bump_schedule_version(conn, student_id)
+    return True
+
+def sql_mark_refreshed(conn, student_id: int, far: bool, now: int = None):
+    """
+    Отмечает, что расписание ученика только что обновлено из МЭШ (с дальним горизонтом при far).
+    """
+    now = now if now is not None else int(time.time())
+    conn.execute('''
+        UPDATE students SET refreshed_at = ?,
+            far_refreshed_at = CASE WHEN ? THEN ? ELSE far_refreshed_at END
+        WHERE student_id = ?
+    ''', (now, far, now, student_id))
 
+def sql_refresh_schedule(conn, student_id: int, begin: date, end: date, events_response, far: bool) -> bool:
+    """
+    sql_replace_schedule + sql_mark_refreshed в одной записи: отметка об
+    обновлении коммитится вместе с самими уроками. Возвращает True, если расписание изменилось.
+    """
+    changed = sql_replace_schedule(conn, student_id, begin, end, events_response)
+    sql_mark_refreshed(conn, student_id, far)
+    return changed
+
+def _decode_lesson(conn, subject_id, slot_id, room_id):
+    start_time, end_time = slots.decode(conn, slot_id) or ('', '')
+    return subjects.decode(conn, subject_id) or '', start_time, end_time, rooms.decode(conn, room_id) or ''
+
+def sql_iter_schedule(conn, student_id: int):
+    """
+    Все уроки ученика по порядку (date, start_time) — строки читаются курсором
+    по мере перебора, без загрузки всей истории в память:
+    (date, lesson_id, subject_name, start_time, end_time, homework_text, room_number, lesson_theme).
+    """
+    cur = conn.execute('''
+        SELECT s.day, s.lesson_id, s.subject_id, s.slot_id, s.room_id,
+               s.homework_text, s.lesson_theme
+        FROM schedule s
+        LEFT JOIN slots t ON t.slot_id = s.slot_id
+        WHERE s.student_id = ?
+        ORDER BY s.day, t.start_time
+    ''', (student_id,))
+    for day, lesson_id, subject_id, slot_id, room_id, hw_text, theme in cur:
+        subject, start_time, end_time, room = _decode_lesson(conn, subject_id, slot_id, room_id)
+        yield day_str(day), lesson_id, subject, start_time, end_time, hw_text, room, theme
+
+def sql_select_day(conn, student_id: int, date_str: str):
+    """
+    Уроки ученика на дату date_str (YYYY-MM-DD), отсортированные по времени:
+    (lesson_id, subject_name, start_time, end_time, homework_text, room_number, lesson_theme).
+    """
+    rows = conn.execute('''
+        SELECT lesson_id, subject_id, slot_id, room_id, homework_text, lesson_theme
+        FROM schedule
+        WHERE student_id = ? AND day = ?
+    ''', (student_id, day_number(date_str))).fetchall()
+    lessons = []
+    for lesson_id, subject_id, slot_id, room_id, hw_text, theme in rows:
+        subject, start_time, end_time, room = _decode_lesson(conn, subject_id, slot_id, room_id)
+        lessons.append((lesson_id, subject, start_time, end_time, hw_text, room, theme))
+    lessons.sort(key=lambda row: row[2])
+    return lessons
+
+def sql_select_lessons(conn, student_id: int, date_str: str):
+    """
+    Уроки ученика на дату date_str (YYYY-MM-DD) объектами bot.lessons.Lesson
+    (как из живого ответа МЭШ), отсортированные по времени.
+    """
+    rows = conn.execute('''
+        SELECT lesson_id, subject_id, slot_id, room_id, homework_text, lesson_theme, payload
+        FROM schedule
+        WHERE student_id = ? AND day = ?
+    ''', (student_id, day_number(date_str))).fetchall()
+    lessons = []
+    for lesson_id, subject_id, slot_id, room_id, hw_text, theme, payload in rows:
+        subject, start_time, end_time, room = _decode_lesson(conn, subject_id, slot_id, room_id)
+        lessons.append(Lesson.from_row(lesson_id, subject, start_time, end_time, room, theme, hw_text, payload))
+    lessons.sort(key=lambda lesson: lesson.start_time)
+    return lessons
+
+def fts_query(text: str) -> str:
+    """
+    Превращает ввод пользователя в безопасный запрос FTS5: каждое слово —
+    строка в кавычках с поиском по префиксу, все слова обязательны.
+    Пустая строка, если слов нет.
+    """
+    words = [w.replace('"', '""') for w in text.split()]
+    return ' AND '.join(f'"{w}"*' for w in words if w.strip('"'))
+
+def sql_search(conn, student_id: int, match: str, limit: int, offset: int = 0):
+    """
+    Уроки ученика, у которых ДЗ или тема урока подходят под match (см. fts_query),
+    по релевантности (bm25), затем от новых к старым:
+    список (date, start_time, subject_name, фрагмент с подсветкой «…»).
+    """
+    query = f'student_id : "{student_id}" AND {{homework_text lesson_theme}} : ({match})'
+    rows = conn.execute('''
+        SELECT s.day, s.slot_id, s.subject_id,
+               -- фрагмент из ДЗ, а если совпадение только в теме — из темы
+               -- (snippet(-1) мог бы выбрать колонку student_id)
+               CASE WHEN instr(snippet(schedule_fts, 1, '«', '»', '…', 12), '«')
+                    THEN snippet(schedule_fts, 1, '«', '»', '…', 12)
+                    ELSE snippet(schedule_fts, 2, '«', '»', '…', 12) END
+        FROM schedule_fts
+        JOIN schedule s ON s.rowid = schedule_fts.rowid
+        WHERE schedule_fts MATCH ?
+        ORDER BY bm25(schedule_fts, 0.0, 1.0, 2.0), s.day DESC
+        LIMIT ? OFFSET ?
+    ''', (query, limit, offset)).fetchall()
+    results = []
+    for day, slot_id, subject_id, fragment in rows:
+        start_time = (slots.decode(conn, slot_id) or ('', ''))[0]
+        results.append((day_str(day), start_time, subjects.decode(conn, subject_id) or '', fragment))
+    return results
+
+
+# --- Синхронные функции (своё подключение на вызов) --------------------------
+
+@timed('db_seconds')
+def delete_user_data(telegram_user_id: int):
+    """
+    Удаляет данные пользователя (зашифрованный токен и привязку к ученику) из базы данных.
+    """
+    conn = get_db_connection()
+    sql_delete_user(conn, telegram_user_id)
     conn.commit()
     conn.close()
+    token_cache.invalidate(telegram_user_id)
 
+
+def prune_schedule(retention_days=SCHEDULE_RETENTION_DAYS, batch_size=SCHEDULE_PRUNE_BATCH):
+    """
+    Удаляет уроки старше retention_days дней пачками по batch_size строк
+    (каждая пачка — отдельная короткая транзакция, отбор по idx_schedule_day),
+    чтобы не держать блокировку записи надолго. Заодно удаляет расписание
+    учеников, у которых не осталось подписчиков. Возвращает число удалённых строк.
+    """
+    cutoff = (date.today() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+    total = 0
+    conn = get_db_connection()
+    try:
+        total += sql_drop_orphan_students(conn)
+        # История меняется — версии расписания затронутых учеников растут
+        conn.execute('''
+            UPDATE students SET schedule_version = schedule_version + 1
+            WHERE student_id IN (SELECT DISTINCT student_id FROM schedule WHERE day < ?)
+        ''', (day_number(cutoff),))
+        conn.commit()
+        while True:
+            cur = conn.execute('''
+                DELETE FROM schedule WHERE rowid IN (
+                    SELECT rowid FROM schedule WHERE day < ? LIMIT ?
+                )
+            ''', (day_number(cutoff), batch_size))
+            conn.commit()
+            total += cur.rowcount
+            if cur.rowcount < batch_size:
+                break
+            time.sleep(0.01)  # даём пройти другим писателям
+    finally:
+        conn.close()
+    if total:
+        inc('schedule_pruned_total', total)
+        logger.info("Удалено уроков старше %s: %s", cutoff, total)
+    return total
+
+def purge_dead_users(after=TOKEN_PURGE_AFTER, batch_size=TOKEN_PURGE_BATCH):
+    """
+    Удаляет пользователей, чей токен мёртв (needs_relogin) дольше after секунд
+    и кто так и не вошёл заново, а также строки users без токена — вместе
+    с привязкой и расписанием учеников, у которых не осталось подписчиков.
+    Пачками по batch_size пользователей, каждая — отдельная короткая
+    транзакция. Возвращает (удалено пользователей, удалено уроков).
+    """
+    dead_before = int(time.time()) - after
+    users = lessons = 0
+    conn = get_db_connection()
+    try:
+        while True:
+            ids = sql_select_dead_users(conn, dead_before, batch_size)
+            if not ids:
+                break
+            lessons += sql_purge_users(conn, ids)
+            conn.commit()
+            users += len(ids)
+            for tg_id in ids:
+                token_cache.invalidate(tg_id)
+            if len(ids) < batch_size:
+                break
+            time.sleep(0.01)  # даём пройти другим писателям
+    finally:
+        conn.close()
+    if users:
+        inc('users_purged_total', users)
+        inc('schedule_pruned_total', lessons)
+        logger.info("Удалено пользователей с мёртвым токеном: %s (уроков: %s)", users, lessons)
+    return users, lessons
@@ -0,0 +1,169 @@
+# bot/digest.py
+
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+
+from telegram.error import Forbidden, RetryAfter
+
+from config.settings import DIGEST_RATE
+from .cache import TTLCache
+from .database import (
+    day_number,
+    sql_select_day,
+    sql_select_schedule_version,
+    sql_select_digest_students,
+    sql_select_due_digests,
+    sql_mark_digest_sent,
+    sql_set_digest,
+)
+from .metrics import inc, observe
+from .repository import repository
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS_RU = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+
+# Готовые тексты сводок: (student_id, YYYY-MM-DD) -> (версия расписания, текст или None).
+# Подписчики одного ученика получают один и тот же текст.
+_rendered = TTLCache(100000, 24 * 3600, name='digest')
+
+# Отметки об отправке пишем пачками — меньше записей в БД во время рассылки
+MARK_BATCH = 50
+# Рендерим по RENDER_BATCH учеников за один запрос к потоку БД, чтобы
+# между ними успевали выполняться запросы хендлеров
+RENDER_BATCH = 20
+MAX_TEXT = 4096
+
+
+def parse_time(text: str):
+    """
+    'ЧЧ:ММ' -> минуты от полуночи или None, если формат неверный.
+    """
+    try:
+        t = datetime.strptime(text.strip(), '%H:%M')
+    except ValueError:
+        return None
+    return t.hour * 60 + t.minute
+
+
+def format_time(minute: int) -> str:
+    return f'{minute // 60:02d}:{minute % 60:02d}'
+
+
+def render_digest(day: date, lessons):
+    """
+    Текст сводки на день по строкам sql_select_day или None, если уроков нет.
+    """
+    if not lessons:
+        return None
+    lines = [f"Расписание на {day.strftime('%d.%m.%Y')} ({WEEKDAYS_RU[day.weekday()]}):"]
+    for _, subject, start, end, homework, room, theme in lessons:
+        lines.append('')
+        lines.append(f"⏰ {start or '--:--'}-{end or '--:--'} {subject or '---'}"
+                     + (f", каб. {room}" if room else ''))
+        if theme:
+            lines.append(f"📖 {theme}")
+        if homework and homework.strip():
+            lines.append(f"📝 {homework.strip()}")
+    text = '\n'.join(lines)
+    if len(text) > MAX_TEXT:
+        text = text[:MAX_TEXT - 1] + '…'
+    return text
+
+
+def _render_students(conn, student_ids, day: date):
+    """
+    Выполняется в потоке репозитория: рендерит сводки учеников student_ids
+    на day, пропуская тех, у кого готовый текст актуален (версия расписания
+    не менялась). Возвращает число отрендеренных.
+    """
+    date_str = day.isoformat()
+    rendered = 0
+    for student_id in student_ids:
+        version = sql_select_schedule_version(conn, student_id)
+        cached = _rendered.get((student_id, date_str))
+        if cached is not None and cached[0] == version:
+            continue
+        _rendered.set((student_id, date_str), (version, render_digest(day, sql_select_day(conn, student_id, date_str))))
+        rendered += 1
+    return rendered
+
+
+async def _render(student_ids, day: date):
+    """
+    _render_students пачками по RENDER_BATCH — отдельными запросами к очереди репозитория.
+    """
+    rendered = 0
+    for i in range(0, len(student_ids), RENDER_BATCH):
+        rendered += await repository.read(_render_students, student_ids[i:i + RENDER_BATCH], day)
+    return rendered
+
+
+async def prerender_digests(context=None):
+    """
+    Задача JobQueue (раз в день до первых сводок): заранее готовит тексты
+    на сегодня для всех учеников с подписчиками сводки.
+    """
+    start = time.perf_counter()
+    student_ids = await repository.read(sql_select_digest_students)
+    rendered = await _render(student_ids, date.today())
+    observe('digest_render_seconds', time.perf_counter() - start)
+    logger.info("Сводки подготовлены: %s учеников, перерисовано %s", len(student_ids), rendered)
+
+
+async def send_due_digests(context):
+    """
+    Задача JobQueue (раз в минуту): рассылает сводки тем, у кого наступило
+    время, с темпом DIGEST_RATE сообщений в секунду. Тексты берутся из
+    заранее подготовленных (перерисовываются только изменившиеся).
+    Пустые дни (выходные, каникулы) отмечаются без отправки.
+    """
+    now = datetime.now()
+    today = now.date()
+    day = day_number(today)
+    due = await repository.read(sql_select_due_digests, now.hour * 60 + now.minute, day)
+    if not due:
+        return
+
+    await _render(sorted({sid for _, sid in due}), today)
+    date_str = today.isoformat()
+    interval = 1 / DIGEST_RATE
+    sent = []
+    for tg_id, student_id in due:
+        cached = _rendered.get((student_id, date_str))
+        text = cached[1] if cached else None
+        if text is not None:
+            await _send(context.bot, tg_id, text)
+            await asyncio.sleep(interval)
+        else:
+            inc('digest_total', status='empty')
+        sent.append(tg_id)
+        if len(sent) >= MARK_BATCH:
+            await repository.write(sql_mark_digest_sent, sent, day)
+            sent = []
+    if sent:
+        await repository.write(sql_mark_digest_sent, sent, day)
+
+
+async def _send(bot, tg_id, text):
+    for attempt in range(2):
+        try:
+            await bot.send_message(chat_id=tg_id, text=text)
+            inc('digest_total', status='sent')
+            return
+        except RetryAfter as e:
+            # Упёрлись в лимит Bot API — ждём, сколько просят, и повторяем один раз
+            inc('digest_total', status='retry')
+            await asyncio.sleep(e.retry_after)
+        except Forbidden:
+            # Пользователь заблокировал бота — сводку выключаем
+            await repository.write(sql_set_digest, tg_id, None)
+            inc('digest_total', status='blocked')
+            return
+        except Exception as e:
+            logger.warning("Не удалось отправить сводку user_id=%s: %s", tg_id, e)
+            inc('digest_total', status='error')
+            return
+    inc('digest_total', status='error')
@@ -0,0 +1,19 @@
+# bot/executor.py
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from config.settings import BLOCKING_POOL_SIZE
+
+# Ограниченный пул потоков для блокирующих вызовов из хендлеров:
+# sqlite3 и расшифровка Fernet не должны выполняться в самом event loop.
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix='blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Выполняет func(*args, **kwargs) в пуле и ждёт результат, не блокируя loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
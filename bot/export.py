@@ -0,0 +1,157 @@
+# bot/export.py
+
+import csv
+import hashlib
+import os
+import tempfile
+from datetime import datetime, timezone
+
+from config.settings import EXPORT_CACHE_SIZE
+from .cache import TTLCache
+from .database import get_db_connection, sql_iter_schedule, sql_select_schedule_version
+
+# (student_id, формат, версия расписания) -> file_id документа в Telegram:
+# пока расписание не изменилось, повторный /export ничего не генерирует,
+# а подписчики одного ученика получают один и тот же документ
+export_cache = TTLCache(EXPORT_CACHE_SIZE, 30 * 24 * 3600, name='export')
+
+# Время уроков МЭШ — московское (UTC+3, без перехода на летнее время)
+TZID = 'Europe/Moscow'
+VTIMEZONE = (
+    'BEGIN:VTIMEZONE',
+    f'TZID:{TZID}',
+    'BEGIN:STANDARD',
+    'DTSTART:19700101T000000',
+    'TZOFFSETFROM:+0300',
+    'TZOFFSETTO:+0300',
+    'TZNAME:MSK',
+    'END:STANDARD',
+    'END:VTIMEZONE',
+)
+
+CSV_HEADER = ('date', 'start_time', 'end_time', 'subject', 'room', 'theme', 'homework')
+
+
+def _ics_escape(text) -> str:
+    return (str(text or '')
+            .replace('\\', '\\\\')
+            .replace(';', '\\;')
+            .replace(',', '\\,')
+            .replace('\r\n', '\\n')
+            .replace('\n', '\\n'))
+
+
+def _ics_fold(line: str) -> str:
+    """
+    Перенос длинных строк по RFC 5545: не больше 75 октетов, продолжение с пробела.
+    """
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return line + '\r\n'
+    parts = []
+    limit = 75
+    while raw:
+        cut = min(limit, len(raw))
+        # не режем многобайтовый символ UTF-8 посередине
+        while cut < len(raw) and (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode('utf-8'))
+        raw = raw[cut:]
+        limit = 74  # с учётом ведущего пробела
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _event_uid(student_id: int, lesson_id, day: str) -> str:
+    # Хэш, а не сами числа: внутренний student_id наружу не отдаём (как ETag в bot.feed)
+    digest = hashlib.sha256(f'{student_id}:{lesson_id}:{day}'.encode()).hexdigest()
+    return f'{digest[:32]}@meshinfo'
+
+
+def ics_lines(rows, student_id: int, stamp: datetime = None):
+    """
+    Генератор строк iCalendar по строкам sql_iter_schedule — по одному VEVENT на урок.
+    """
+    stamp = (stamp or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    yield _ics_fold('BEGIN:VCALENDAR')
+    yield _ics_fold('VERSION:2.0')
+    yield _ics_fold('PRODID:-//MeshInfo//Schedule//RU')
+    yield _ics_fold('CALSCALE:GREGORIAN')
+    yield _ics_fold('X-WR-CALNAME:Расписание МЭШ')
+    for line in VTIMEZONE:
+        yield _ics_fold(line)
+
+    for date_str, lesson_id, subject, start, end, homework, room, theme in rows:
+        if not date_str:
+            continue  # без даты событие в календаре не поставить (DTSTART обязателен)
+        day = date_str.replace('-', '')
+        description = []
+        if theme:
+            description.append(f'Тема: {theme}')
+        if homework:
+            description.append(f'ДЗ: {homework}')
+
+        yield _ics_fold('BEGIN:VEVENT')
+        yield _ics_fold(f'UID:{_event_uid(student_id, lesson_id, day)}')
+        yield _ics_fold(f'DTSTAMP:{stamp}')
+        if start:
+            yield _ics_fold(f'DTSTART;TZID={TZID}:{day}T{start.replace(":", "")}00')
+            if end:
+                yield _ics_fold(f'DTEND;TZID={TZID}:{day}T{end.replace(":", "")}00')
+        else:
+            yield _ics_fold(f'DTSTART;VALUE=DATE:{day}')
+        yield _ics_fold(f'SUMMARY:{_ics_escape(subject)}')
+        if room:
+            yield _ics_fold(f'LOCATION:{_ics_escape(room)}')
+        if description:
+            yield _ics_fold(f'DESCRIPTION:{_ics_escape(chr(10).join(description))}')
+        yield _ics_fold('END:VEVENT')
+
+    yield _ics_fold('END:VCALENDAR')
+
+
+def write_csv(rows, f):
+    writer = csv.writer(f)
+    writer.writerow(CSV_HEADER)
+    for date_str, _, subject, start, end, homework, room, theme in rows:
+        writer.writerow((date_str, start, end, subject, room, theme, homework or ''))
+
+
+def build_export(student_id: int, fmt: str = 'ics'):
+    """
+    Пишет всё сохранённое расписание ученика во временный файл
+    (.ics или .csv), перебирая строки курсором — история целиком в памяти
+    не собирается. Возвращает (путь к файлу, версия расписания); файл
+    удаляет вызывающий код. Блокирующая функция — вызывать через run_blocking.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN')  # версия и строки — из одного снимка БД
+        version = sql_select_schedule_version(conn, student_id)
+        rows = sql_iter_schedule(conn, student_id)
+        fd, path = tempfile.mkstemp(prefix='schedule-', suffix=f'.{fmt}')
+        # newline='' — переводы строк ICS (\r\n) и CSV пишутся как есть
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            if fmt == 'csv':
+                write_csv(rows, f)
+            else:
+                f.writelines(ics_lines(rows, student_id))
+    finally:
+        conn.close()
+    return path, version
+
+
+def render_ics(student_id: int):
+    """
+    ICS-лента ученика целиком в памяти: (версия расписания, тело в байтах).
+    DTSTAMP фиксирован для версии, так что одинаковая версия даёт одинаковые байты
+    (нужно для сильного ETag). Блокирующая функция.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN')
+        version = sql_select_schedule_version(conn, student_id)
+        stamp = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        body = ''.join(ics_lines(sql_iter_schedule(conn, student_id), student_id, stamp)).encode('utf-8')
+    finally:
+        conn.close()
+    return version, body
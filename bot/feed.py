@@ -0,0 +1,125 @@
+# bot/feed.py
+
+import hashlib
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config.settings import FEED_VERSION_TTL, FEED_CACHE_SIZE
+from .cache import TTLCache, feed_user_cache
+from .database import get_db_connection, sql_select_feed_user, sql_select_schedule_version
+from .export import render_ics
+from .metrics import inc
+
+logger = logging.getLogger(__name__)
+
+_FEED_PATH_RE = re.compile(r'^/feed/([A-Za-z0-9_-]{16,64})\.ics$')
+
+# Календарные клиенты опрашивают ленту каждые ~15 минут. Чтобы не ходить в
+# SQLite на каждый запрос, токен -> student_id (bot.cache.feed_user_cache) и
+# student_id -> версия расписания держим в памяти FEED_VERSION_TTL секунд;
+# готовые тела лент — по версии (у подписчиков одного ученика лента общая).
+_versions = TTLCache(FEED_CACHE_SIZE * 5, FEED_VERSION_TTL, name='feed_version')
+_bodies = TTLCache(FEED_CACHE_SIZE, 24 * 3600, name='feed_body')
+
+
+def etag(feed_token: str, student_id: int, version: int) -> str:
+    # Хэш, а не сами числа: внутренний student_id наружу не отдаём
+    digest = hashlib.sha256(f'{feed_token}:{student_id}:{version}'.encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def _lookup(feed_token: str):
+    """
+    (student_id, версия расписания) по токену ленты или (None, None).
+    """
+    student_id = feed_user_cache.get(feed_token)
+    version = _versions.get(student_id) if student_id is not None else None
+    if student_id is not None and version is not None:
+        return student_id, version
+
+    conn = get_db_connection()
+    try:
+        student_id = sql_select_feed_user(conn, feed_token)
+        if student_id is None:
+            return None, None
+        version = sql_select_schedule_version(conn, student_id)
+    finally:
+        conn.close()
+    feed_user_cache.set(feed_token, student_id)
+    _versions.set(student_id, version)
+    return student_id, version
+
+
+def _matches(if_none_match: str, tag: str) -> bool:
+    # Слабое сравнение (RFC 9110): для If-None-Match префикс W/ игнорируется
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == tag:
+            return True
+    return False
+
+
+class _FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._serve(with_body=True)
+
+    def do_HEAD(self):
+        self._serve(with_body=False)
+
+    def _serve(self, with_body):
+        match = _FEED_PATH_RE.match(self.path.split('?', 1)[0])
+        feed_token = match.group(1) if match else None
+        student_id, version = _lookup(feed_token) if match else (None, None)
+        if student_id is None:
+            inc('feed_requests_total', status='404')
+            self.send_error(404)
+            return
+
+        tag = etag(feed_token, student_id, version)
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and _matches(if_none_match, tag):
+            inc('feed_requests_total', status='304')
+            self.send_response(304)
+            self.send_header('ETag', tag)
+            self.send_header('Cache-Control', 'private, max-age=900')
+            self.end_headers()
+            return
+
+        cached = _bodies.get(student_id)
+        if cached is not None and cached[0] == version:
+            body = cached[1]
+        else:
+            version, body = render_ics(student_id)
+            _bodies.set(student_id, (version, body))
+            _versions.set(student_id, version)
+            tag = etag(feed_token, student_id, version)
+
+        inc('feed_requests_total', status='200')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', tag)
+        self.send_header('Cache-Control', 'private, max-age=900')
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_feed_server(host, port):
+    """
+    Поднимает HTTP-сервер ICS-лент (/feed/<токен>.ics) в фоновом потоке (daemon).
+    Возвращает сервер (для shutdown) или None, если port не задан.
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _FeedHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='feed-http', daemon=True)
+    thread.start()
+    logger.info("ICS-ленты доступны на http://%s:%s/feed/<токен>.ics", host, port)
+    return server
@@ -1,8 +1,8 @@
 # bot/handlers.py
 
 import logging
-import re
-from datetime import datetime, date, timedelta
+import os
+from datetime import datetime
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -10,6 +10,7 @@ from telegram import (
     ReplyKeyboardRemove,
 )
 from telegram.ext import (
+    TypeHandler,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
@@ -21,20 +22,35 @@ from telegram.ext import (
 from .auth import (
     is_user_logged_in,
     get_api_client,
-    save_token_db,
-    load_token_db,
-    encrypt_token,
-    decrypt_token,
+    get_token_async,
+    save_token_async,
+    resolve_identity,
+    token_bundle,
+    new_api,
 )
-from .database import (
-    get_db_connection,
-    # init_db, init_schedule_db, clear_user_schedule, save_events_in_db,
-    delete_user_data,
+from .repository import repository
+from .router import CallbackRouter, callback_data
+from .sync import start_first_sync, wait_first_sync
+from .horizon import current_week_range
+from .database import fts_query, sql_set_digest, sql_select_digest
+from .export import build_export, export_cache
+from .lessons import Lesson
+from config.settings import (
+    SEARCH_PAGE_SIZE,
+    FEED_BASE_URL,
+    LOGIN_SESSION_TTL,
+    DIGEST_DEFAULT_TIME,
+    DIGEST_PRERENDER_TIME,
+    HORIZON_FAR_DAYS,
+    SCHEDULE_RETENTION_DAYS,
 )
-from .utils import generate_calendar_keyboard, compute_21days
-from octodiary.apis import AsyncMobileAPI
-from octodiary.urls import Systems
-from octodiary.types.enter_sms_code import EnterSmsCode
+from .utils import generate_calendar_keyboard, generate_lessons_keyboard, compute_21days
+from .metrics import timed, inc
+from .logs import user_id_var, request_id_var, SAMPLED
+from .executor import run_blocking
+from .sessions import LoginSession, login_sessions, close_login_client
+from .digest import parse_time, format_time, prerender_digests, send_due_digests
+from .admin import stats, profile
 
 logger = logging.getLogger(__name__)
 
@@ -52,18 +68,88 @@ def setup_handlers(application):
             USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_username)],
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_password)],
             SMS_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_sms_code)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, login_timeout)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        # Брошенный на полпути вход завершается сам (нужен JobQueue)
+        conversation_timeout=LOGIN_SESSION_TTL,
     )
 
+    # Группа -1 выполняется раньше всех: привязываем user_id/update_id к логам апдейта
+    application.add_handler(TypeHandler(Update, bind_log_context), group=-1)
+
     application.add_handler(CommandHandler('start', start))
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('schedule', schedule))
-
-    # Обработчик всех колбэков (callback_data)
+    application.add_handler(CommandHandler('search', search))
+    application.add_handler(CommandHandler('export', export))
+    application.add_handler(CommandHandler('feed', feed))
+    application.add_handler(CommandHandler('digest', digest))
+    # Служебные команды: отвечают только ADMIN_IDS, в /start не перечислены
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('profile', profile))
+
+    # Обработчик всех колбэков (callback_data) — через router
     application.add_handler(CallbackQueryHandler(handle_callback_query))
 
+    # Раз в минуту закрываем просроченные сессии входа (HTTP-клиенты МЭШ)
+    if application.job_queue:
+        application.job_queue.run_repeating(login_sessions.expire, interval=60, first=60)
+        # Утренние сводки: тексты готовятся заранее, рассылка проверяется раз в минуту.
+        # Время — местное время сервера (как у задач APScheduler в main.py)
+        local_tz = datetime.now().astimezone().tzinfo
+        prerender_at = datetime.strptime(DIGEST_PRERENDER_TIME, '%H:%M').time().replace(tzinfo=local_tz)
+        application.job_queue.run_daily(prerender_digests, time=prerender_at)
+        application.job_queue.run_repeating(send_due_digests, interval=60, first=30)
+
+
+# Маршруты инлайн-кнопок (грамматика callback_data — в bot.router)
+router = CallbackRouter()
+
+
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Проставляет идентификаторы корреляции для всех логов, написанных
+    при обработке этого апдейта (см. bot.logs).
+    """
+    user = update.effective_user
+    user_id_var.set(user.id if user else None)
+    request_id_var.set(update.update_id)
+
+
+# Картинки меню: с диска читаются один раз (в пуле потоков), а после первой
+# отправки используется file_id, который вернул Telegram, — файл больше не загружается.
+PHOTO_DIR = "bot/photo"
+_photo_bytes = {}
+_photo_file_ids = {}
 
+
+def _read_photo(name):
+    with open(f"{PHOTO_DIR}/{name}", "rb") as f:
+        return f.read()
+
+
+async def send_menu_photo(context, chat_id, name, caption, reply_markup):
+    """
+    Отправляет картинку меню name (1.jpg / 2.jpg / 3.jpg) с подписью и клавиатурой.
+    """
+    photo = _photo_file_ids.get(name)
+    if photo is None:
+        photo = _photo_bytes.get(name)
+        if photo is None:
+            photo = _photo_bytes[name] = await run_blocking(_read_photo, name)
+    message = await context.bot.send_photo(
+        chat_id=chat_id,
+        photo=photo,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    if name not in _photo_file_ids and message.photo:
+        _photo_file_ids[name] = message.photo[-1].file_id
+    return message
+
+
+@timed('handler_seconds')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /start — проверяем, авторизован ли пользователь.
@@ -76,8 +162,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await is_user_logged_in(telegram_user_id):
         # Если уже есть валидный токен
         keyboard = [
-            [InlineKeyboardButton("Посмотреть расписание", callback_data='view_schedule')],
-            [InlineKeyboardButton("Удалить мои данные из бота", callback_data='delete_my_data')],
+            [InlineKeyboardButton("Посмотреть расписание", callback_data=callback_data('vs'))],
+            [InlineKeyboardButton("Удалить мои данные из бота", callback_data=callback_data('del'))],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -92,6 +178,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Основные команды:\n"
             "  /login - Авторизация (логин/пароль + SMS)\n"
             "  /schedule - Просмотр расписания (после авторизации)\n"
+            "  /search <слова> - Поиск по домашним заданиям и темам уроков\n"
+            "  /export [ics|csv] - Выгрузить расписание файлом (для календаря телефона)\n"
+            "  /feed - Ссылка для подписки на расписание в календаре\n"
+            "  /digest [ЧЧ:ММ|off] - Утренняя сводка уроков и ДЗ на день\n"
             "  /cancel - Отмена любой операции\n"
             "  /start - Повторное приветствие или выбор действий\n\n"
             "Чтобы начать, введите /login."
@@ -99,6 +189,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(welcome_text)
 
 
+@timed('handler_seconds')
 async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Начало процесса логина (ConversationHandler).
@@ -114,123 +205,104 @@ async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return USERNAME
 
 
+@timed('handler_seconds')
 async def get_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['username'] = update.message.text
+    await login_sessions.put(update.effective_user.id, LoginSession(username=update.message.text))
     await update.message.reply_text('Теперь введите ваш пароль:')
     return PASSWORD
 
 
-async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['password'] = update.message.text
-    await update.message.reply_text('Пожалуйста, подождите, идёт авторизация...')
+async def _login_expired(update: Update):
+    await update.message.reply_text('Время входа истекло. Начните заново: /login')
+    return ConversationHandler.END
+
 
+@timed('handler_seconds')
+async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_user_id = update.effective_user.id
-    username = context.user_data['username']
-    password = context.user_data['password']
+    session = login_sessions.get(telegram_user_id)
+    if session is None:
+        return await _login_expired(update)
+
+    password = update.message.text
+    # Пароль не храним и не оставляем в истории чата
+    try:
+        await update.message.delete()
+    except Exception as e:
+        logger.info("Не удалось удалить сообщение с паролем: %s", e)
+    await context.bot.send_message(update.effective_chat.id, 'Пожалуйста, подождите, идёт авторизация...')
+
+    username, session.username = session.username, None
     api, sms_code_obj = await get_api_client(telegram_user_id, username, password)
+    del password
 
     if api is None:
-        await update.message.reply_text('Ошибка авторизации. Попробуйте снова /login.')
+        await login_sessions.discard(telegram_user_id, outcome='failed')
+        await context.bot.send_message(update.effective_chat.id, 'Ошибка авторизации. Попробуйте снова /login.')
         return ConversationHandler.END
 
-    context.user_data['api'] = api
-    context.user_data['sms_code_obj'] = sms_code_obj
-
     if sms_code_obj:
-        await update.message.reply_text('Введите код из SMS/Приложения Госуслуг:')
+        session.api = api
+        session.sms_code_obj = sms_code_obj
+        await context.bot.send_message(update.effective_chat.id, 'Введите код из SMS/Приложения Госуслуг:')
         return SMS_CODE
     else:
-        await update.message.reply_text(
+        login_sessions.pop(telegram_user_id)
+        await close_login_client(api)
+        context.user_data['api'] = api
+        await context.bot.send_message(
+            update.effective_chat.id,
             'Авторизация успешна! Используйте /schedule для просмотра расписания.'
         )
         return ConversationHandler.END
 
-async def sync_user_schedule(tg_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Синхронизирует расписание одного пользователя (tg_id) из МЭШ в локальную БД.
-    Смысл - вызвать, когда пользователь впервые залогинился.
-    """
-    from .database import clear_user_schedule, save_events_in_db
-    from bot.auth import decrypt_token
-    from octodiary.apis import AsyncMobileAPI
-    from octodiary.urls import Systems
-
-    logger = logging.getLogger(__name__)
-
-    # 1) Берём зашифрованный токен из БД
-    enc_token = load_token_db(tg_id)
-    if not enc_token:
-        logger.warning(f"У пользователя {tg_id} нет токена, пропускаем sync_user_schedule.")
-        return
-
-    try:
-        token_data = decrypt_token(enc_token)
-        mesh_api = AsyncMobileAPI(system=Systems.MES)
-        mesh_api.token = token_data
-    except Exception as e:
-        logger.warning(f"Ошибка расшифровки токена при sync_user_schedule(tg_id={tg_id}): {e}")
-        return
-
-    # 2) Вызываем API MЭШ, например, на 7 дней назад и 7 дней вперёд
-    today = date.today()
-    begin_date = today - timedelta(days=7)
-    end_date = today + timedelta(days=7)
-
-    try:
-        profiles = await mesh_api.get_users_profile_info()
-        if not profiles:
-            logger.warning(f"Нет профилей у {tg_id}, не можем синхронизировать.")
-            return
-        first_profile = profiles[0]
-        fam = await mesh_api.get_family_profile(profile_id=first_profile.id)
-        if not fam.children:
-            logger.warning(f"У пользователя {tg_id} нет children, пропускаем.")
-            return
-
-        child = fam.children[0]
-        person_guid = child.contingent_guid
-        mes_role = fam.profile.type
-
-        events = await mesh_api.get_events(
-            person_id=person_guid,
-            mes_role=mes_role,
-            begin_date=begin_date,
-            end_date=end_date
-        )
-
-        # 3) Очищаем расписание, сохраняем свежее
-        clear_user_schedule(tg_id)
-        save_events_in_db(tg_id, events)
-
-        logger.info(f"Синхронизация расписания user_id={tg_id} завершена успешно.")
-    except Exception as e:
-        logger.warning(f"Ошибка при синхронизации user_id={tg_id}: {e}")
-
+@timed('handler_seconds')
 async def get_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sms_code = update.message.text
     telegram_user_id = update.effective_user.id
-    api = context.user_data['api']
-    sms_code_obj = context.user_data['sms_code_obj']
+    session = login_sessions.get(telegram_user_id)
+    if session is None or session.sms_code_obj is None:
+        return await _login_expired(update)
+    api = session.api
 
     try:
-        api.token = await sms_code_obj.async_enter_code(sms_code)
-        encrypted_token = encrypt_token(api.token)
-        save_token_db(telegram_user_id, encrypted_token)
+        api.token = await session.sms_code_obj.async_enter_code(sms_code)
+        # Вместе с токеном сохраняем refresh_token — его продлевает renew_tokens
+        await save_token_async(telegram_user_id, token_bundle(api))
     except Exception as e:
         logger.error("Ошибка при вводе SMS-кода для пользователя %s: %s", telegram_user_id, e)
+        await login_sessions.discard(telegram_user_id, outcome='failed')
         await update.message.reply_text(
             'Неверный SMS-код или истекло время. Попробуйте снова с помощью команды /login.'
         )
         return ConversationHandler.END
 
+    # Вход завершён: закрываем HTTP-сессию авторизации, клиент с токеном оставляем
+    login_sessions.pop(telegram_user_id)
+    await close_login_client(api)
+    context.user_data['api'] = api
+
     await update.message.reply_text(
         'Авторизация успешна! Используйте /schedule для просмотра расписания.'
     )
 
-    await sync_user_schedule(telegram_user_id, context)
+    # Расписание подтягивается в фоне: текущая неделя, затем весь горизонт
+    start_first_sync(context.application, telegram_user_id)
     return ConversationHandler.END
 
 
+async def login_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Диалог /login простоял conversation_timeout: закрываем сессию входа.
+    """
+    await login_sessions.discard(update.effective_user.id, outcome='expired')
+    await context.bot.send_message(
+        update.effective_chat.id,
+        'Время входа истекло. Начните заново: /login'
+    )
+
+
+@timed('handler_seconds')
 async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /schedule — показываем календарь (21 день, offset=7 => текущая неделя),
@@ -240,26 +312,24 @@ async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     api = context.user_data.get('api')
 
     if not api:
-        encrypted_token = load_token_db(telegram_user_id)
-        if encrypted_token:
-            try:
-                token_data = decrypt_token(encrypted_token)
-                api_local = AsyncMobileAPI(system=Systems.MES)
-                api_local.token = token_data
-                context.user_data['api'] = api_local
-            except Exception as e:
-                logger.error("Ошибка при дешифровании токена: %s", e)
-                await update.effective_message.reply_text(
-                    'Сессия истекла. Пожалуйста, /login снова.'
-                )
-                return
+        try:
+            token_data = await get_token_async(telegram_user_id)
+        except Exception as e:
+            logger.error("Ошибка при дешифровании токена: %s", e)
+            await update.effective_message.reply_text(
+                'Сессия истекла. Пожалуйста, /login снова.'
+            )
+            return
+        if token_data:
+            context.user_data['api'] = new_api(token_data)
         else:
             await update.effective_message.reply_text('Пожалуйста, выполните /login.')
             return
 
     # Предупреждение
     await update.effective_message.reply_text(
-        "Внимание: храним расписание только на 3 недели (прошлая, текущая, следующая)."
+        f"Внимание: расписание загружается на {HORIZON_FAR_DAYS} дн. вперёд, "
+        f"прошедшие уроки хранятся {SCHEDULE_RETENTION_DAYS} дн."
     )
 
     # Формируем календарь
@@ -267,82 +337,64 @@ async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Удаляем предыдущее сообщение, отправляем фото 1.jpg
     await update.effective_message.delete()
-    with open("bot/photo/1.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=f,
-            caption="Выберите дату",
-            reply_markup=markup
-        )
+    await send_menu_photo(
+        context,
+        chat_id=update.effective_chat.id,
+        name="1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
 
 
+@timed('handler_seconds')
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = query.data
-    logger.info("callback_data: %s", data)
+    logger.info("callback_data: %s", update.callback_query.data, extra=SAMPLED)
+    await router.dispatch(update, context)
 
-    match_day = re.match(r'^cal21_day_(\d+)$', data)
-    if match_day:
-        idx = int(match_day.group(1))
-        await process_calendar_day(query, context, idx)
-        return
 
-    match_prev = re.match(r'^cal21_prev_(\d+)$', data)
-    if match_prev:
-        old_offset = int(match_prev.group(1))
-        new_offset = max(0, old_offset - 5)
-        markup = generate_calendar_keyboard(offset=new_offset)
+async def send_calendar(query, context, offset: int):
+    markup = generate_calendar_keyboard(offset=offset)
 
-        await query.message.delete()
-        with open("bot/photo/1.jpg", "rb") as f:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=f,
-                caption="Выберите дату",
-                reply_markup=markup
-            )
-        return
+    await query.message.delete()
+    await send_menu_photo(
+        context,
+        chat_id=query.message.chat_id,
+        name="1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
 
-    match_next = re.match(r'^cal21_next_(\d+)$', data)
-    if match_next:
-        old_offset = int(match_next.group(1))
-        new_offset = old_offset + 5
-        if new_offset >= 21:
-            new_offset = 16
-        markup = generate_calendar_keyboard(offset=new_offset)
 
-        await query.message.delete()
-        with open("bot/photo/1.jpg", "rb") as f:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=f,
-                caption="Выберите дату",
-                reply_markup=markup
-            )
-        return
+async def calendar_day(update: Update, context: ContextTypes.DEFAULT_TYPE, day_index: int):
+    await process_calendar_day(update.callback_query, context, day_index)
 
-    if data == 'back_to_schedule':
-        await back_to_schedule(update, context)
-    elif data == 'back_to_lessons':
-        await back_to_lessons(update, context)
-    elif data == 'delete_my_data':
-        await delete_my_data(update, context)
-    elif data == 'view_schedule':
-        await schedule(update, context)
-    elif data.startswith('lesson_'):
-        await lesson_detail(update, context)
-    else:
-        logger.warning("Неизвестный callback_data: %s", data)
-        await query.answer("Неизвестный ввод")
+
+@timed('handler_seconds')
+async def calendar_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, old_offset: int):
+    await send_calendar(update.callback_query, context, max(0, old_offset - 5))
+
+
+@timed('handler_seconds')
+async def calendar_next(update: Update, context: ContextTypes.DEFAULT_TYPE, old_offset: int):
+    new_offset = old_offset + 5
+    if new_offset >= 21:
+        new_offset = 16
+    await send_calendar(update.callback_query, context, new_offset)
 
 
+async def ignore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Некликабельные ячейки календаря (дни недели, пустые кнопки)
+    await update.callback_query.answer()
+
+
+@timed('handler_seconds')
 async def process_calendar_day(query, context, day_index: int):
     """
     Когда пользователь выбрал дату (cal21_day_X):
       - Пытаемся получить расписание из МЭШ.
       - Если ошибка => fallback из локальной БД (schedule).
       - Независимо от fallback или нет, прикрепляем фото 2.jpg: "Выберите урок на <дата>".
-      - Сохраняем ДЗ в lessons (fallback) через homework_text.
+      - В обоих случаях в lessons лежат bot.lessons.Lesson (с ДЗ и ЦДЗ).
     """
     await query.answer()
 
@@ -370,15 +422,9 @@ async def process_calendar_day(query, context, day_index: int):
         )
         return
 
-    # Попробуем MЭШ
+    # Попробуем MЭШ (ученик и роль — из таблицы identity, без лишних запросов)
     try:
-        profiles = await api.get_users_profile_info()
-        profile_id = profiles[0].id
-
-        family = await api.get_family_profile(profile_id=profile_id)
-        mes_role = family.profile.type
-        child = family.children[0]
-        person_guid = child.contingent_guid
+        _, person_guid, mes_role = await resolve_identity(telegram_user_id, api)
 
         events = await api.get_events(
             person_id=person_guid,
@@ -386,45 +432,20 @@ async def process_calendar_day(query, context, day_index: int):
             begin_date=chosen_date,
             end_date=chosen_date
         )
-        mesh_lessons = [
-            ev for ev in events.response
+        lessons = [
+            Lesson.from_event(ev) for ev in events.response
             if ev.subject_name and ev.start_at and ev.finish_at
         ]
-        lessons = mesh_lessons
 
     except Exception as e:
-        logger.error(f"MЭШ недоступен: {e}")
+        logger.error("MЭШ недоступен: %s", e)
         # fallback
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT lesson_id, subject_name, start_time, end_time,
-                   homework_text, room_number, lesson_theme
-            FROM schedule
-            WHERE user_id=? AND date=?
-            ORDER BY start_time
-        ''', (telegram_user_id, date_str))
-        rows = cur.fetchall()
-        conn.close()
-
-        class FakeEvent: pass
-        lessons = []
-        for (lid, subj, st, et, hw_text, r_num, l_theme) in rows:
-            fe = FakeEvent()
-
-            fe.id = lid
-            fe.subject_name = subj
-            fe.start_at = datetime.strptime(st, '%H:%M') if st else None
-            fe.finish_at = datetime.strptime(et, '%H:%M') if et else None
-            fe.homework_text = hw_text
-
-            # <-- ВАЖНО: сохраняем колонку room_number в fe.room_number
-            fe.room_number = r_num if r_num else None
-            # <-- Сохраняем lesson_theme
-            fe.lesson_theme = l_theme if l_theme else None
-
-            # при желании: fe.materials = None
-            lessons.append(fe)
+        inc('mes_fallback_total')
+        # Сразу после логина локальное расписание может ещё загружаться
+        week_begin, week_end = current_week_range()
+        await wait_first_sync(telegram_user_id, week_only=week_begin <= chosen_date <= week_end)
+        student_id = await repository.student_id(telegram_user_id)
+        lessons = await repository.load_day_lessons(student_id, date_str) if student_id else []
 
     if not lessons:
         await query.message.delete()
@@ -434,111 +455,78 @@ async def process_calendar_day(query, context, day_index: int):
         )
         return
 
-    # Формируем inline-кнопки
-    keyboard = []
-    for idx, ev in enumerate(lessons):
-        if getattr(ev, "start_at", None):
-            st_t = ev.start_at.strftime('%H:%M')
-        else:
-            st_t = "--:--"
-        if getattr(ev, "finish_at", None):
-            et_t = ev.finish_at.strftime('%H:%M')
-        else:
-            et_t = "--:--"
-        subj = ev.subject_name or '---'
-        btn_txt = f"{st_t}-{et_t} {subj}"
-        callback_data = f"lesson_{idx}"
-        keyboard.append([InlineKeyboardButton(btn_txt, callback_data=callback_data)])
-
-    keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Формируем inline-кнопки (из кэша, если такой набор уроков уже встречался)
+    reply_markup = generate_lessons_keyboard(lessons)
     context.user_data['lessons'] = lessons
+    context.user_data['lessons_markup'] = reply_markup
 
     # Удаляем старое сообщение и отправляем 2.jpg => "Выберите урок на ..."
     await query.message.delete()
-    with open("bot/photo/2.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption=f"Выберите урок на {chosen_date_str}:",
-            reply_markup=reply_markup
-        )
+    await send_menu_photo(
+        context,
+        chat_id=query.message.chat_id,
+        name="2.jpg",
+        caption=f"Выберите урок на {chosen_date_str}:",
+        reply_markup=reply_markup
+    )
 
 
-async def lesson_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed('handler_seconds')
+async def lesson_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, lesson_index: int):
     """
     Когда пользователь выбрал конкретный урок (lesson_X).
-    Показываем домашку. Если fallback => event.homework_text, иначе event.homework.descriptions.
+    Показываем домашку. Урок — bot.lessons.Lesson, из МЭШ или из локальной БД одинаково.
     """
     query = update.callback_query
     await query.answer()
-    data = query.data
 
     lessons = context.user_data.get('lessons')
-    lesson_index = int(data.split('_')[1])
-    event = lessons[lesson_index]
+    if not lessons or not 0 <= lesson_index < len(lessons):
+        # Кнопка из старого сообщения (после перезапуска бота или выбора другого дня)
+        await query.message.delete()
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text='Ошибка: список уроков не найден. Откройте /schedule заново.'
+        )
+        return
+    lesson = lessons[lesson_index]
 
     # Собираем сообщение
-    start_time = getattr(event, 'start_at', None)
-    finish_time = getattr(event, 'finish_at', None)
-    st_str = start_time.strftime('%H:%M') if start_time else 'Не указано'
-    et_str = finish_time.strftime('%H:%M') if finish_time else 'Не указано'
-    subject = getattr(event, 'subject_name', 'Не указано')
-    room = getattr(event, 'room_number', 'Не указан')
-    theme = getattr(event, 'lesson_theme', 'Не указана')
-
     message = (
-        f"⏰ {st_str}-{et_str}\n"
-        f"📚 Предмет: {subject}\n"
-        f"🚪 Кабинет: {room}\n"
-        f"📖 Тема урока: {theme}\n"
+        f"⏰ {lesson.start_time or 'Не указано'}-{lesson.end_time or 'Не указано'}\n"
+        f"📚 Предмет: {lesson.subject_name or 'Не указано'}\n"
+        f"🚪 Кабинет: {lesson.room_number or 'Не указан'}\n"
+        f"📖 Тема урока: {lesson.lesson_theme or 'Не указана'}\n"
     )
 
-    # ДЗ: если fallback => event.homework_text, иначе event.homework.descriptions
-    fallback_hw = getattr(event, 'homework_text', None)
-    if fallback_hw is not None:
-        # fallback
-        fallback_hw = fallback_hw.strip()
-        if fallback_hw:
-            message += "📝 Домашнее задание:\n" + fallback_hw + "\n"
-        else:
-            message += "📝 Домашнее задание: нет\n"
+    if lesson.homework:
+        message += "📝 Домашнее задание:\n"
+        for desc in lesson.homework:
+            message += f"- {desc}\n"
     else:
-        # normal event
-        if getattr(event, "homework", None) and event.homework.descriptions:
-            message += "📝 Домашнее задание:\n"
-            for desc in event.homework.descriptions:
-                message += f"- {desc}\n"
-        else:
-            message += "📝 Домашнее задание: нет\n"
+        message += "📝 Домашнее задание: нет\n"
 
     # ЦДЗ
-    has_cdz = False
-    if fallback_hw is None:
-        # normal event => check event.materials
-        if getattr(event, "materials", None):
-            has_cdz = True
-    # (Если fallback, materials=None => has_cdz=False, либо вы можете хранить info)
-
-    if has_cdz:
+    if lesson.materials:
         message += "💻 Учитель прикрепил ЦДЗ к ДЗ.\n"
 
     keyboard = [
-        [InlineKeyboardButton("Вернуться к урокам", callback_data='back_to_lessons')],
-        [InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')]
+        [InlineKeyboardButton("Вернуться к урокам", callback_data=callback_data('bl'))],
+        [InlineKeyboardButton("Вернуться к расписанию", callback_data=callback_data('bs'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.delete()
-    with open("bot/photo/3.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption=message,
-            reply_markup=reply_markup
-        )
+    await send_menu_photo(
+        context,
+        chat_id=query.message.chat_id,
+        name="3.jpg",
+        caption=message,
+        reply_markup=reply_markup
+    )
 
 
+@timed('handler_seconds')
 async def back_to_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Возврат к списку уроков => прикрепляем 3.jpg + "Выберите урок:"
@@ -555,29 +543,20 @@ async def back_to_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Генерируем inline-кнопки по урокам
-    keyboard = []
-    for idx, ev in enumerate(lessons):
-        st_t = ev.start_at.strftime('%H:%M') if ev.start_at else '--:--'
-        et_t = ev.finish_at.strftime('%H:%M') if ev.finish_at else '--:--'
-        subj = ev.subject_name or '---'
-        btn_txt = f"{st_t}-{et_t} {subj}"
-        callback_data = f"lesson_{idx}"
-        keyboard.append([InlineKeyboardButton(btn_txt, callback_data=callback_data)])
-
-    keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data='back_to_schedule')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Клавиатура, построенная при выборе дня
+    reply_markup = context.user_data.get('lessons_markup') or generate_lessons_keyboard(lessons)
 
     await query.message.delete()
-    with open("bot/photo/2.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption="Выберите урок:",
-            reply_markup=reply_markup
-        )
+    await send_menu_photo(
+        context,
+        chat_id=query.message.chat_id,
+        name="2.jpg",
+        caption="Выберите урок:",
+        reply_markup=reply_markup
+    )
 
 
+@timed('handler_seconds')
 async def back_to_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Возвращаемся к календарю => 1.jpg
@@ -587,15 +566,16 @@ async def back_to_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     markup = generate_calendar_keyboard(offset=7)
     await query.message.delete()
-    with open("bot/photo/1.jpg", "rb") as f:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=f,
-            caption="Выберите дату",
-            reply_markup=markup
-        )
+    await send_menu_photo(
+        context,
+        chat_id=query.message.chat_id,
+        name="1.jpg",
+        caption="Выберите дату",
+        reply_markup=markup
+    )
 
 
+@timed('handler_seconds')
 async def delete_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Удаляем зашифрованный токен из таблицы users + очищаем context
@@ -604,7 +584,7 @@ async def delete_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     telegram_user_id = update.effective_user.id
-    delete_user_data(telegram_user_id)
+    await repository.delete_user(telegram_user_id)
     context.user_data.clear()
 
     await query.message.delete()
@@ -614,12 +594,194 @@ async def delete_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@timed('handler_seconds')
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /search <слова> — ищем по ДЗ и темам уроков в сохранённом расписании
+    (включая прошлые недели). Запрос запоминаем в user_data для листания страниц.
+    """
+    match = fts_query(' '.join(context.args or ()))
+    if not match:
+        await update.message.reply_text('Использование: /search <слова>, например /search параграф 12')
+        return
+    context.user_data['search_match'] = match
+    await wait_first_sync(update.effective_user.id)
+    await send_search_page(update.message.reply_text, update.effective_user.id, match, 0)
+
+
+@timed('handler_seconds')
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    query = update.callback_query
+    await query.answer()
+    match = context.user_data.get('search_match')
+    if not match:
+        await query.edit_message_text('Поиск устарел. Повторите /search <слова>.')
+        return
+    await send_search_page(query.edit_message_text, update.effective_user.id, match, max(0, page))
+
+
+async def send_search_page(reply, telegram_user_id, match, page):
+    # На одну строку больше страницы — так узнаём, есть ли следующая
+    student_id = await repository.student_id(telegram_user_id)
+    rows = []
+    if student_id:
+        rows = await repository.search(student_id, match, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    has_next = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+
+    if not rows:
+        await reply('Ничего не найдено.' if page == 0 else 'Больше результатов нет.')
+        return
+
+    lines = []
+    for date_str, start_time, subject, fragment in rows:
+        day = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')
+        lines.append(f"📅 {day} {start_time} {subject}\n{fragment}")
+    text = f"Результаты поиска (стр. {page + 1}):\n\n" + "\n\n".join(lines)
+
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("« Назад", callback_data=callback_data('s', page - 1)))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Вперёд »", callback_data=callback_data('s', page + 1)))
+    reply_markup = InlineKeyboardMarkup([nav_row]) if nav_row else None
+    await reply(text, reply_markup=reply_markup)
+
+
+@timed('handler_seconds')
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /export [ics|csv] — всё сохранённое расписание с ДЗ одним файлом.
+    Файл генерируется только при новой версии расписания, иначе
+    повторно отправляется уже загруженный в Telegram документ (file_id).
+    """
+    telegram_user_id = update.effective_user.id
+    fmt = (context.args[0].lower() if context.args else 'ics')
+    if fmt not in ('ics', 'csv'):
+        await update.message.reply_text('Использование: /export ics или /export csv')
+        return
+
+    await wait_first_sync(telegram_user_id)
+    student_id = await repository.student_id(telegram_user_id)
+    if not student_id:
+        await update.message.reply_text('Расписание ещё не загружено. Выполните /login или попробуйте позже.')
+        return
+    version = await repository.schedule_version(student_id)
+    file_id = export_cache.get((student_id, fmt, version))
+    if file_id:
+        await update.message.reply_document(document=file_id)
+        return
+
+    path, version = await run_blocking(build_export, student_id, fmt)
+    try:
+        with open(path, 'rb') as f:
+            message = await update.message.reply_document(
+                document=f,
+                filename=f'schedule.{fmt}',
+                caption='Расписание и домашние задания' + (' (импортируйте в календарь)' if fmt == 'ics' else ''),
+            )
+    finally:
+        os.remove(path)
+    if message.document:
+        export_cache.set((student_id, fmt, version), message.document.file_id)
+
+
+@timed('handler_seconds')
+async def feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /feed — секретная ссылка на ICS-ленту для подписки из календаря
+    (обновляется сама при изменении расписания). /feed reset — выдать новую
+    ссылку, старая перестанет работать.
+    """
+    if not FEED_BASE_URL:
+        await update.message.reply_text('Подписка на календарь на этом сервере не настроена. Используйте /export.')
+        return
+
+    reset = bool(context.args) and context.args[0].lower() == 'reset'
+    feed_token = await repository.feed_token(update.effective_user.id, reset=reset)
+    if not feed_token:
+        await update.message.reply_text('Пожалуйста, выполните /login.')
+        return
+    await update.message.reply_text(
+        "Ссылка для подписки на расписание (никому её не пересылайте):\n"
+        f"{FEED_BASE_URL.rstrip('/')}/feed/{feed_token}.ics\n\n"
+        "Новая ссылка вместо этой: /feed reset",
+        disable_web_page_preview=True,
+    )
+
+
+@timed('handler_seconds')
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /digest [ЧЧ:ММ|on|off] — утренняя сводка: каждый день в указанное время
+    бот сам присылает уроки, кабинеты и ДЗ на сегодня одним сообщением.
+    Без аргументов — показать текущую настройку.
+    """
+    telegram_user_id = update.effective_user.id
+    arg = context.args[0].lower() if context.args else None
+
+    if arg is None:
+        minute = await repository.read(sql_select_digest, telegram_user_id)
+        status = f'включена, в {format_time(minute)}' if minute is not None else 'выключена'
+        await update.message.reply_text(
+            f'Утренняя сводка {status}.\n'
+            f'Включить: /digest {DIGEST_DEFAULT_TIME} (или другое время), выключить: /digest off'
+        )
+        return
+
+    if arg == 'off':
+        minute = None
+    else:
+        minute = parse_time(DIGEST_DEFAULT_TIME if arg == 'on' else arg)
+        if minute is None:
+            await update.message.reply_text('Использование: /digest 07:00 или /digest off')
+            return
+
+    now = datetime.now()
+    first_day = await repository.write(sql_set_digest, telegram_user_id, minute, now)
+    if first_day is None:
+        await update.message.reply_text('Пожалуйста, выполните /login.')
+        return
+    if minute is None:
+        await update.message.reply_text('Утренняя сводка выключена.')
+    else:
+        days_ahead = (first_day - now.date()).days
+        since = ('' if days_ahead <= 0 else ', начиная с завтра' if days_ahead == 1
+                 else f', начиная с {first_day:%d.%m}')
+        await update.message.reply_text(f'Готово: сводка на день будет приходить в {format_time(minute)}{since}.')
+
+
+@timed('handler_seconds')
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Отмена ConversationHandler (логин).
     """
+    await login_sessions.discard(update.effective_user.id)
     await update.message.reply_text(
         "Операция отменена. Введите /start для нового начала.",
         reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
+
+
+router.add('d', calendar_day, int)
+router.add('p', calendar_prev, int)
+router.add('n', calendar_next, int)
+router.add('l', lesson_detail, int)
+router.add('bl', back_to_lessons)
+router.add('bs', back_to_schedule)
+router.add('vs', schedule)
+router.add('del', delete_my_data)
+router.add('x', ignore)
+router.add('s', search_page, int)
+
+# Кнопки, отправленные до появления router (формат cal21_day_7, lesson_0, ...)
+router.legacy('cal21_day', 'd', prefix=True)
+router.legacy('cal21_prev', 'p', prefix=True)
+router.legacy('cal21_next', 'n', prefix=True)
+router.legacy('lesson', 'l', prefix=True)
+router.legacy('back_to_lessons', 'bl')
+router.legacy('back_to_schedule', 'bs')
+router.legacy('view_schedule', 'vs')
+router.legacy('delete_my_data', 'del')
+router.legacy('ignore', 'x')
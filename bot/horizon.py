@@ -0,0 +1,77 @@
+# bot/horizon.py
+
+import time
+from datetime import date, timedelta
+
+from config.settings import (
+    HORIZON_PAST_DAYS,
+    HORIZON_NEAR_DAYS,
+    HORIZON_FAR_DAYS,
+    HORIZON_FAR_REFRESH_HOURS,
+)
+
+
+def full_range(today: date = None):
+    """
+    Весь обновляемый диапазон (begin, end): от начала изменяемого прошлого
+    до дальнего горизонта. Используется при первой синхронизации после логина.
+    """
+    today = today or date.today()
+    return today - timedelta(days=HORIZON_PAST_DAYS), today + timedelta(days=HORIZON_FAR_DAYS)
+
+
+def near_range(today: date = None):
+    today = today or date.today()
+    return today - timedelta(days=HORIZON_PAST_DAYS), today + timedelta(days=HORIZON_NEAR_DAYS)
+
+
+def sweep_range(far_refreshed_at: float = None, today: date = None, now: float = None):
+    """
+    Диапазон для очередного обновления ученика в update_all_schedules:
+    (begin, end, far). Ближний горизонт — каждый раз, дальний (far=True) — если
+    с прошлого дальнего обновления (far_refreshed_at, unix time из БД) прошло
+    HORIZON_FAR_REFRESH_HOURS часов или его ещё не было.
+    """
+    now = now if now is not None else time.time()
+    far = (far_refreshed_at is None
+           or now - far_refreshed_at >= HORIZON_FAR_REFRESH_HOURS * 3600)
+    begin, end = full_range(today) if far else near_range(today)
+    return begin, end, far
+
+
+def current_week_range(today: date = None):
+    """
+    Понедельник..воскресенье текущей недели — то, что пользователь
+    откроет первым (/schedule показывает текущую неделю).
+    """
+    today = today or date.today()
+    monday = today - timedelta(days=today.weekday())
+    return monday, monday + timedelta(days=6)
+
+
+def first_sync_ranges(today: date = None):
+    """
+    Диапазоны первой синхронизации после логина: сначала текущая неделя,
+    затем остаток горизонта после неё и до неё — без повторного запроса
+    недели. Вместе покрывают full_range.
+    """
+    begin, end = full_range(today)
+    monday, sunday = current_week_range(today)
+    ranges = [(monday, sunday)]
+    if end > sunday:
+        ranges.append((sunday + timedelta(days=1), end))
+    if begin < monday:
+        ranges.append((begin, monday - timedelta(days=1)))
+    return ranges
+
+
+def covers(ranges, begin: date, end: date) -> bool:
+    """
+    True, если диапазоны ranges вместе (без пропусков) покрывают begin..end.
+    """
+    reached = begin - timedelta(days=1)
+    for first, last in sorted(ranges):
+        if first > reached + timedelta(days=1):
+            break
+        reached = max(reached, last)
+    return reached >= end
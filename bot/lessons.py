@@ -0,0 +1,94 @@
+# bot/lessons.py
+
+import json
+import zlib
+
+# Сжатая нагрузка начинается с заголовка zlib (0x78), несжатая — с '[' JSON
+_ZLIB_HEADER = 0x78
+
+
+class Lesson:
+    """
+    Урок в том виде, в каком его показывает бот (кнопки дня и карточка урока).
+    Одинаково строится из живого ответа МЭШ (from_event) и из строки schedule
+    с упакованной нагрузкой (pack_event), поэтому оба пути рендерятся одним
+    кодом. Лёгкий (__slots__) — списки уроков лежат в user_data.
+      - start_time / end_time: 'ЧЧ:ММ' или '';
+      - homework: кортеж описаний ДЗ (homework.descriptions);
+      - materials: число прикреплённых материалов (ЦДЗ).
+    """
+
+    __slots__ = ('id', 'subject_name', 'start_time', 'end_time', 'room_number',
+                 'lesson_theme', 'homework', 'materials')
+
+    def __init__(self, id, subject_name, start_time, end_time, room_number=None,
+                 lesson_theme=None, homework=(), materials=0):
+        self.id = id
+        self.subject_name = subject_name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.room_number = room_number
+        self.lesson_theme = lesson_theme
+        self.homework = homework
+        self.materials = materials
+
+    @classmethod
+    def from_event(cls, event):
+        """
+        Урок из события get_events (octodiary).
+        """
+        homework, materials = _event_payload(event)
+        return cls(
+            event.id,
+            event.subject_name,
+            event.start_at.strftime('%H:%M') if event.start_at else '',
+            event.finish_at.strftime('%H:%M') if event.finish_at else '',
+            event.room_number or None,
+            event.lesson_theme or None,
+            tuple(homework),
+            materials,
+        )
+
+    @classmethod
+    def from_row(cls, lesson_id, subject_name, start_time, end_time, room_number,
+                 lesson_theme, homework_text, payload):
+        """
+        Урок из строки schedule (уже раскодированной через справочники).
+        """
+        homework, materials = unpack_payload(payload, homework_text)
+        return cls(lesson_id, subject_name, start_time, end_time, room_number or None,
+                   lesson_theme or None, homework, materials)
+
+
+def _event_payload(event):
+    descriptions = list(event.homework.descriptions or []) if event.homework else []
+    return descriptions, len(event.materials or [])
+
+
+def pack_event(event):
+    """
+    То, что нужно карточке урока сверх колонок schedule (описания ДЗ по
+    отдельности и число материалов), в виде компактного JSON; сжимается zlib,
+    только если так короче (короткое ДЗ от сжатия обычно растёт).
+    None, если ни ДЗ, ни материалов нет.
+    """
+    descriptions, materials = _event_payload(event)
+    if not descriptions and not materials:
+        return None
+    data = json.dumps([descriptions, materials], ensure_ascii=False, separators=(',', ':')).encode()
+    packed = zlib.compress(data, 9)
+    return packed if len(packed) < len(data) else data
+
+
+def unpack_payload(payload, homework_text=None):
+    """
+    (кортеж описаний ДЗ, число материалов) из pack_event. Для строк, записанных
+    до появления нагрузки, ДЗ берётся из homework_text одним описанием.
+    """
+    if payload is None:
+        text = (homework_text or '').strip()
+        return ((text,) if text else ()), 0
+    if payload[0] == _ZLIB_HEADER:
+        payload = zlib.decompress(payload)
+    descriptions, materials = json.loads(payload)
+    return tuple(descriptions), materials
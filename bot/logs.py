@@ -0,0 +1,181 @@
+# bot/logs.py
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from config.settings import (
+    LOGGING_LEVEL,
+    LOG_FORMAT,
+    LOG_NOISY_LEVEL,
+    LOG_SAMPLE_EVERY,
+)
+
+# Идентификаторы корреляции: кто (telegram_user_id) и какой апдейт (update_id)
+user_id_var = ContextVar('user_id', default=None)
+request_id_var = ContextVar('request_id', default=None)
+
+# Для логов, которые пишутся на каждый запрос: logger.info(..., extra=SAMPLED)
+# — в лог попадает только каждая LOG_SAMPLE_EVERY-я такая запись.
+SAMPLED = {'sampled': True}
+
+# Библиотеки, которые на DEBUG/INFO пишут по строке на каждый HTTP-запрос
+NOISY_LOGGERS = ('httpx', 'httpcore', 'telegram', 'apscheduler', 'aiohttp')
+
+_listener = None
+
+
+@contextmanager
+def log_context(user_id=None, request_id=None):
+    """
+    Временно привязывает user_id/request_id ко всем логам текущего контекста.
+    """
+    user_token = user_id_var.set(user_id)
+    request_token = request_id_var.set(request_id)
+    try:
+        yield
+    finally:
+        user_id_var.reset(user_token)
+        request_id_var.reset(request_token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Переносит user_id/request_id из contextvars в запись лога.
+    Стоит на QueueHandler, т.е. выполняется в потоке, который пишет лог,
+    а не в потоке QueueListener (где contextvars уже другие).
+    """
+
+    def filter(self, record):
+        record.user_id = user_id_var.get()
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только каждую every-ю запись с extra=SAMPLED
+    (отдельный счётчик на каждый шаблон сообщения). Остальные записи не трогает.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) or self.every == 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + 1
+        if n % self.every:
+            return False
+        record.sample_rate = self.every
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который в потоке вызова только подставляет аргументы в сообщение
+    и превращает exc_info в текст (объекты исключений нельзя безопасно
+    передавать в другой поток), а всё остальное форматирование — в QueueListener.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exc_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна запись — одна JSON-строка.
+    """
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        user_id = getattr(record, 'user_id', None)
+        if user_id is not None:
+            data['user_id'] = user_id
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            data['request_id'] = request_id
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate:
+            data['sample_rate'] = sample_rate
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s [u=%(user_id)s r=%(request_id)s] %(message)s')
+
+
+def setup_logging(level=LOGGING_LEVEL, fmt=LOG_FORMAT):
+    """
+    Настраивает корневой логгер:
+      - уровень из config.settings.LOGGING_LEVEL;
+      - QueueHandler → QueueListener: запись в stderr идёт в отдельном потоке,
+        event loop никогда не ждёт ввода-вывода логов;
+      - JSON (LOG_FORMAT=json) или текст (LOG_FORMAT=text) с user_id/request_id;
+      - сэмплирование частых записей (extra=SAMPLED);
+      - шумные библиотеки (httpx, telegram, ...) не ниже LOG_NOISY_LEVEL.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    noisy_level = max(root.level, logging.getLevelName(LOG_NOISY_LEVEL.upper()))
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(noisy_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Дописывает очередь логов и останавливает поток записи.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
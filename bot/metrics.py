@@ -0,0 +1,210 @@
+# bot/metrics.py
+
+import time
+import logging
+import threading
+import functools
+import inspect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм (секунды)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}     # (name, labels) -> value
+_gauges = {}       # (name, labels) -> value
+_histograms = {}   # (name, labels) -> [counts по бакетам, sum, count]
+_callbacks = []    # (name, kind, labels, fn) — значения, вычисляемые при выдаче
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Увеличивает счётчик name{labels} на value.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Добавляет наблюдение (длительность в секундах) в гистограмму name{labels}.
+    """
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[0][i] += 1
+                break
+        hist[1] += seconds
+        hist[2] += 1
+
+
+def register_callback(name, kind, fn, **labels):
+    """
+    Регистрирует метрику, значение которой берётся из fn() в момент выдачи
+    (размеры кэшей, попадания и т.п.) — на горячем пути ничего не стоит.
+    kind: 'counter' или 'gauge'.
+    """
+    with _lock:
+        _callbacks.append((name, kind, tuple(sorted(labels.items())), fn))
+
+
+def timed(name, **labels):
+    """
+    Декоратор: пишет длительность вызова в гистограмму name
+    с меткой fn=<имя функции> (и status=error при исключении).
+    Работает и для обычных функций, и для корутин.
+    """
+    def decorator(func):
+        fn_name = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                status = 'ok'
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    status = 'error'
+                    raise
+                finally:
+                    observe(name, time.perf_counter() - start, fn=fn_name, status=status, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                status = 'error'
+                raise
+            finally:
+                observe(name, time.perf_counter() - start, fn=fn_name, status=status, **labels)
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """
+    Текущие значения в виде словаря (для бенчмарков и /stats):
+      counters/gauges: {(name, labels): value}
+      histograms: {(name, labels): (count, sum)}
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: (h[2], h[1]) for key, h in _histograms.items()}
+        callbacks = list(_callbacks)
+    for name, kind, labels, fn in callbacks:
+        target = counters if kind == 'counter' else gauges
+        try:
+            target[(name, labels)] = fn()
+        except Exception:
+            pass
+    return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    parts = []
+    for k, v in items:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def render():
+    """
+    Текст в формате Prometheus exposition.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((k, (list(h[0]), h[1], h[2])) for k, h in _histograms.items())
+        callbacks = list(_callbacks)
+
+    lines = []
+    typed = set()
+
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in counters:
+        type_line(name, 'counter')
+        lines.append(f'{name}{_fmt_labels(labels)} {value}')
+    for (name, labels), value in gauges:
+        type_line(name, 'gauge')
+        lines.append(f'{name}{_fmt_labels(labels)} {value}')
+    for name, kind, labels, fn in callbacks:
+        try:
+            value = fn()
+        except Exception:
+            continue
+        type_line(name, kind)
+        lines.append(f'{name}{_fmt_labels(labels)} {value}')
+    for (name, labels), (counts, total, count) in histograms:
+        type_line(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{_fmt_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_bucket{_fmt_labels(labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{name}_sum{_fmt_labels(labels)} {total}')
+        lines.append(f'{name}_count{_fmt_labels(labels)} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    """
+    Поднимает HTTP-эндпоинт /metrics в фоновом потоке (daemon).
+    Возвращает сервер (для shutdown) или None, если port не задан.
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,145 @@
+# bot/profiler.py
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from config.settings import PROFILE_INTERVAL_MS
+from .metrics import inc
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Поток, у которого на вершине стека ожидание (блокировка/очередь/select
+# event loop/простаивающий воркер пула), не работает — такие выборки
+# считаем простоем, а не собственным временем функции
+_IDLE_MODULES = tuple(os.sep + name for name in ('threading.py', 'queue.py', 'selectors.py'))
+_IDLE_FUNCTIONS = {('_worker', os.path.join('concurrent', 'futures', 'thread.py'))}
+
+
+def _is_idle(code):
+    path = code.co_filename
+    if path.endswith(_IDLE_MODULES):
+        return True
+    return any(code.co_name == name and path.endswith(suffix) for name, suffix in _IDLE_FUNCTIONS)
+
+
+def _where(code):
+    path = code.co_filename
+    if 'site-packages' + os.sep in path:
+        path = path.split('site-packages' + os.sep, 1)[1]
+    elif path.startswith(_ROOT):
+        path = os.path.relpath(path, _ROOT)
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """
+    Статистический профайлер без зависимостей: отдельный поток каждые
+    interval секунд снимает стеки всех потоков (sys._current_frames) и считает,
+    в каких функциях они находятся. Запускается на живом процессе и почти
+    не замедляет его (стоимость — один обход стеков на выборку).
+    - self: функция на вершине стека (где реально тратится время);
+    - total: функция где-то в стеке (включая вызванные из неё).
+    Выборки потоков, которые просто ждут (см. _is_idle), в self/total не
+    попадают и показываются отдельно — простой по потокам.
+    Одновременно работает не больше одного профилирования.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.started_at = None
+        self.finished_at = None
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.stacks = Counter()  # "поток;f1;f2;..." -> выборки (формат folded для flamegraph)
+        self.idle = Counter()  # поток -> выборки, когда он ждал
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Начинает профилирование. False, если оно уже идёт.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._reset()
+            self._stop.clear()
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        inc('profiler_runs_total')
+        return True
+
+    def stop(self):
+        """
+        Останавливает профилирование и возвращает текстовый отчёт (None, если не шло).
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return None
+        self._stop.set()
+        thread.join()
+        self.finished_at = time.monotonic()
+        return self.report()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                if _is_idle(frame.f_code):
+                    self.idle[thread_name] += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_where(frame.f_code))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self.self_counts[stack[0]] += 1
+                for fn in set(stack):
+                    self.total_counts[fn] += 1
+                stack.reverse()
+                self.stacks[';'.join([thread_name] + stack)] += 1
+            self.samples += 1
+
+    def report(self, top=40):
+        duration = (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+        lines = [
+            f'Профилирование: {duration:.1f} с, выборок {self.samples} '
+            f'(каждые {self.interval * 1000:.0f} мс, по всем потокам)',
+            '',
+            f'Топ-{top} по собственному времени (self) — выборки, % от числа выборок:',
+        ]
+        samples = max(self.samples, 1)
+        for fn, n in self.self_counts.most_common(top):
+            lines.append(f'{n:8d} {100 * n / samples:6.1f}%  {fn}')
+        lines += ['', f'Топ-{top} по времени с вложенными вызовами (total):']
+        for fn, n in self.total_counts.most_common(top):
+            lines.append(f'{n:8d} {100 * n / samples:6.1f}%  {fn}')
+        lines += ['', 'Простой (поток ждал в threading/queue/selectors), выборки по потокам:']
+        for name, n in self.idle.most_common():
+            lines.append(f'{n:8d} {100 * n / samples:6.1f}%  {name}')
+        lines += ['', 'Стеки (folded, для flamegraph.pl / speedscope):']
+        for stack, n in self.stacks.most_common():
+            lines.append(f'{stack} {n}')
+        return '\n'.join(lines) + '\n'
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
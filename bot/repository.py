@@ -0,0 +1,260 @@
+# bot/repository.py
+
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from config.settings import DATABASE_PATH, GROUP_COMMIT_MAX, GROUP_COMMIT_WINDOW_MS
+from .cache import token_cache
+from .metrics import observe, inc, register_callback
+from .database import (
+    sql_select_users,
+    sql_select_token,
+    sql_upsert_token,
+    sql_delete_user,
+    sql_select_identity,
+    sql_upsert_identity,
+    sql_delete_identity,
+    sql_select_student_id,
+    sql_replace_schedule,
+    sql_mark_refreshed,
+    sql_select_lessons,
+    sql_search,
+    sql_select_schedule_version,
+    sql_ensure_feed_token,
+    forget_lookups,
+)
+
+logger = logging.getLogger(__name__)
+
+_READ, _WRITE, _STOP = range(3)
+
+
+def _save_token(conn, telegram_user_id, encrypted_token, key_id, expires_at):
+    # Новый токен может принадлежать другому аккаунту mos.ru — привязку к ученику сбрасываем
+    sql_upsert_token(conn, telegram_user_id, encrypted_token, key_id, expires_at)
+    sql_delete_identity(conn, telegram_user_id)
+
+
+class Repository:
+    """
+    Асинхронный доступ к SQLite для хендлеров.
+
+    Все запросы выполняет один поток со своим подключением (WAL), поэтому
+    корутины только ждут результата и не блокируют event loop.
+    - Чтения выполняются сразу, вне транзакции.
+    - Записи копятся в очереди до max_batch штук или window_ms миллисекунд и
+      коммитятся одной транзакцией (group commit); каждая запись — в своём
+      SAVEPOINT, так что ошибка одной не откатывает остальные.
+    Future записи завершается только после COMMIT.
+
+    submit_* можно вызывать из любого потока (например, из APScheduler):
+    они возвращают concurrent.futures.Future, не дожидаясь выполнения.
+    """
+
+    def __init__(self, path=DATABASE_PATH, max_batch=GROUP_COMMIT_MAX, window_ms=GROUP_COMMIT_WINDOW_MS):
+        self.path = path
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        register_callback('db_queue_depth', 'gauge', self._queue.qsize)
+
+    # --- Поток БД -------------------------------------------------------------
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-repository', daemon=True)
+                self._thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item[0] == _STOP:
+                    break
+                if item[0] == _READ:
+                    self._execute_read(conn, item)
+                    continue
+
+                # Запись: добираем соседние записи из очереди в ту же транзакцию
+                batch = [item]
+                pending = None
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        nxt = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt[0] != _WRITE:
+                        pending = nxt  # чтение/остановку выполним после коммита
+                        break
+                    batch.append(nxt)
+                self._commit(conn, batch)
+
+                if pending is not None:
+                    if pending[0] == _STOP:
+                        break
+                    self._execute_read(conn, pending)
+        finally:
+            conn.close()
+
+    def _execute_read(self, conn, item):
+        _, future, fn, args = item
+        if not future.set_running_or_notify_cancel():
+            return
+        start = time.perf_counter()
+        try:
+            future.set_result(fn(conn, *args))
+            status = 'ok'
+        except BaseException as e:
+            future.set_exception(e)
+            status = 'error'
+        observe('db_seconds', time.perf_counter() - start, fn=fn.__name__, status=status)
+
+    def _commit(self, conn, batch):
+        start = time.perf_counter()
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for _, future, fn, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    results.append(None)
+                    continue
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append((True, fn(conn, *args)))
+                    conn.execute('RELEASE write')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    forget_lookups()  # откат мог забрать и новые id справочников
+                    results.append((False, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            # Не удалось начать или закоммитить транзакцию — ошибка для всей пачки
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            forget_lookups()
+            logger.error("Ошибка группового коммита (%s записей): %s", len(batch), e)
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            inc('db_commits_total', status='error')
+            return
+
+        elapsed = time.perf_counter() - start
+        observe('db_commit_seconds', elapsed)
+        inc('db_commits_total', status='ok')
+        inc('db_writes_total', len(batch))
+        for (_, future, fn, _), result in zip(batch, results):
+            if result is None:
+                continue
+            ok, value = result
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+            observe('db_seconds', elapsed, fn=fn.__name__, status='ok' if ok else 'error')
+
+    # --- Постановка в очередь -------------------------------------------------
+
+    def submit_read(self, fn, *args) -> Future:
+        """
+        fn(conn, *args) в потоке БД; возвращает concurrent.futures.Future.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((_READ, future, fn, args))
+        return future
+
+    def submit_write(self, fn, *args) -> Future:
+        """
+        fn(conn, *args) в ближайшем групповом коммите; Future завершается после COMMIT.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((_WRITE, future, fn, args))
+        return future
+
+    def close(self):
+        """
+        Дожидается выполнения уже поставленных запросов и останавливает поток.
+        При следующем submit_* поток будет запущен заново.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put((_STOP, None, None, None))
+            thread.join()
+
+    # --- Асинхронный API ------------------------------------------------------
+
+    async def read(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_read(fn, *args))
+
+    async def write(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    async def list_users(self):
+        return await self.read(sql_select_users)
+
+    async def load_encrypted_token(self, telegram_user_id):
+        return await self.read(sql_select_token, telegram_user_id)
+
+    async def save_token(self, telegram_user_id, encrypted_token, key_id, expires_at=None):
+        await self.write(_save_token, telegram_user_id, encrypted_token, key_id, expires_at)
+        token_cache.invalidate(telegram_user_id)
+
+    async def delete_user(self, telegram_user_id):
+        await self.write(sql_delete_user, telegram_user_id)
+        token_cache.invalidate(telegram_user_id)
+
+    async def load_identity(self, telegram_user_id):
+        return await self.read(sql_select_identity, telegram_user_id)
+
+    async def save_identity(self, telegram_user_id, profile_id, person_guid, mes_role):
+        return await self.write(sql_upsert_identity, telegram_user_id, profile_id, person_guid, mes_role)
+
+    async def student_id(self, telegram_user_id):
+        return await self.read(sql_select_student_id, telegram_user_id)
+
+    # Расписание хранится по ученику (student_id), общее для всех его подписчиков
+
+    async def replace_schedule(self, student_id, begin, end, events_response):
+        return await self.write(sql_replace_schedule, student_id, begin, end, events_response)
+
+    async def mark_refreshed(self, student_id, far):
+        await self.write(sql_mark_refreshed, student_id, far)
+
+    async def load_day_lessons(self, student_id, date_str):
+        return await self.read(sql_select_lessons, student_id, date_str)
+
+    async def schedule_version(self, student_id):
+        return await self.read(sql_select_schedule_version, student_id)
+
+    async def feed_token(self, user_id, reset=False):
+        return await self.write(sql_ensure_feed_token, user_id, reset)
+
+    async def search(self, student_id, match, limit, offset=0):
+        return await self.read(sql_search, student_id, match, limit, offset)
+
+
+repository = Repository()
@@ -0,0 +1,27 @@
+# bot/request.py
+
+import time
+from telegram.request import HTTPXRequest
+
+from .metrics import observe
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """
+    HTTPXRequest, который пишет длительность каждого вызова Bot API
+    (sendPhoto, sendMessage, deleteMessage, ...) в гистограмму telegram_request_seconds.
+    Для getUpdates не используется (долгий polling исказил бы гистограмму).
+    """
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            observe('telegram_request_seconds', time.perf_counter() - start,
+                    endpoint=endpoint, status=status)
@@ -0,0 +1,104 @@
+# bot/router.py
+
+import logging
+import time
+
+from .metrics import observe, inc
+
+logger = logging.getLogger(__name__)
+
+# Версия грамматики callback_data. Формат: "<версия>.<маршрут>[.<арг>...]",
+# например "1.d.7" — выбран день 7. Кнопки со старой версией или старым
+# форматом (cal21_day_7, lesson_0, back_to_schedule...) разбираются через
+# таблицу legacy, а совсем неизвестные — мягко отклоняются.
+VERSION = '1'
+SEP = '.'
+
+
+def callback_data(route: str, *args) -> str:
+    """
+    Собирает callback_data для кнопки: callback_data('d', 7) -> "1.d.7".
+    """
+    return SEP.join((VERSION, route) + tuple(str(a) for a in args))
+
+
+class CallbackRouter:
+    """
+    Диспетчер нажатий инлайн-кнопок.
+
+    Маршруты регистрируются по короткому имени (route) вместе с типами
+    аргументов; разбор callback_data — один split и поиск в словаре,
+    без регулярных выражений, поэтому стоимость не растёт с числом экранов.
+    Для каждого маршрута пишутся callback_seconds{route} и callback_total{route,status}.
+    """
+
+    def __init__(self, fallback_text="Кнопка устарела, откройте /schedule заново"):
+        self.fallback_text = fallback_text
+        self._routes = {}          # route -> (handler, типы аргументов)
+        self._legacy_exact = {}    # "back_to_schedule" -> route
+        self._legacy_prefix = {}   # "cal21_day" -> route (аргумент после последнего "_")
+
+    def add(self, route: str, handler, *arg_types):
+        """
+        handler(update, context, *args) вызывается для callback_data(route, *args).
+        """
+        self._routes[route] = (handler, arg_types)
+
+    def legacy(self, old: str, route: str, prefix: bool = False):
+        """
+        Старый формат кнопок: точное значение (old) или префикс
+        вида "<old>_<арг>" (prefix=True), который отображается на route.
+        """
+        if prefix:
+            self._legacy_prefix[old] = route
+        else:
+            self._legacy_exact[old] = route
+
+    def parse(self, data: str):
+        """
+        Возвращает (route, [аргументы строками]) или (None, None), если формат неизвестен.
+        """
+        if not data:
+            return None, None
+        parts = data.split(SEP)
+        if len(parts) >= 2 and parts[0] == VERSION:
+            return parts[1], parts[2:]
+
+        route = self._legacy_exact.get(data)
+        if route is not None:
+            return route, []
+        head, _, arg = data.rpartition('_')
+        route = self._legacy_prefix.get(head)
+        if route is not None:
+            return route, [arg]
+        return None, None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        route, raw_args = self.parse(query.data)
+        entry = self._routes.get(route)
+        args = None
+        if entry is not None:
+            handler, arg_types = entry
+            if len(raw_args) == len(arg_types):
+                try:
+                    args = [t(a) for t, a in zip(arg_types, raw_args)]
+                except ValueError:
+                    args = None
+
+        if args is None:
+            inc('callback_total', route='unknown', status='rejected')
+            logger.warning("Неизвестный или устаревший callback_data: %s", query.data)
+            await query.answer(self.fallback_text)
+            return
+
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(update, context, *args)
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            observe('callback_seconds', time.perf_counter() - start, route=route)
+            inc('callback_total', route=route, status=status)
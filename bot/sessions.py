@@ -0,0 +1,115 @@
+# bot/sessions.py
+
+import logging
+import time
+from collections import OrderedDict
+
+from config.settings import LOGIN_SESSION_TTL, LOGIN_SESSION_MAX
+from .metrics import inc, register_callback
+
+logger = logging.getLogger(__name__)
+
+
+async def close_login_client(api):
+    """
+    Закрывает HTTP-сессию авторизации octodiary (api._login_info["session"]),
+    которую AsyncMobileAPI.login открывает и сам не закрывает, и стирает
+    куки входа. Сам api с токеном остаётся рабочим.
+    """
+    login_info = getattr(api, '_login_info', None) if api is not None else None
+    if not login_info:
+        return
+    session = login_info.get('session')
+    login_info.clear()
+    if session is not None and not session.closed:
+        try:
+            await session.close()
+        except Exception as e:
+            logger.warning("Не удалось закрыть сессию авторизации МЭШ: %s", e)
+
+
+class LoginSession:
+    """
+    Состояние одного входа в МЭШ между шагами диалога /login:
+    логин (до ввода пароля), клиент AsyncMobileAPI с открытой
+    HTTP-сессией авторизации и объект ввода SMS-кода.
+    Пароль здесь не хранится — он используется сразу в get_password.
+    """
+
+    __slots__ = ('username', 'api', 'sms_code_obj', 'expires_at')
+
+    def __init__(self, username=None):
+        self.username = username
+        self.api = None
+        self.sms_code_obj = None
+        self.expires_at = 0.0
+
+    async def close(self):
+        """
+        Закрывает HTTP-сессию авторизации octodiary и стирает данные входа.
+        """
+        api, self.api, self.sms_code_obj, self.username = self.api, None, None, None
+        await close_login_client(api)
+
+
+class LoginSessionStore:
+    """
+    Ограниченное хранилище сессий входа с TTL (живёт в event loop бота).
+    При переполнении вытесняется самая старая сессия; просроченные
+    закрываются периодическим expire() (задача JobQueue). Закрытие сессии
+    закрывает HTTP-клиент МЭШ, поэтому брошенные на шаге SMS входы
+    не держат соединения и данные в памяти.
+    """
+
+    def __init__(self, ttl=LOGIN_SESSION_TTL, maxsize=LOGIN_SESSION_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        register_callback('login_sessions_live', 'gauge', lambda: len(self._sessions))
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None or session.expires_at <= time.monotonic():
+            return None
+        return session
+
+    async def put(self, user_id, session):
+        old = self._sessions.pop(user_id, None)
+        if old is not None and old is not session:
+            await old.close()
+        session.expires_at = time.monotonic() + self.ttl
+        self._sessions[user_id] = session
+        inc('login_sessions_total', outcome='started')
+        while len(self._sessions) > self.maxsize:
+            _, evicted = self._sessions.popitem(last=False)
+            inc('login_sessions_total', outcome='evicted')
+            await evicted.close()
+
+    def pop(self, user_id):
+        """
+        Забирает сессию из хранилища без закрытия (вход завершён, api нужен дальше).
+        """
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            inc('login_sessions_total', outcome='completed')
+        return session
+
+    async def discard(self, user_id, outcome='cancelled'):
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            inc('login_sessions_total', outcome=outcome)
+            await session.close()
+
+    async def expire(self, context=None):
+        """
+        Закрывает все просроченные сессии. Подходит как колбэк JobQueue.
+        """
+        now = time.monotonic()
+        expired = [uid for uid, s in self._sessions.items() if s.expires_at <= now]
+        for user_id in expired:
+            await self.discard(user_id, outcome='expired')
+        if expired:
+            logger.info("Закрыто просроченных сессий входа: %s", len(expired))
+
+
+login_sessions = LoginSessionStore()
@@ -0,0 +1,118 @@
+# bot/sync.py
+
+import asyncio
+import logging
+
+from config.settings import FIRST_SYNC_WAIT
+from .auth import get_token_async, new_api, resolve_identity
+from .horizon import full_range, first_sync_ranges, covers
+from .metrics import timed, inc
+from .repository import repository
+
+logger = logging.getLogger(__name__)
+
+
+class _FirstSync:
+    def __init__(self):
+        self.task = None
+        self.week_done = asyncio.Event()
+
+
+# Идущие первые синхронизации: telegram_user_id -> _FirstSync.
+# Читается и потоком update_all_schedules (только проверка «есть ли»).
+_running = {}
+
+
+@timed('sync_seconds')
+async def sync_user_schedule(tg_id: int, ranges=None, on_range_done=None):
+    """
+    Синхронизирует расписание ученика, к которому привязан пользователь tg_id,
+    из МЭШ в локальную БД (общую копию для всех подписчиков ученика).
+    ranges — список диапазонов (begin, end), которые запрашиваются и
+    сохраняются по очереди; по умолчанию весь горизонт (bot.horizon).
+    on_range_done() вызывается после сохранения каждого диапазона.
+    """
+    # 1) Берём токен (из кэша или БД)
+    try:
+        token_data = await get_token_async(tg_id)
+        if not token_data:
+            logger.warning("У пользователя %s нет токена, пропускаем sync_user_schedule.", tg_id)
+            return
+        mesh_api = new_api(token_data)
+    except Exception as e:
+        logger.warning("Ошибка расшифровки токена при sync_user_schedule(tg_id=%s): %s", tg_id, e)
+        return
+
+    try:
+        identity = await resolve_identity(tg_id, mesh_api)
+        if not identity:
+            logger.warning("Нет профиля ученика у %s, не можем синхронизировать.", tg_id)
+            return
+        student_id, person_guid, mes_role = identity
+
+        # 2) Вызываем API MЭШ по диапазонам и 3) заменяем расписание за каждый
+        #    из них свежим (история вне диапазонов не трогается)
+        ranges = ranges or [full_range()]
+        for begin_date, end_date in ranges:
+            events = await mesh_api.get_events(
+                person_id=person_guid,
+                mes_role=mes_role,
+                begin_date=begin_date,
+                end_date=end_date
+            )
+            await repository.replace_schedule(student_id, begin_date, end_date, events)
+            if on_range_done:
+                on_range_done()
+        if covers(ranges, *full_range()):
+            # Весь горизонт свежий — плановый проход может пропустить ученика
+            await repository.mark_refreshed(student_id, far=True)
+
+        logger.info("Синхронизация расписания user_id=%s завершена успешно.", tg_id)
+    except Exception as e:
+        logger.warning("Ошибка при синхронизации user_id=%s: %s", tg_id, e)
+
+
+def start_first_sync(application, tg_id: int):
+    """
+    Запускает первую синхронизацию после логина фоновой задачей приложения,
+    не дожидаясь её: сначала текущая неделя, затем остальной горизонт.
+    Повторный вызов, пока синхронизация идёт, ничего не делает.
+    """
+    if tg_id in _running:
+        return
+    state = _FirstSync()
+    _running[tg_id] = state
+
+    async def run():
+        try:
+            await sync_user_schedule(
+                tg_id,
+                ranges=first_sync_ranges(),
+                on_range_done=state.week_done.set,
+            )
+        finally:
+            state.week_done.set()
+            _running.pop(tg_id, None)
+
+    inc('first_sync_total')
+    state.task = application.create_task(run())
+
+
+def first_sync_pending(tg_id: int) -> bool:
+    return tg_id in _running
+
+
+async def wait_first_sync(tg_id: int, week_only: bool = False, timeout: float = FIRST_SYNC_WAIT):
+    """
+    Если у пользователя идёт первая синхронизация, ждёт её (или только
+    текущую неделю при week_only), но не дольше timeout секунд.
+    """
+    state = _running.get(tg_id)
+    if state is None:
+        return
+    inc('first_sync_joined_total')
+    waiter = state.week_done.wait() if week_only else asyncio.shield(state.task)
+    try:
+        await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        logger.info("Первая синхронизация user_id=%s не успела за %s с", tg_id, timeout)
@@ -1,12 +1,21 @@
 # bot/utils.py
 
+import threading
 from datetime import date, timedelta
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from config.settings import LESSON_KEYBOARD_CACHE_SIZE
+from .cache import TTLCache
+from .router import callback_data
+
 WEEKDAYS_RU = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
 MONTHS_RU    = ["янв", "фев", "мар", "апр", "май", "июн",
                 "июл", "авг", "сен", "окт", "ноя", "дек"]
 
+def current_week_monday(today=None) -> date:
+    today = today or date.today()
+    return today - timedelta(days=today.weekday())
+
 def compute_21days():
     """
     Возвращает список из 21 date:
@@ -19,15 +28,36 @@ def compute_21days():
                7..13 => текущая
                14..20=> следующая
     """
-    today = date.today()
     # Понедельник текущей недели
-    current_monday = today - timedelta(days=today.weekday())
+    current_monday = current_week_monday()
     # Понедельник предыдущей недели
     start_date = current_monday - timedelta(days=7)
 
     days_21 = [start_date + timedelta(days=i) for i in range(21)]
     return days_21
 
+# Клавиатуры календаря одинаковы для всех пользователей и меняются только
+# в понедельник, поэтому строятся один раз на неделю для всех offset 0..20:
+# (понедельник, {offset: InlineKeyboardMarkup}). Объекты PTB неизменяемы,
+# так что один markup можно отдавать всем.
+_calendar_keyboards = (None, {})
+_calendar_lock = threading.Lock()
+
+def precompute_calendar_keyboards(monday: date = None):
+    """
+    Строит клавиатуры календаря на неделю с понедельником monday (по умолчанию
+    текущую). Вызывается планировщиком в момент смены недели и лениво
+    из generate_calendar_keyboard, если неделя уже сменилась.
+    """
+    global _calendar_keyboards
+    monday = monday or current_week_monday()
+    start_date = monday - timedelta(days=7)
+    days_21 = [start_date + timedelta(days=i) for i in range(21)]
+    keyboards = {offset: _build_calendar_keyboard(days_21, offset) for offset in range(21)}
+    with _calendar_lock:
+        _calendar_keyboards = (monday, keyboards)
+    return keyboards
+
 def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
     """
     Создаёт инлайн-клавиатуру, показывающую максимум 5 дат
@@ -41,20 +71,25 @@ def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
       - Вторая строка: число+месяц
       - Третья строка: кнопки "Назад"/"Вперёд"
 
-    callback_data:
-      "cal21_day_X"     -> пользователь выбрал день (X=0..20)
-      "cal21_prev_OFF"  -> смещение offset -= 5
-      "cal21_next_OFF"  -> смещение offset += 5
-    """
-
-    days_21 = compute_21days()
+    callback_data (см. bot.router):
+      "1.d.X"    -> пользователь выбрал день (X=0..20)
+      "1.p.OFF"  -> смещение offset -= 5
+      "1.n.OFF"  -> смещение offset += 5
 
+    Готовая клавиатура берётся из недельного кэша (см. precompute_calendar_keyboards).
+    """
     # Гарантируем, что offset не вышел за границы (0..20)
     if offset < 0:
         offset = 0
     if offset >= 21:
         offset = 0
 
+    monday, keyboards = _calendar_keyboards
+    if monday != current_week_monday():
+        keyboards = precompute_calendar_keyboards()
+    return keyboards[offset]
+
+def _build_calendar_keyboard(days_21, offset: int) -> InlineKeyboardMarkup:
     # Покажем 5 дат начиная с offset
     slice_end = min(offset + 5, 21)  # не больше 21
     slice_days = days_21[offset:slice_end]
@@ -68,7 +103,7 @@ def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
         wd_name = WEEKDAYS_RU[day_.weekday()]  # "Пн", "Вт"...
         header_row.append(InlineKeyboardButton(
             wd_name,
-            callback_data="ignore"  # не кликабельно
+            callback_data=callback_data('x')  # не кликабельно
         ))
         # "DD MMM"
         m_name = MONTHS_RU[day_.month - 1]
@@ -77,7 +112,7 @@ def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
         global_index = offset + i  # индекс в 0..20
         date_row.append(InlineKeyboardButton(
             label,
-            callback_data=f"cal21_day_{global_index}"
+            callback_data=callback_data('d', global_index)
         ))
 
     keyboard = [header_row, date_row]
@@ -87,19 +122,46 @@ def generate_calendar_keyboard(offset: int = 0) -> InlineKeyboardMarkup:
     if offset > 0:
         nav_row.append(InlineKeyboardButton(
             "« Назад",
-            callback_data=f"cal21_prev_{offset}"
+            callback_data=callback_data('p', offset)
         ))
     else:
-        nav_row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+        nav_row.append(InlineKeyboardButton(" ", callback_data=callback_data('x')))
 
     if slice_end < 21:
         nav_row.append(InlineKeyboardButton(
             "Вперёд »",
-            callback_data=f"cal21_next_{offset}"
+            callback_data=callback_data('n', offset)
         ))
     else:
-        nav_row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+        nav_row.append(InlineKeyboardButton(" ", callback_data=callback_data('x')))
 
     keyboard.append(nav_row)
 
-    return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Клавиатуры списка уроков дня: ключ — содержимое кнопок (время и предмет
+# каждого урока), т.е. версия расписания дня. У одноклассников и при повторных
+# просмотрах того же дня клавиатура переиспользуется.
+_lesson_keyboards = TTLCache(LESSON_KEYBOARD_CACHE_SIZE, 24 * 3600, name='lesson_keyboard')
+
+def generate_lessons_keyboard(lessons) -> InlineKeyboardMarkup:
+    """
+    Кнопки "ЧЧ:ММ-ЧЧ:ММ Предмет" (callback_data "1.l.X") по списку уроков
+    (bot.lessons.Lesson) и кнопка возврата к календарю.
+    """
+    labels = []
+    for lesson in lessons:
+        labels.append(f"{lesson.start_time or '--:--'}-{lesson.end_time or '--:--'} {lesson.subject_name or '---'}")
+    key = tuple(labels)
+
+    markup = _lesson_keyboards.get(key)
+    if markup is None:
+        keyboard = [
+            [InlineKeyboardButton(btn_txt, callback_data=callback_data('l', idx))]
+            for idx, btn_txt in enumerate(labels)
+        ]
+        keyboard.append([InlineKeyboardButton("Вернуться к расписанию", callback_data=callback_data('bs'))])
+        markup = InlineKeyboardMarkup(keyboard)
+        _lesson_keyboards.set(key, markup)
+    return markup
@@ -0,0 +1,84 @@
+# bot/watchdog.py
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from .metrics import observe, set_gauge, inc
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Следит за отзывчивостью event loop.
+
+    - В самом loop крутится «пульс»: каждые interval секунд засыпает и меряет,
+      на сколько проснулся позже (лаг) → гистограмма loop_lag_seconds.
+    - В debug-режиме отдельный поток проверяет, давно ли был пульс; если loop
+      не отвечает дольше threshold, снимает стек потока loop (т.е. того
+      колбэка, который его блокирует) и пишет его в лог один раз за зависание.
+    """
+
+    def __init__(self, interval=0.5, threshold=0.25, debug=False):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self._last_beat = time.monotonic()
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self._last_beat = time.monotonic()
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            observe('loop_lag_seconds', lag)
+            set_gauge('loop_lag_last_seconds', lag)
+
+    def _monitor(self):
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._last_beat
+            stalled = time.monotonic() - beat
+            # Пульс ждёт interval по плану, поэтому «зависание» — сверх interval
+            if stalled <= self.interval + self.threshold or reported_beat == beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            inc('loop_blocked_total')
+            logger.warning("Event loop заблокирован уже %.0f мс, стек:\n%s",
+                           (stalled - self.interval) * 1000, stack)
+
+    def start(self):
+        """
+        Запускать изнутри работающего loop (например, из post_init приложения).
+        """
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        if self.debug:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._stop.set()
+        self._thread = None
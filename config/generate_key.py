@@ -1,7 +1,22 @@
+import os
+import sys
 from cryptography.fernet import Fernet
 
+# Тот же файл, что читает бот (config.settings.ENCRYPTION_KEY_PATH); скрипт
+# запускается как python config/generate_key.py, поэтому settings не импортируем
+KEY_PATH = os.getenv("ENCRYPTION_KEY_PATH", "encryption.key")
+
 key = Fernet.generate_key()
-with open("encryption.key", "wb") as f:
-    f.write(key)
 
-print("Ключ шифрования сгенерирован и сохранён в файл encryption.key")
+if "--rotate" in sys.argv and os.path.exists(KEY_PATH):
+    # Ротация: новый ключ становится первым (текущим), старые остаются ниже
+    # для расшифровки, пока бот в фоне не перешифрует все токены.
+    with open(KEY_PATH, "rb") as f:
+        old_keys = [line.strip() for line in f.read().splitlines() if line.strip()]
+    with open(KEY_PATH, "wb") as f:
+        f.write(b"\n".join([key] + old_keys) + b"\n")
+    print(f"Новый ключ добавлен в {KEY_PATH}, старых ключей: {len(old_keys)}. Перезапустите бота.")
+else:
+    with open(KEY_PATH, "wb") as f:
+        f.write(key)
+    print(f"Ключ шифрования сгенерирован и сохранён в файл {KEY_PATH}")
@@ -9,7 +9,124 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '7900995488:AAHP-vD0DMqeSQBIvdemyJh
 LOGGING_LEVEL = os.getenv('LOGGING_LEVEL', 'INFO')
 
 # Путь к файлу базы данных
-DATABASE_PATH = 'users.db'
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'users.db')
 
-# Путь к файлу ключа шифрования для Fernet
-ENCRYPTION_KEY_PATH = 'encryption.key'
+# Путь к файлу ключей шифрования для Fernet (по одному на строку, первый — текущий;
+# ротация: python config/generate_key.py --rotate)
+ENCRYPTION_KEY_PATH = os.getenv('ENCRYPTION_KEY_PATH', 'encryption.key')
+
+# Кэш расшифрованных токенов: максимум записей и время жизни (секунды).
+# Время жизни больше SWEEP_INTERVAL, чтобы следующий проход обновления
+# расписаний находил токены в кэше, а не расшифровывал их заново
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', '10800'))
+
+# Фоновое перешифрование токенов после ротации ключа:
+# размер пачки (строк на транзакцию) и предельная скорость (строк/сек)
+KEY_ROTATION_BATCH_SIZE = int(os.getenv('KEY_ROTATION_BATCH_SIZE', '100'))
+KEY_ROTATION_RATE = int(os.getenv('KEY_ROTATION_RATE', '200'))
+
+# Локальный HTTP-эндпоинт метрик в формате Prometheus (/metrics); 0 — выключен
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Формат логов: json (структурированный) или text
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Минимальный уровень для шумных библиотек (httpx, telegram, apscheduler, aiohttp)
+LOG_NOISY_LEVEL = os.getenv('LOG_NOISY_LEVEL', 'WARNING')
+# Частые записи на каждый запрос (extra=SAMPLED) пишутся 1 раз из N
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '100'))
+
+# Сторож event loop: период замера лага, порог «блокировки» (сек) и debug-режим
+# со снятием стека заблокировавшего колбэка
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', '0.5'))
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', '0.25'))
+LOOP_WATCHDOG_DEBUG = os.getenv('LOOP_WATCHDOG_DEBUG', '0') == '1'
+
+# Размер пула потоков для блокирующих вызовов (SQLite, Fernet) из хендлеров
+BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', '8'))
+
+# Групповой коммит записей в bot.repository: не больше N записей в транзакции
+# и не дольше W миллисекунд ожидания соседних записей
+GROUP_COMMIT_MAX = int(os.getenv('GROUP_COMMIT_MAX', '200'))
+GROUP_COMMIT_WINDOW_MS = float(os.getenv('GROUP_COMMIT_WINDOW_MS', '5'))
+
+# Кэш клавиатур списка уроков (по набору уроков дня): максимум записей
+LESSON_KEYBOARD_CACHE_SIZE = int(os.getenv('LESSON_KEYBOARD_CACHE_SIZE', '5000'))
+
+# Горизонт расписания (дни относительно сегодняшнего):
+# - прошлые HORIZON_PAST_DAYS дней ещё обновляются (ДЗ и темы могут дописать),
+#   всё, что раньше, хранится как неизменяемая история;
+# - ближние HORIZON_NEAR_DAYS дней вперёд обновляются при каждом проходе;
+# - дальние до HORIZON_FAR_DAYS — не чаще раза в HORIZON_FAR_REFRESH_HOURS часов.
+HORIZON_PAST_DAYS = int(os.getenv('HORIZON_PAST_DAYS', '7'))
+HORIZON_NEAR_DAYS = int(os.getenv('HORIZON_NEAR_DAYS', '7'))
+HORIZON_FAR_DAYS = int(os.getenv('HORIZON_FAR_DAYS', '21'))
+HORIZON_FAR_REFRESH_HOURS = float(os.getenv('HORIZON_FAR_REFRESH_HOURS', '24'))
+
+# Хранение истории расписания: уроки старше SCHEDULE_RETENTION_DAYS дней
+# удаляются ежедневной задачей пачками по SCHEDULE_PRUNE_BATCH строк
+SCHEDULE_RETENTION_DAYS = int(os.getenv('SCHEDULE_RETENTION_DAYS', '180'))
+SCHEDULE_PRUNE_BATCH = int(os.getenv('SCHEDULE_PRUNE_BATCH', '1000'))
+
+# /search: результатов на странице
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '5'))
+
+# Кэш file_id отправленных экспортов (/export) по версии расписания: максимум записей
+EXPORT_CACHE_SIZE = int(os.getenv('EXPORT_CACHE_SIZE', '10000'))
+
+# ICS-лента для подписки из календарей: HTTP-сервер (0 — выключен) и внешний
+# адрес, по которому он доступен пользователям (например, https://bot.example.ru)
+FEED_HOST = os.getenv('FEED_HOST', '127.0.0.1')
+FEED_PORT = int(os.getenv('FEED_PORT', '0'))
+FEED_BASE_URL = os.getenv('FEED_BASE_URL', '')
+# Сколько секунд лента доверяет закэшированной в памяти версии расписания
+FEED_VERSION_TTL = int(os.getenv('FEED_VERSION_TTL', '60'))
+# Сколько лент держать в памяти целиком
+FEED_CACHE_SIZE = int(os.getenv('FEED_CACHE_SIZE', '2000'))
+
+# Первая синхронизация после логина идёт в фоне; сколько секунд хендлер
+# ждёт её, если данные нужны раньше, чем она закончилась
+FIRST_SYNC_WAIT = float(os.getenv('FIRST_SYNC_WAIT', '10'))
+
+# Незавершённые входы (/login → пароль → SMS): время жизни сессии (сек)
+# и максимум одновременных сессий; старые закрываются и забываются
+LOGIN_SESSION_TTL = int(os.getenv('LOGIN_SESSION_TTL', '300'))
+LOGIN_SESSION_MAX = int(os.getenv('LOGIN_SESSION_MAX', '1000'))
+
+# Продление токенов МЭШ: за сколько секунд до истечения (JWT exp) обновлять
+# токен через refresh_token и как часто (сек) запускать задачу продления
+TOKEN_RENEW_AHEAD = int(os.getenv('TOKEN_RENEW_AHEAD', str(24 * 3600)))
+TOKEN_RENEW_INTERVAL = int(os.getenv('TOKEN_RENEW_INTERVAL', '3600'))
+
+# Проверка сохранённых токенов у МЭШ (validate_tokens, раз в сутки): сколько
+# запросов одновременно, не больше скольких в секунду, и не проверять токены,
+# проверенные менее TOKEN_CHECK_MAX_AGE секунд назад
+TOKEN_CHECK_CONCURRENCY = int(os.getenv('TOKEN_CHECK_CONCURRENCY', '10'))
+TOKEN_CHECK_RATE = float(os.getenv('TOKEN_CHECK_RATE', '20'))
+TOKEN_CHECK_MAX_AGE = int(os.getenv('TOKEN_CHECK_MAX_AGE', str(20 * 3600)))
+# Пользователи с мёртвым токеном, не вошедшие заново за TOKEN_PURGE_AFTER
+# секунд, удаляются вместе с расписанием (пачками по TOKEN_PURGE_BATCH)
+TOKEN_PURGE_AFTER = int(os.getenv('TOKEN_PURGE_AFTER', str(30 * 24 * 3600)))
+TOKEN_PURGE_BATCH = int(os.getenv('TOKEN_PURGE_BATCH', '100'))
+
+# Обновление расписаний (update_all_schedules): период прохода (сек), задержка
+# первого прохода после старта (сек) и минимальный возраст данных ученика —
+# обновлявшиеся позже SWEEP_MIN_AGE секунд назад пропускаются (в т.ч. после рестарта)
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', '3600'))
+SWEEP_START_DELAY = int(os.getenv('SWEEP_START_DELAY', '120'))
+SWEEP_MIN_AGE = int(os.getenv('SWEEP_MIN_AGE', '3300'))
+
+# Утренняя сводка (/digest): время по умолчанию (ЧЧ:ММ), когда заранее
+# готовить тексты сводок на день, и скорость отправки (сообщений в секунду —
+# ниже общего лимита Bot API в 30/с, чтобы оставить место интерактиву)
+DIGEST_DEFAULT_TIME = os.getenv('DIGEST_DEFAULT_TIME', '07:00')
+DIGEST_PRERENDER_TIME = os.getenv('DIGEST_PRERENDER_TIME', '05:30')
+DIGEST_RATE = float(os.getenv('DIGEST_RATE', '20'))
+
+# Администраторы бота (telegram_user_id через запятую): только им доступны
+# /stats и /profile. Пусто — команды отключены
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
+# /profile: максимальная длительность профилирования (сек) и период выборок (мс)
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '300'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
@@ -1,119 +1,265 @@
 # main.py (СИНХРОННЫЙ вариант с run_polling)
 
+import time
+_T_START = time.perf_counter()
+
+import asyncio
 import logging
-from datetime import date, timedelta
 from telegram.ext import ApplicationBuilder
 from bot.handlers import setup_handlers
-from bot.database import init_db, init_schedule_db
+from bot.database import (
+    init_db,
+    prune_schedule,
+    purge_dead_users,
+    sql_select_subscribers,
+    sql_refresh_schedule,
+    sql_mark_needs_relogin,
+)
+from bot.auth import (
+    reencrypt_tokens,
+    renew_tokens,
+    validate_tokens,
+    get_token,
+    new_api,
+    resolve_identity,
+    is_auth_error,
+)
+from bot.cache import token_cache
+from bot.horizon import sweep_range
+from bot.sync import first_sync_pending
+from bot.metrics import start_metrics_server, observe, inc, set_gauge
+from bot.request import InstrumentedHTTPXRequest
+from bot.logs import setup_logging, log_context, SAMPLED
+from bot.watchdog import LoopWatchdog
+from bot.feed import start_feed_server
+from bot.repository import repository
+from bot.utils import precompute_calendar_keyboards
 from config import settings
 # APScheduler (не async, а background)
 from apscheduler.schedulers.background import BackgroundScheduler
 
+# octodiary и cryptography здесь не импортируются: они подгружаются лениво
+# при первом обращении к МЭШ / ключу шифрования (см. bot.auth).
+_T_IMPORTED = time.perf_counter()
+
+
+watchdog = LoopWatchdog(
+    interval=settings.LOOP_WATCHDOG_INTERVAL,
+    threshold=settings.LOOP_BLOCK_THRESHOLD,
+    debug=settings.LOOP_WATCHDOG_DEBUG,
+)
 
-def main():
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger(__name__)
 
-    init_db()
-    init_schedule_db()
+async def _start_watchdog(application):
+    watchdog.start()
 
-    application = ApplicationBuilder().token(f"{settings.TELEGRAM_TOKEN}").build()
 
+async def _stop_watchdog(application):
+    watchdog.stop()
+    # Дописываем очередь записей в БД и останавливаем поток репозитория
+    await asyncio.to_thread(repository.close)
+
+
+def build_application(base_url=None):
+    """
+    Собирает Application со всеми хендлерами.
+    base_url позволяет направить бота на другой Bot API (например, фейковый в bench/).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(f"{settings.TELEGRAM_TOKEN}")
+        .request(InstrumentedHTTPXRequest(connection_pool_size=256))
+        .post_init(_start_watchdog)
+        .post_shutdown(_stop_watchdog)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     setup_handlers(application)
+    return application
+
+
+def main():
+    setup_logging()  # уровень из settings.LOGGING_LEVEL, JSON через QueueHandler
+    logger = logging.getLogger(__name__)
+
+    t0 = time.perf_counter()
+    init_db()  # вся схема — одной транзакцией
+    t_schema = time.perf_counter()
 
-    # Сбрасываем вебхук
-    application.bot.delete_webhook(drop_pending_updates=True)
+    application = build_application()
+    t_app = time.perf_counter()
 
     # Создаём BackgroundScheduler (не async)
     sched = BackgroundScheduler()
-    from datetime import datetime
+    from datetime import datetime, timedelta
 
+    # Первый проход — не сразу при старте (каждый деплой не должен бить по МЭШ),
+    # и он обновит только учеников, чьи данные старше SWEEP_MIN_AGE
     sched.add_job(
         update_all_schedules,
         'interval',
-        seconds=3600,
-        next_run_time=datetime.now()  # Выполнить прямо сейчас
+        seconds=settings.SWEEP_INTERVAL,
+        next_run_time=datetime.now() + timedelta(seconds=settings.SWEEP_START_DELAY),
+        max_instances=1,
+        coalesce=True,
     )
 
+    # Клавиатуры календаря: сразу при старте и заново в момент смены недели
+    precompute_calendar_keyboards()
+    sched.add_job(precompute_calendar_keyboards, 'cron', day_of_week='mon', hour=0, minute=0, second=1)
+
+    # Раз в сутки удаляем историю расписания старше SCHEDULE_RETENTION_DAYS
+    sched.add_job(prune_schedule, 'cron', hour=3, minute=30)
+
+    # Перешифровываем токены старыми ключами (если была ротация) — в фоне, пачками
+    sched.add_job(reencrypt_tokens, 'date', run_date=datetime.now())
+
+    # Продлеваем токены МЭШ до истечения, мёртвые помечаем needs_relogin
+    sched.add_job(renew_tokens, 'interval', seconds=settings.TOKEN_RENEW_INTERVAL, next_run_time=datetime.now())
+
+    # Раз в сутки проверяем у МЭШ все сохранённые токены (мёртвые — в needs_relogin),
+    # затем удаляем давно не вернувшихся пользователей вместе с их расписанием
+    sched.add_job(validate_tokens, 'cron', hour=4, minute=0)
+    sched.add_job(purge_dead_users, 'cron', hour=4, minute=45)
+
     sched.start()
+    t_sched = time.perf_counter()
+
+    start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+    start_feed_server(settings.FEED_HOST, settings.FEED_PORT)
+
+    logger.info(
+        "Старт за %.0f мс: импорт %.0f мс, схема БД %.0f мс, Application %.0f мс, планировщик %.0f мс",
+        (t_sched - _T_START) * 1000,
+        (_T_IMPORTED - _T_START) * 1000,
+        (t_schema - t0) * 1000,
+        (t_app - t_schema) * 1000,
+        (t_sched - t_app) * 1000,
+    )
 
     logger.info("Запускаем run_polling() ...")
-    application.run_polling()  # <-- СИНХРОННЫЙ вызов
+    # Вебхук сбрасывается внутри run_polling (drop_pending_updates)
+    application.run_polling(drop_pending_updates=True)  # <-- СИНХРОННЫЙ вызов
     # Когда run_polling() завершится (например, Ctrl+C), идёт выход из main().
 
     logger.info("Stopping APScheduler...")
     sched.shutdown()
-def update_all_schedules():
+def update_all_schedules(min_age=settings.SWEEP_MIN_AGE):
     """
     Функция, которую APScheduler будет вызывать раз в час.
     Внимание: теперь она обычная (sync) или внутри можно вызывать .run_until_complete(async...) при необходимости.
+
+    Расписание запрашивается один раз на ученика: родители и сам ученик —
+    подписчики одной копии, и для запроса берётся первый рабочий токен из них.
+    Ученики идут от самых давно обновлённых; обновлённые менее min_age секунд
+    назад пропускаются. Отметка об обновлении коммитится вместе с уроками,
+    так что прерванный (рестартом) проход следующий продолжит с оставшихся.
     """
-    import asyncio
-    import logging
     logger = logging.getLogger(__name__)
 
-    from bot.database import get_db_connection, clear_user_schedule, save_events_in_db
-    from bot.auth import decrypt_token
-    from octodiary.apis import AsyncMobileAPI
-    from octodiary.urls import Systems
-
     logger.info("Начинаем обновление расписаний (BackgroundScheduler)...")
+    sweep_start = time.perf_counter()
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_user_id, encrypted_token FROM users")
-    rows = cur.fetchall()
-    conn.close()
-
+    # Пользователи с мёртвыми токенами (needs_relogin, истёкший срок) не запрашиваются
+    # Токены, сохранённые заново во время прохода, не должны попасть в кэш старыми
+    token_versions = token_cache.versions()
+    rows = repository.submit_read(sql_select_subscribers, int(time.time()) - min_age).result()
+    # Записи расписаний не ждём по одной: они копятся в очереди репозитория
+    # и коммитятся пачками, а результаты собираем в конце прохода
+    writes = []
     # Поскольку внутри хотим вызвать async методы, делаем маленький вспомогательный "event_loop"
     loop = asyncio.new_event_loop()
 
-    for (tg_id, enc_token) in rows:
-        if not enc_token:
-            continue
+    def mark_dead(tg_id):
+        # Токен отвергнут — до нового /login больше не тратим на него запросы
+        repository.submit_write(sql_mark_needs_relogin, tg_id)
+        token_cache.invalidate(tg_id)
+        inc('tokens_dead_total')
+        inc('sweep_users_total', status='dead')
+
+    # student_id -> (person_guid, mes_role, far_refreshed_at, [(tg_id, enc_token), ...]);
+    # порядок вставки — порядок обхода (от давно обновлённых)
+    students = {}
+    for (tg_id, enc_token, student_id, person_guid, mes_role, far_refreshed_at) in rows:
+        with log_context(user_id=tg_id, request_id='sweep'):
+            if not enc_token:
+                continue
+            if first_sync_pending(tg_id):
+                # Первая синхронизация после логина уже идёт в loop бота
+                inc('sweep_users_total', status='skipped')
+                continue
+            if student_id is None:
+                # Ученик ещё не известен (например, после нового /login) — узнаём у МЭШ
+                try:
+                    identity = loop.run_until_complete(resolve_identity(tg_id, new_api(get_token(tg_id, enc_token, token_versions.get(tg_id, 0)))))
+                except Exception as e:
+                    if is_auth_error(e):
+                        mark_dead(tg_id)
+                    else:
+                        inc('sweep_users_total', status='error')
+                    logger.warning("Ошибка при определении ученика user_id=%s: %s", tg_id, e)
+                    continue
+                if not identity:
+                    logger.warning("Нет профиля ученика у %s. Пропускаем.", tg_id)
+                    inc('sweep_users_total', status='skipped')
+                    continue
+                student_id, person_guid, mes_role = identity
+            students.setdefault(student_id, (person_guid, mes_role, far_refreshed_at, []))[3].append((tg_id, enc_token))
+
+    # Прогресс прохода — для /stats и /metrics
+    set_gauge('sweep_running', 1)
+    for left, (student_id, (person_guid, mes_role, far_refreshed_at, subscribers)) in enumerate(students.items()):
+        set_gauge('sweep_students_left', len(students) - left)
+        # Ближний горизонт — каждый раз, дальний — раз в HORIZON_FAR_REFRESH_HOURS
+        begin_date, end_date, far = sweep_range(far_refreshed_at)
+        events = None
+        for n, (tg_id, enc_token) in enumerate(subscribers, 1):
+            # Все логи внутри помечаются user_id пользователя и request_id=sweep
+            with log_context(user_id=tg_id, request_id='sweep'):
+                try:
+                    mesh_api = new_api(get_token(tg_id, enc_token, token_versions.get(tg_id, 0)))
+                    # вызываем get_events в нашем временном event loop
+                    events = loop.run_until_complete(mesh_api.get_events(
+                        person_id=person_guid,
+                        mes_role=mes_role,
+                        begin_date=begin_date,
+                        end_date=end_date
+                    ))
+                    break
+                except Exception as e:
+                    logger.warning("Ошибка при обновлении расписания user_id=%s: %s", tg_id, e)
+                    if not is_auth_error(e):
+                        # МЭШ недоступен — другие токены того же ученика не помогут
+                        break
+                    # Пробуем следующего подписчика ученика
+                    mark_dead(tg_id)
+
+        if events:
+            # Остальным подписчикам ученика запрос не понадобился
+            inc('sweep_users_total', len(subscribers) - n, status='shared')
+            writes.append((student_id, repository.submit_write(
+                sql_refresh_schedule, student_id, begin_date, end_date, events, far)))
+        else:
+            inc('sweep_students_total', status='error')
+
+    loop.close()
+
+    for student_id, future in writes:
         try:
-            token_data = decrypt_token(enc_token)
-            mesh_api = AsyncMobileAPI(system=Systems.MES)
-            mesh_api.token = token_data
-
-            async def fetch_events():
-                profiles = await mesh_api.get_users_profile_info()
-                if not profiles:
-                    logger.warning(f"Нет профилей у {tg_id}. Пропускаем.")
-                    return None
-
-                first_profile = profiles[0]
-                fam = await mesh_api.get_family_profile(profile_id=first_profile.id)
-                if not fam.children:
-                    logger.warning(f"У пользователя {tg_id} нет children. Пропускаем.")
-                    return None
-
-                child = fam.children[0]
-                person_guid = child.contingent_guid
-                mes_role = fam.profile.type
-
-                begin_date = date.today() - timedelta(days=10)
-                end_date = date.today() + timedelta(days=10)
-
-                events = await mesh_api.get_events(
-                    person_id=person_guid,
-                    mes_role=mes_role,
-                    begin_date=begin_date,
-                    end_date=end_date
-                )
-                return events
-
-            # вызываем корутину fetch_events() в нашем временном event loop
-            events = loop.run_until_complete(fetch_events())
-            if events:
-                clear_user_schedule(tg_id)
-                save_events_in_db(tg_id, events)
-                logger.info(f"Успешно обновили расписание user_id={tg_id}.")
+            changed = future.result()
+            inc('sweep_students_total', status='ok' if changed else 'unchanged')
+            logger.info("Успешно обновили расписание student_id=%s.", student_id, extra=SAMPLED)
         except Exception as e:
-            logger.warning(f"Ошибка при обновлении расписания user_id={tg_id}: {e}")
+            inc('sweep_students_total', status='error')
+            logger.warning("Ошибка при сохранении расписания student_id=%s: %s", student_id, e)
 
-    loop.close()
-    logger.info("Глобальное обновление расписаний завершено.")
+    set_gauge('sweep_students_left', 0)
+    set_gauge('sweep_running', 0)
+    set_gauge('sweep_last_finished_timestamp', int(time.time()))
+    observe('sweep_seconds', time.perf_counter() - sweep_start)
+    logger.info("Глобальное обновление расписаний завершено: %s учеников, %s подписчиков.",
+                len(students), sum(len(s[3]) for s in students.values()))
 
 if __name__ == "__main__":
     main()
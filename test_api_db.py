@@ -17,7 +17,7 @@ from typing import Optional, Generic, TypeVar
 from pydantic import BaseModel
 
 # Из вашего бота:
-from bot.auth import load_token_db, decrypt_token
+from bot.auth import load_token_db, decrypt_token, new_api
 from bot.database import get_db_connection
 # Из octodiary:
 from octodiary.apis import AsyncMobileAPI
@@ -177,9 +177,8 @@ async def test_main():
         logger.error(f"Ошибка расшифровки: {e}")
         return
 
-    # 3) Создаём AsyncMobileAPI
-    mobile_api = AsyncMobileAPI(system=Systems.MES)
-    mobile_api.token = token_data
+    # 3) Создаём AsyncMobileAPI (token_data — строка или словарь из token_bundle)
+    mobile_api = new_api(token_data)
     logger.info("mobile_api сконфигурирован.")
 
     # 4) fake_apis
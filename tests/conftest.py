@@ -0,0 +1,70 @@
+# tests/conftest.py
+
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+# config.settings читает окружение при импорте: до любых импортов bot.*
+# уводим БД и файл ключей во временный каталог
+_tmp = tempfile.mkdtemp(prefix='meshinfo-tests-')
+os.environ.setdefault('DATABASE_PATH', os.path.join(_tmp, 'users.db'))
+os.environ.setdefault('ENCRYPTION_KEY_PATH', os.path.join(_tmp, 'encryption.key'))
+
+from bot import database  # noqa: E402
+from bot.cache import token_cache, feed_user_cache  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """
+    Путь к новой БД с актуальной схемой; get_db_connection смотрит на неё.
+    """
+    path = str(tmp_path / 'users.db')
+    monkeypatch.setattr(database, 'DATABASE_PATH', path)
+    database.forget_lookups()
+    token_cache.clear()
+    feed_user_cache.clear()
+    database.init_db()
+    yield path
+    database.forget_lookups()
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = sqlite3.connect(db_path)
+    yield conn
+    conn.close()
+
+
+def make_event(id, day, start='08:30', finish='09:15', subject='Математика', room='101',
+               theme=None, homework=None, materials=None):
+    """
+    Урок в том виде, в каком его отдаёт get_events (octodiary).
+    """
+    return SimpleNamespace(
+        id=id,
+        subject_name=subject,
+        start_at=datetime.fromisoformat(f'{day}T{start}') if day else None,
+        finish_at=datetime.fromisoformat(f'{day}T{finish}') if day else None,
+        room_number=room,
+        lesson_theme=theme,
+        homework=SimpleNamespace(descriptions=homework) if homework is not None else None,
+        materials=materials,
+    )
+
+
+@pytest.fixture
+def events():
+    """
+    Фабрика ответа get_events: events(make_event(...), ...).
+    """
+    return lambda *items: SimpleNamespace(response=list(items))
+
+
+@pytest.fixture
+def event():
+    return make_event
@@ -0,0 +1,33 @@
+# tests/test_bench.py
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(module, *args):
+    # Отдельный процесс: бенчмарк настраивает окружение до импорта bot.*
+    return subprocess.run([sys.executable, '-m', module, *args], cwd=ROOT,
+                          capture_output=True, text=True, timeout=120, check=True).stdout
+
+
+def test_bench_smoke(tmp_path):
+    out = _run('bench.run', '--sessions', '4', '--concurrency', '2', '--sweep-users', '8',
+               '--subscribers', '2', '--workdir', str(tmp_path / 'new-dir'))
+    report = json.loads(out)
+    assert report['sessions']['errors'] == 0
+    # Проход запрашивает расписание один раз на ученика, а не на каждого подписчика
+    assert report['sweep']['students'] == 4
+    assert report['sweep']['mes_calls'].get('events') == 4
+
+
+def test_load_smoke(tmp_path):
+    out = _run('bench.load', '--users', '10', '--rate', '20', '--duration', '1', '--report-every', '1',
+               '--sweep-interval', '1', '--mes-latency', '0', '--mes-error-rate', '0', '--tg-latency', '0',
+               '--workdir', str(tmp_path))
+    [summary] = [json.loads(line) for line in out.splitlines() if line.startswith('{"summary"')]
+    assert summary['processed'] > 0
+    assert summary['errors'] == {} and summary['dropped'] == 0
@@ -0,0 +1,48 @@
+# tests/test_cache.py
+
+from bot import auth
+from bot.cache import TTLCache, token_cache
+from bot.database import sql_upsert_token
+
+
+def test_ttl_and_lru_eviction(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('bot.cache.time.monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # вытесняется давно не читанный b
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    now[0] += 10
+    assert cache.get('a') is None
+
+
+def test_stale_set_is_skipped_only_for_its_key():
+    cache = TTLCache(maxsize=10, ttl=60)
+    version_a, version_b = cache.version('a'), cache.version('b')
+    cache.invalidate('a')  # 'a' сохранили заново, пока его читали
+    cache.set('a', 'old', version_a)
+    cache.set('b', 'fresh', version_b)
+    assert cache.get('a') is None
+    assert cache.get('b') == 'fresh'
+    cache.set('a', 'new', cache.version('a'))
+    assert cache.get('a') == 'new'
+
+
+def test_sweep_snapshot_survives_unrelated_logins(conn):
+    enc_1 = auth.encrypt_token({'token': 'one'})
+    enc_2 = auth.encrypt_token({'token': 'two'})
+    sql_upsert_token(conn, 1, enc_1, 'key')
+    sql_upsert_token(conn, 2, enc_2, 'key')
+    conn.commit()
+    versions = token_cache.versions()
+
+    # Во время прохода пользователь 2 заново вошёл
+    auth.save_token_db(2, auth.encrypt_token({'token': 'two-new'}))
+    assert auth.get_token(1, enc_1, versions.get(1, 0)) == {'token': 'one'}
+    assert auth.get_token(2, enc_2, versions.get(2, 0)) == {'token': 'two'}
+    assert token_cache.get(1) == {'token': 'one'}
+    # Старый токен 2 в кэш не попал — следующее чтение берёт новый из БД
+    assert token_cache.get(2) is None
+    assert auth.get_token(2) == {'token': 'two-new'}
@@ -0,0 +1,55 @@
+# tests/test_digest.py
+
+from datetime import date, datetime
+
+from bot.database import (
+    day_number,
+    sql_mark_digest_sent,
+    sql_select_due_digests,
+    sql_set_digest,
+    sql_upsert_identity,
+    sql_upsert_token,
+)
+
+NOW = datetime(2025, 3, 5, 15, 0)
+TODAY, TOMORROW = date(2025, 3, 5), date(2025, 3, 6)
+
+
+def _user(conn, tg=1):
+    sql_upsert_token(conn, tg, b'token', 'key')
+    sql_upsert_identity(conn, tg, tg, f'guid-{tg}', 'student')
+
+
+def _due(conn, minute, day):
+    return [tg for tg, _ in sql_select_due_digests(conn, minute, day_number(day))]
+
+
+def test_first_digest_day_matches_due_digests(conn):
+    _user(conn)
+    # 07:00 в 15:00 уже прошло — первая сводка завтра
+    assert sql_set_digest(conn, 1, 7 * 60, NOW) == TOMORROW
+    assert _due(conn, 15 * 60, TODAY) == []
+    assert _due(conn, 7 * 60, TOMORROW) == [1]
+
+    # 18:00 ещё впереди — сегодня
+    _user(conn, 2)
+    assert sql_set_digest(conn, 2, 18 * 60, NOW) == TODAY
+    assert _due(conn, 18 * 60, TODAY) == [2]
+
+    # Сегодняшний день уже отмечен — перенос на вечер тоже сдвигает на завтра,
+    # и ответ об этом говорит
+    assert sql_set_digest(conn, 1, 18 * 60, NOW) == TOMORROW
+    assert _due(conn, 18 * 60, TODAY) == [2]
+
+
+def test_digest_already_sent_today_starts_tomorrow(conn):
+    _user(conn)
+    sql_set_digest(conn, 1, 7 * 60, datetime(2025, 3, 5, 6, 0))
+    sql_mark_digest_sent(conn, [1], day_number(TODAY))
+    # Перенос на вечер не присылает вторую сводку за сегодня
+    assert sql_set_digest(conn, 1, 20 * 60, NOW) == TOMORROW
+    assert _due(conn, 20 * 60, TODAY) == []
+
+
+def test_unknown_user(conn):
+    assert sql_set_digest(conn, 404, 7 * 60, NOW) is None
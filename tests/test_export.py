@@ -0,0 +1,84 @@
+# tests/test_export.py
+
+import csv
+import os
+import re
+from datetime import date
+
+from bot.database import sql_upsert_identity, sql_replace_schedule, sql_select_schedule_version
+from bot.export import CSV_HEADER, build_export, ics_lines
+
+
+def _row(date_str='2025-03-03', lesson_id=11, theme='Дроби'):
+    return (date_str, lesson_id, 'Математика', '08:30', '09:15', 'Параграф 12', '101', theme)
+
+
+def _uids(rows, student_id):
+    return [line for line in ics_lines(rows, student_id) if line.startswith('UID:')]
+
+
+def test_uid_does_not_expose_student_id():
+    [uid] = _uids([_row()], 4242)
+    assert re.fullmatch(r'UID:[0-9a-f]{32}@meshinfo\r\n', uid)
+    # Стабилен для того же урока, различается у разных учеников и дней
+    assert _uids([_row()], 4242) == [uid]
+    assert _uids([_row()], 4243) != [uid]
+    assert _uids([_row('2025-03-04')], 4242) != [uid]
+
+
+def test_escape_and_fold():
+    long_theme = 'Тема; с запятой, и \\ слешем\n' + 'ж' * 60
+    lines = list(ics_lines([_row(theme=long_theme)], 1))
+    [summary] = [line for line in lines if line.startswith('SUMMARY:')]
+    assert summary == 'SUMMARY:Математика\r\n'
+    [description] = [line for line in lines if line.startswith('DESCRIPTION:')]
+    physical = description.split('\r\n')[:-1]
+    assert len(physical) > 1
+    assert all(len(part.encode('utf-8')) <= 75 for part in physical)
+    assert all(part.startswith(' ') for part in physical[1:])
+    # Склейка обратно (RFC 5545: CRLF + пробел убираются) — без разрезанных символов
+    unfolded = description.replace('\r\n ', '')
+    assert unfolded == ('DESCRIPTION:Тема: Тема\\; с запятой\\, и \\\\ слешем\\n' + 'ж' * 60
+                        + '\\nДЗ: Параграф 12\r\n')
+
+
+def test_calendar_structure_and_undated_rows():
+    lines = list(ics_lines([_row(), _row(date_str=''), _row('2025-03-04', 12)], 1))
+    assert lines[0] == 'BEGIN:VCALENDAR\r\n' and lines[-1] == 'END:VCALENDAR\r\n'
+    assert lines.count('BEGIN:VEVENT\r\n') == 2
+    assert 'DTSTART;TZID=Europe/Moscow:20250303T083000\r\n' in lines
+    assert 'DTEND;TZID=Europe/Moscow:20250303T091500\r\n' in lines
+    all_day = ('2025-03-05', 13, 'Экскурсия', '', '', None, '', None)
+    assert 'DTSTART;VALUE=DATE:20250305\r\n' in ics_lines([all_day], 1)
+
+
+def test_build_export_csv_and_ics(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    sql_replace_schedule(conn, student, date(2025, 3, 3), date(2025, 3, 3), events(
+        event(2, '2025-03-03', '09:25', '10:10', subject='История', room='', theme='Реформы, Петра'),
+        event(1, '2025-03-03', theme='Дроби', homework=['Параграф 12', 'Упр. 3']),
+    ))
+    conn.commit()
+
+    path, version = build_export(student, 'csv')
+    try:
+        with open(path, encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+    finally:
+        os.remove(path)
+    assert version == sql_select_schedule_version(conn, student)
+    assert tuple(rows[0]) == CSV_HEADER
+    assert rows[1:] == [
+        ['2025-03-03', '08:30', '09:15', 'Математика', '101', 'Дроби', 'Параграф 12\nУпр. 3'],
+        ['2025-03-03', '09:25', '10:10', 'История', '', 'Реформы, Петра', ''],
+    ]
+
+    path, _ = build_export(student, 'ics')
+    try:
+        with open(path, encoding='utf-8', newline='') as f:
+            body = f.read()
+    finally:
+        os.remove(path)
+    assert body.count('BEGIN:VEVENT') == 2
+    assert 'DESCRIPTION:Тема: Реформы\\, Петра\r\n' in body
+    assert '\n' not in body.replace('\r\n', '')
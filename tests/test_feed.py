@@ -0,0 +1,65 @@
+# tests/test_feed.py
+
+import threading
+import urllib.error
+import urllib.request
+from datetime import date
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from bot import feed
+from bot.database import sql_upsert_token, sql_upsert_identity, sql_replace_schedule, sql_ensure_feed_token
+
+DAY = date(2025, 3, 3)
+
+
+@pytest.fixture
+def server(db_path):
+    feed._versions.clear()
+    feed._bodies.clear()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), feed._FeedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def feed_token(conn, events, event):
+    sql_upsert_token(conn, 1, b'token', 'key')
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    sql_replace_schedule(conn, student, DAY, DAY, events(event(1, '2025-03-03', theme='Дроби')))
+    token = sql_ensure_feed_token(conn, 1)
+    conn.commit()
+    return token
+
+
+def _get(url, **headers):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, b''
+
+
+def test_matching_if_none_match_gets_304(server, feed_token):
+    url = f'{server}/feed/{feed_token}.ics'
+    status, headers, body = _get(url)
+    assert status == 200
+    assert b'BEGIN:VCALENDAR' in body and 'Дроби'.encode() in body
+    tag = headers['ETag']
+    assert '"' in tag and str(feed_token) not in tag
+
+    status, headers, body = _get(url, **{'If-None-Match': tag})
+    assert (status, headers['ETag'], body) == (304, tag, b'')
+    assert _get(url, **{'If-None-Match': f'W/{tag}'})[0] == 304
+    assert _get(url, **{'If-None-Match': '"other"'})[0] == 200
+
+
+def test_reset_token_stops_serving_old_link(server, feed_token, conn):
+    assert _get(f'{server}/feed/{feed_token}.ics')[0] == 200
+    new_token = sql_ensure_feed_token(conn, 1, reset=True)
+    conn.commit()
+    assert _get(f'{server}/feed/{feed_token}.ics')[0] == 404
+    assert _get(f'{server}/feed/{new_token}.ics')[0] == 200
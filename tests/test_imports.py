@@ -0,0 +1,21 @@
+# tests/test_imports.py
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_startup_does_not_load_heavy_dependencies(tmp_path):
+    # Отдельный процесс: в этом тесты уже могли загрузить octodiary/Fernet
+    code = (
+        'import sys, main; '
+        "print(sorted(m for m in ('octodiary', 'cryptography.fernet', 'fake_useragent') if m in sys.modules))"
+    )
+    env = dict(os.environ, DATABASE_PATH=str(tmp_path / 'users.db'),
+               ENCRYPTION_KEY_PATH=str(tmp_path / 'encryption.key'))
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
+    assert not (tmp_path / 'encryption.key').exists()
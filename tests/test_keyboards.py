@@ -0,0 +1,42 @@
+# tests/test_keyboards.py
+
+from datetime import date
+
+from bot import utils
+from bot.lessons import Lesson
+from bot.router import callback_data
+from bot.utils import generate_calendar_keyboard, generate_lessons_keyboard, precompute_calendar_keyboards
+
+
+def _buttons(markup):
+    return [[(b.text, b.callback_data) for b in row] for row in markup.inline_keyboard]
+
+
+def test_calendar_keyboards_are_built_once_per_week(monkeypatch):
+    monday = date(2025, 3, 3)
+    monkeypatch.setattr(utils, 'current_week_monday', lambda today=None: monday)
+    keyboards = precompute_calendar_keyboards(monday)
+    assert len(keyboards) == 21
+    assert generate_calendar_keyboard(7) is keyboards[7]
+
+    header, dates, nav = _buttons(keyboards[7])
+    assert [text for text, _ in header] == ['Пн', 'Вт', 'Ср', 'Чт', 'Пт']
+    assert dates[0] == ('3 мар', callback_data('d', 7))
+    assert nav == [('« Назад', callback_data('p', 7)), ('Вперёд »', callback_data('n', 7))]
+
+    # Неделя сменилась — клавиатуры перестраиваются
+    monkeypatch.setattr(utils, 'current_week_monday', lambda today=None: date(2025, 3, 10))
+    assert _buttons(generate_calendar_keyboard(7))[1][0] == ('10 мар', callback_data('d', 7))
+
+
+def test_lesson_keyboard_reused_for_same_day():
+    lessons = [Lesson(1, 'Математика', '08:30', '09:15'), Lesson(2, 'История', '', '')]
+    markup = generate_lessons_keyboard(lessons)
+    assert _buttons(markup) == [
+        [('08:30-09:15 Математика', callback_data('l', 0))],
+        [('--:-----:-- История', callback_data('l', 1))],
+        [('Вернуться к расписанию', callback_data('bs'))],
+    ]
+    # У одноклассника те же уроки с другими id — та же клавиатура
+    same = [Lesson(7, 'Математика', '08:30', '09:15'), Lesson(8, 'История', '', '')]
+    assert generate_lessons_keyboard(same) is markup
@@ -0,0 +1,39 @@
+# tests/test_lessons.py
+
+from datetime import date
+
+from bot.database import sql_upsert_identity, sql_replace_schedule, sql_select_lessons
+from bot.lessons import Lesson, pack_event, unpack_payload
+
+
+def _fields(lesson):
+    return tuple(getattr(lesson, name) for name in Lesson.__slots__)
+
+
+def test_pack_unpack_round_trip(event):
+    short = event(1, '2025-03-03', homework=['Параграф 12'], materials=[{'uuid': 'a'}])
+    payload = pack_event(short)
+    assert payload.startswith(b'[')  # короткое ДЗ хранится без сжатия
+    assert unpack_payload(payload) == (('Параграф 12',), 1)
+
+    long = event(2, '2025-03-03', homework=['Прочитать главу 3. ' * 40, 'Выучить стих'])
+    payload = pack_event(long)
+    assert payload[0] == 0x78  # длинное сжимается
+    assert unpack_payload(payload) == (('Прочитать главу 3. ' * 40, 'Выучить стих'), 0)
+
+
+def test_empty_payload_and_legacy_rows(event):
+    assert pack_event(event(1, '2025-03-03')) is None
+    assert pack_event(event(1, '2025-03-03', homework=[], materials=[])) is None
+    # Строки, записанные до появления payload
+    assert unpack_payload(None, ' Параграф 12 ') == (('Параграф 12',), 0)
+    assert unpack_payload(None, None) == ((), 0)
+
+
+def test_stored_lesson_matches_live_one(conn, events, event):
+    live = event(7, '2025-03-03', theme='Дроби', homework=['Параграф 12', 'Упр. 3'],
+                      materials=[{'uuid': 'a'}, {'uuid': 'b'}])
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    sql_replace_schedule(conn, student, date(2025, 3, 3), date(2025, 3, 3), events(live))
+    [stored] = sql_select_lessons(conn, student, '2025-03-03')
+    assert _fields(stored) == _fields(Lesson.from_event(live))
@@ -0,0 +1,37 @@
+# tests/test_metrics.py
+
+import pytest
+
+from bot.metrics import BUCKETS, inc, observe, render, snapshot, timed
+
+
+def test_render_prometheus_text():
+    inc('test_events_total', route='a"b')
+    inc('test_events_total', 2, route='a"b')
+    observe('test_latency_seconds', BUCKETS[0] / 2)
+    observe('test_latency_seconds', BUCKETS[-1] * 2)
+    lines = render().splitlines()
+
+    assert '# TYPE test_events_total counter' in lines
+    assert 'test_events_total{route="a\\"b"} 3' in lines
+    assert '# TYPE test_latency_seconds histogram' in lines
+    assert f'test_latency_seconds_bucket{{le="{BUCKETS[0]}"}} 1' in lines
+    # Бакеты накопительные, наблюдение сверх последнего — только в +Inf
+    assert f'test_latency_seconds_bucket{{le="{BUCKETS[-1]}"}} 1' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'test_latency_seconds_count 2' in lines
+
+
+def test_timed_records_status():
+    @timed('test_call_seconds')
+    def work(fail):
+        if fail:
+            raise RuntimeError
+        return 'ok'
+
+    assert work(False) == 'ok'
+    with pytest.raises(RuntimeError):
+        work(True)
+    histograms = snapshot()['histograms']
+    assert histograms[('test_call_seconds', (('fn', 'work'), ('status', 'ok')))][0] == 1
+    assert histograms[('test_call_seconds', (('fn', 'work'), ('status', 'error')))][0] == 1
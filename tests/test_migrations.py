@@ -0,0 +1,84 @@
+# tests/test_migrations.py
+
+import sqlite3
+
+import pytest
+
+from bot import database
+from bot.database import (
+    MIGRATIONS,
+    init_db,
+    fts_query,
+    sql_search,
+    sql_select_day,
+    sql_select_student_id,
+    sql_upsert_identity,
+)
+
+
+@pytest.fixture
+def empty_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'users.db')
+    monkeypatch.setattr(database, 'DATABASE_PATH', path)
+    database.forget_lookups()
+    yield path
+    database.forget_lookups()
+
+
+def _tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_empty_db_gets_latest_schema(empty_path):
+    init_db()
+    init_db()  # повторный запуск — ничего не делает
+    conn = sqlite3.connect(empty_path)
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert {'users', 'schedule', 'identity', 'students', 'subjects', 'rooms', 'slots',
+                'schedule_fts'} <= _tables(conn)
+    finally:
+        conn.close()
+
+
+def test_baseline_db_keeps_users_schedules(empty_path):
+    # Схема и данные в том виде, в каком их оставляла исходная версия бота
+    conn = sqlite3.connect(empty_path)
+    conn.executescript('''
+        CREATE TABLE users (telegram_user_id INTEGER PRIMARY KEY, encrypted_token BLOB);
+        CREATE TABLE schedule (
+            user_id INTEGER, date TEXT, lesson_id INTEGER, subject_name TEXT,
+            start_time TEXT, end_time TEXT, homework_text TEXT, room_number TEXT, lesson_theme TEXT
+        );
+        INSERT INTO users VALUES (1, x'00');
+        INSERT INTO schedule VALUES
+            (1, '2025-03-03', 11, 'Математика', '08:30', '09:15', 'Параграф 12', '101', 'Дроби'),
+            (1, '2025-03-03', 12, 'История', '09:25', '10:10', NULL, '205', 'Реформы Петра'),
+            (99, '2025-03-03', 13, 'Химия', '08:30', '09:15', 'Параграф 1', '301', NULL);
+    ''')
+    conn.commit()
+
+    init_db()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+
+    # Ученик пользователя 1 ещё не известен — уроки под временным учеником
+    placeholder = sql_select_student_id(conn, 1)
+    assert placeholder is not None
+    day = sql_select_day(conn, placeholder, '2025-03-03')
+    assert [(row[0], row[1], row[2], row[5]) for row in day] == [
+        (11, 'Математика', '08:30', '101'), (12, 'История', '09:25', '205'),
+    ]
+    assert [row[2] for row in sql_search(conn, placeholder, fts_query('парагр'), 10)] == ['Математика']
+    # Уроки пользователя, которого нет в users, не переносятся
+    assert conn.execute('SELECT COUNT(*) FROM schedule').fetchone()[0] == 2
+
+    # Когда ученик определился, расписание переходит к нему
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    conn.commit()
+    assert student != placeholder
+    assert sql_select_student_id(conn, 1) == student
+    assert len(sql_select_day(conn, student, '2025-03-03')) == 2
+    assert conn.execute(
+        "SELECT COUNT(*) FROM students WHERE person_guid LIKE 'user:%'"
+    ).fetchone()[0] == 0
+    conn.close()
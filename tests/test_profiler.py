@@ -0,0 +1,37 @@
+# tests/test_profiler.py
+
+import threading
+import time
+
+from bot.profiler import SamplingProfiler
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_idle_threads_are_reported_separately():
+    stop = threading.Event()
+    busy = threading.Thread(target=_busy_loop, args=(stop,), name='test-busy')
+    idle = threading.Thread(target=stop.wait, name='test-idle')
+    busy.start()
+    idle.start()
+    profiler = SamplingProfiler(interval=0.002)
+    try:
+        assert profiler.start()
+        assert not profiler.start()  # одновременно — только одно профилирование
+        time.sleep(0.3)
+        report = profiler.stop()
+    finally:
+        stop.set()
+        busy.join()
+        idle.join()
+
+    assert profiler.idle['test-idle'] > 0
+    assert not any(stack.startswith('test-idle;') for stack in profiler.stacks)
+    assert any(stack.startswith('test-busy;') for stack in profiler.stacks)
+    assert any(fn.startswith('_busy_loop ') for fn in profiler.total_counts)
+    idle_section = report.split('Простой', 1)[1].split('Стеки', 1)[0]
+    assert 'test-idle' in idle_section
+    assert profiler.stop() is None
@@ -0,0 +1,87 @@
+# tests/test_repository.py
+
+import asyncio
+import threading
+
+import pytest
+
+from bot.database import subjects
+from bot.metrics import snapshot
+from bot.repository import Repository
+
+
+def _commits():
+    return snapshot()['counters'].get(('db_commits_total', (('status', 'ok'),)), 0)
+
+
+def _insert(conn, tg):
+    conn.execute('INSERT INTO users (telegram_user_id) VALUES (?)', (tg,))
+    return tg
+
+
+def _fail(conn, tg):
+    conn.execute('INSERT INTO users (telegram_user_id) VALUES (?)', (tg,))
+    raise ValueError('сбой записи')
+
+
+def _users(conn):
+    return [row[0] for row in conn.execute('SELECT telegram_user_id FROM users ORDER BY 1')]
+
+
+@pytest.fixture
+def repository(db_path):
+    repository = Repository(db_path, window_ms=200)
+    yield repository
+    repository.close()
+
+
+def test_writes_are_group_committed(repository, conn):
+    # Поток БД занят чтением, пока в очередь не встанут все записи
+    gate = threading.Event()
+    blocker = repository.submit_read(lambda conn: gate.wait(5))
+    commits = _commits()
+    futures = [repository.submit_write(_insert, tg) for tg in range(1, 6)]
+    gate.set()
+    assert blocker.result() is True
+    assert [future.result(5) for future in futures] == [1, 2, 3, 4, 5]
+    assert _commits() == commits + 1
+    assert _users(conn) == [1, 2, 3, 4, 5]
+
+
+def test_failed_write_rolls_back_only_itself(repository, conn):
+    gate = threading.Event()
+    repository.submit_read(lambda conn: gate.wait(5))
+    ok_before = repository.submit_write(_insert, 1)
+    failed = repository.submit_write(_fail, 2)
+    ok_after = repository.submit_write(_insert, 3)
+    gate.set()
+
+    assert ok_before.result(5) == 1 and ok_after.result(5) == 3
+    with pytest.raises(ValueError):
+        failed.result(5)
+    assert _users(conn) == [1, 3]
+
+
+def test_async_api_and_read_after_write(repository):
+    async def scenario():
+        await repository.write(_insert, 7)
+        return await repository.read(_users)
+
+    assert asyncio.run(scenario()) == [7]
+
+
+def test_rollback_forgets_uncommitted_lookup_ids(repository, conn):
+    def encode_and_fail(conn):
+        subjects.encode(conn, 'Астрономия')
+        raise ValueError('сбой после вставки в справочник')
+
+    def encode(conn):
+        return subjects.encode(conn, 'Астрономия')
+
+    with pytest.raises(ValueError):
+        repository.submit_write(encode_and_fail).result(5)
+    # id из откатившейся транзакции в кэше не остался
+    subject_id = repository.submit_write(encode).result(5)
+    assert conn.execute(
+        'SELECT name FROM subjects WHERE subject_id = ?', (subject_id,)
+    ).fetchone() == ('Астрономия',)
@@ -0,0 +1,67 @@
+# tests/test_router.py
+
+import asyncio
+from types import SimpleNamespace
+
+from bot.router import CallbackRouter, callback_data
+
+
+def _router(calls):
+    async def day(update, context, n):
+        calls.append(('d', n))
+
+    async def back(update, context):
+        calls.append(('bs',))
+
+    router = CallbackRouter()
+    router.add('d', day, int)
+    router.add('bs', back)
+    router.legacy('cal21_day', 'd', prefix=True)
+    router.legacy('back_to_schedule', 'bs')
+    return router
+
+
+def _dispatch(router, data):
+    answers = []
+
+    async def answer(text=None):
+        answers.append(text)
+
+    update = SimpleNamespace(callback_query=SimpleNamespace(data=data, answer=answer))
+    asyncio.run(router.dispatch(update, None))
+    return answers
+
+
+def test_callback_data_round_trip():
+    router = _router([])
+    assert callback_data('d', 7) == '1.d.7'
+    assert router.parse(callback_data('d', 7)) == ('d', ['7'])
+    assert router.parse(callback_data('bs')) == ('bs', [])
+
+
+def test_legacy_buttons_are_mapped():
+    router = _router([])
+    assert router.parse('cal21_day_7') == ('d', ['7'])
+    assert router.parse('back_to_schedule') == ('bs', [])
+
+
+def test_unknown_formats_are_not_parsed():
+    router = _router([])
+    for data in ('', 'cal22_day_7', 'lesson', '0.d.7', 'мусор'):
+        assert router.parse(data) == (None, None)
+
+
+def test_dispatch_calls_handler_with_typed_args():
+    calls = []
+    router = _router(calls)
+    assert _dispatch(router, callback_data('d', 7)) == []
+    assert _dispatch(router, 'cal21_day_8') == []
+    assert calls == [('d', 7), ('d', 8)]
+
+
+def test_dispatch_rejects_old_or_garbled_data():
+    calls = []
+    router = _router(calls)
+    for data in ('0.d.7', '1.d.x', '1.d', '1.d.7.8', '1.zz.7', 'cal21_day_x', 'garbage'):
+        assert _dispatch(router, data) == [router.fallback_text], data
+    assert calls == []
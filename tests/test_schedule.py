@@ -0,0 +1,79 @@
+# tests/test_schedule.py
+
+from datetime import date, timedelta
+
+from bot.database import (
+    prune_schedule,
+    sql_upsert_identity,
+    sql_replace_schedule,
+    sql_select_schedule_version,
+    sql_select_day,
+)
+from bot.horizon import full_range, near_range, sweep_range
+
+DAY = date(2025, 3, 3)
+
+
+def _lessons(event):
+    return [
+        event(1, '2025-03-03', homework=['Параграф 12']),
+        event(2, '2025-03-03', '09:25', '10:10', subject='История', materials=[{'uuid': 'm'}]),
+    ]
+
+
+def test_identical_refresh_is_not_a_change(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    assert sql_replace_schedule(conn, student, DAY, DAY, events(*_lessons(event)))
+    version = sql_select_schedule_version(conn, student)
+    rowids = conn.execute('SELECT rowid FROM schedule ORDER BY rowid').fetchall()
+
+    # Тот же ответ в другом порядке — ни записи, ни новой версии
+    assert not sql_replace_schedule(conn, student, DAY, DAY, events(*reversed(_lessons(event))))
+    assert sql_select_schedule_version(conn, student) == version
+    assert conn.execute('SELECT rowid FROM schedule ORDER BY rowid').fetchall() == rowids
+
+
+def test_changed_homework_replaces_range(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    sql_replace_schedule(conn, student, DAY, DAY, events(*_lessons(event)))
+    version = sql_select_schedule_version(conn, student)
+
+    lessons = _lessons(event)
+    lessons[0].homework.descriptions = ['Параграф 13']
+    assert sql_replace_schedule(conn, student, DAY, DAY, events(*lessons))
+    assert sql_select_schedule_version(conn, student) == version + 1
+    assert [row[4] for row in sql_select_day(conn, student, '2025-03-03')] == ['Параграф 13', None]
+
+
+def test_history_outside_range_is_kept(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    sql_replace_schedule(conn, student, date(2025, 3, 1), DAY, events(
+        event(1, '2025-03-01'), *_lessons(event),
+    ))
+    # В новом ответе 1 марта уже нет, но обновляется только 3 марта
+    assert not sql_replace_schedule(conn, student, DAY, DAY, events(*_lessons(event)))
+    assert len(sql_select_day(conn, student, '2025-03-01')) == 1
+
+
+def test_sweep_range_far_horizon_once_per_period():
+    today = date(2025, 3, 5)
+    assert sweep_range(None, today, now=1000) == (*full_range(today), True)
+    assert sweep_range(1000 - 3600, today, now=1000) == (*near_range(today), False)
+    assert sweep_range(1000 - 25 * 3600, today, now=1000) == (*full_range(today), True)
+
+
+def test_prune_keeps_recent_history_in_batches(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    today = date.today()
+    old, recent = today - timedelta(days=200), today - timedelta(days=10)
+    sql_replace_schedule(conn, student, old, recent, events(
+        *(event(n, old.isoformat(), f'0{n}:00', f'0{n}:45') for n in range(1, 6)),
+        event(9, recent.isoformat()),
+    ))
+    conn.commit()
+    version = sql_select_schedule_version(conn, student)
+
+    assert prune_schedule(retention_days=180, batch_size=2) == 5
+    assert len(sql_select_day(conn, student, recent.isoformat())) == 1
+    assert conn.execute('SELECT COUNT(*) FROM schedule').fetchone()[0] == 1
+    assert sql_select_schedule_version(conn, student) == version + 1
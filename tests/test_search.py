@@ -0,0 +1,36 @@
+# tests/test_search.py
+
+from datetime import date
+
+from bot.database import fts_query, sql_search, sql_upsert_identity, sql_replace_schedule
+
+
+def test_fts_query_prefix_and_quoting():
+    assert fts_query('парагр упр') == '"парагр"* AND "упр"*'
+    assert fts_query('  "OR" NEAR ') == '"""OR"""* AND "NEAR"*'
+    assert fts_query('" ""') == ''
+    assert fts_query('   ') == ''
+
+
+def test_search_matches_by_prefix_within_student(conn, events, event):
+    student = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    other = sql_upsert_identity(conn, 2, 20, 'guid-2', 'student')
+    day = date(2025, 3, 3)
+    sql_replace_schedule(conn, student, day, day, events(
+        event(1, '2025-03-03', theme='Квадратные уравнения', homework=['Параграф 12, упражнения 3-5']),
+        event(2, '2025-03-03', '09:25', '10:10', subject='История', theme='Реформы Петра'),
+    ))
+    sql_replace_schedule(conn, other, day, day, events(
+        event(3, '2025-03-03', homework=['Параграф 7']),
+    ))
+
+    results = sql_search(conn, student, fts_query('парагр упражн'), 10)
+    assert len(results) == 1
+    date_str, start_time, subject, fragment = results[0]
+    assert (date_str, start_time, subject) == ('2025-03-03', '08:30', 'Математика')
+    assert '«Параграф»' in fragment
+
+    # Совпадение только в теме — фрагмент из темы
+    assert sql_search(conn, student, fts_query('рефор'), 10)[0][2:] == ('История', '«Реформы» Петра')
+    assert sql_search(conn, student, fts_query('параграф петра'), 10) == []
+    assert len(sql_search(conn, other, fts_query('пар'), 10)) == 1
@@ -0,0 +1,76 @@
+# tests/test_sessions.py
+
+import asyncio
+
+import pytest
+
+from bot import sessions
+from bot.sessions import LoginSession, LoginSessionStore
+
+
+class FakeHTTPSession:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAPI:
+    def __init__(self):
+        self.http = FakeHTTPSession()
+        self._login_info = {'session': self.http, 'cookies': 'секрет'}
+
+
+def _session(username):
+    session = LoginSession(username)
+    session.api = FakeAPI()
+    return session
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_expired_sessions_are_hidden_and_closed(clock):
+    store = LoginSessionStore(ttl=60, maxsize=10)
+    old, fresh = _session('old'), _session('fresh')
+    asyncio.run(store.put(1, old))
+    clock[0] += 30
+    asyncio.run(store.put(2, fresh))
+    old_http = old.api.http
+
+    clock[0] += 30
+    assert store.get(1) is None
+    assert store.get(2) is fresh
+    asyncio.run(store.expire())
+    assert old_http.closed and old.api is None and old.username is None
+    assert not fresh.api.http.closed
+    assert len(store._sessions) == 1
+
+
+def test_overflow_evicts_oldest(clock):
+    store = LoginSessionStore(ttl=60, maxsize=2)
+    first, second, third = _session('a'), _session('b'), _session('c')
+    first_http = first.api.http
+    for user_id, session in ((1, first), (2, second), (3, third)):
+        asyncio.run(store.put(user_id, session))
+    assert first_http.closed
+    assert (store.get(1), store.get(2), store.get(3)) == (None, second, third)
+
+
+def test_restart_closes_previous_and_pop_keeps_client(clock):
+    store = LoginSessionStore(ttl=60, maxsize=10)
+    previous, restarted = _session('a'), _session('a')
+    previous_http = previous.api.http
+    asyncio.run(store.put(1, previous))
+    asyncio.run(store.put(1, restarted))
+    assert previous_http.closed
+
+    # Вход завершён: api нужен дальше, закрывать его нельзя
+    assert store.pop(1) is restarted
+    assert restarted.api is not None and not restarted.api.http.closed
+    assert store.get(1) is None
@@ -0,0 +1,84 @@
+# tests/test_sweep.py
+
+from datetime import date
+
+import pytest
+
+import main
+from bot import auth
+from bot.database import sql_upsert_token, sql_upsert_identity, sql_mark_refreshed, sql_select_lessons
+from bot.repository import Repository
+
+
+class AuthError(Exception):
+    status_code = 401
+
+
+@pytest.fixture
+def mes(db_path, events, event, monkeypatch):
+    """
+    Фальшивый МЭШ для update_all_schedules: calls — кто и за кого запрашивал
+    get_events, rejected — токены, на которые МЭШ отвечает 401.
+    """
+    state = {'calls': [], 'rejected': set()}
+    today = date.today().isoformat()
+
+    class FakeAPI:
+        def __init__(self, token):
+            self.token = token['token']
+
+        async def get_events(self, person_id, mes_role, begin_date, end_date):
+            if self.token in state['rejected']:
+                raise AuthError('401')
+            state['calls'].append((self.token, person_id))
+            return events(event(1, today, theme=f'Урок {person_id}'))
+
+    repository = Repository(db_path, window_ms=0)
+    monkeypatch.setattr(main, 'repository', repository)
+    monkeypatch.setattr(main, 'new_api', FakeAPI)
+    yield state
+    repository.close()
+
+
+def _subscribe(conn, tg, person_guid):
+    sql_upsert_token(conn, tg, auth.encrypt_token({'token': f'token-{tg}'}), 'key')
+    return sql_upsert_identity(conn, tg, tg, person_guid, 'student')
+
+
+def _status(conn, tg):
+    return conn.execute('SELECT token_status FROM users WHERE telegram_user_id = ?', (tg,)).fetchone()[0]
+
+
+def test_one_request_per_student(conn, mes):
+    student = _subscribe(conn, 1, 'guid-a')
+    _subscribe(conn, 2, 'guid-a')  # родитель того же ученика
+    conn.commit()
+
+    main.update_all_schedules(min_age=3600)
+    assert mes['calls'] == [('token-1', 'guid-a')]
+    assert [lesson.lesson_theme for lesson in sql_select_lessons(conn, student, date.today().isoformat())] \
+        == ['Урок guid-a']
+
+
+def test_recently_refreshed_students_are_skipped(conn, mes):
+    fresh = _subscribe(conn, 1, 'guid-fresh')
+    _subscribe(conn, 2, 'guid-stale')
+    sql_mark_refreshed(conn, fresh, far=True)
+    conn.commit()
+
+    main.update_all_schedules(min_age=3600)
+    assert mes['calls'] == [('token-2', 'guid-stale')]
+    # Следующий проход продолжает с оставшихся: обновлённый только что тоже пропускается
+    main.update_all_schedules(min_age=3600)
+    assert mes['calls'] == [('token-2', 'guid-stale')]
+
+
+def test_rejected_subscriber_falls_through_to_next(conn, mes):
+    _subscribe(conn, 5, 'guid-c')
+    _subscribe(conn, 6, 'guid-c')
+    conn.commit()
+    mes['rejected'].add('token-5')
+
+    main.update_all_schedules(min_age=3600)
+    assert mes['calls'] == [('token-6', 'guid-c')]
+    assert (_status(conn, 5), _status(conn, 6)) == ('needs_relogin', 'active')
@@ -0,0 +1,65 @@
+# tests/test_sync.py
+
+import asyncio
+from datetime import date, timedelta
+
+from bot import sync
+from bot.database import sql_upsert_identity
+from bot.horizon import covers, current_week_range, first_sync_ranges, full_range
+from bot.repository import Repository
+
+TODAY = date(2025, 3, 5)  # среда
+
+
+def _days(begin, end):
+    return {begin + timedelta(days=n) for n in range((end - begin).days + 1)}
+
+
+def test_first_sync_ranges_fetch_the_week_once():
+    ranges = first_sync_ranges(TODAY)
+    assert ranges[0] == current_week_range(TODAY)
+    days = [day for begin, end in ranges for day in _days(begin, end)]
+    assert len(days) == len(set(days))
+    assert set(days) == _days(*full_range(TODAY)) | _days(*current_week_range(TODAY))
+    assert covers(ranges, *full_range(TODAY))
+
+
+def test_covers_detects_gaps():
+    d = date(2025, 3, 1)
+    assert covers([(d, d + timedelta(days=2)), (d + timedelta(days=3), d + timedelta(days=5))],
+                  d, d + timedelta(days=5))
+    assert not covers([(d, d + timedelta(days=1)), (d + timedelta(days=3), d + timedelta(days=5))],
+                      d, d + timedelta(days=5))
+    assert not covers([(d + timedelta(days=1), d + timedelta(days=5))], d, d + timedelta(days=5))
+
+
+def test_sync_requests_each_day_once_and_marks_refreshed(conn, db_path, events, monkeypatch):
+    calls = []
+
+    class FakeAPI:
+        async def get_events(self, person_id, mes_role, begin_date, end_date):
+            calls.append((begin_date, end_date))
+            return events()
+
+    async def get_token_async(tg_id):
+        return {'token': 'ok'}
+
+    async def resolve_identity(tg_id, api):
+        return student_id, 'guid-1', 'student'
+
+    student_id = sql_upsert_identity(conn, 1, 10, 'guid-1', 'student')
+    conn.commit()
+    repository = Repository(db_path, window_ms=0)
+    monkeypatch.setattr(sync, 'repository', repository)
+    monkeypatch.setattr(sync, 'get_token_async', get_token_async)
+    monkeypatch.setattr(sync, 'resolve_identity', resolve_identity)
+    monkeypatch.setattr(sync, 'new_api', lambda token: FakeAPI())
+    try:
+        asyncio.run(sync.sync_user_schedule(1, ranges=first_sync_ranges()))
+    finally:
+        repository.close()
+
+    assert calls == first_sync_ranges()
+    assert conn.execute(
+        'SELECT far_refreshed_at FROM students WHERE student_id = ?', (student_id,)
+    ).fetchone()[0] is not None
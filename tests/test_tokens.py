@@ -0,0 +1,149 @@
+# tests/test_tokens.py
+
+import asyncio
+import time
+
+import pytest
+
+from bot import auth
+from bot.database import sql_upsert_token, sql_upsert_identity, sql_select_student_id
+from bot.repository import Repository
+
+
+class AuthError(Exception):
+    status_code = 401
+
+
+class FakeAPI:
+    """
+    Клиент МЭШ без сети: refresh_token/get_users_profile_info ведут себя
+    по словарю behaviour[токен] — None (успех), исключение или функция.
+    """
+    behaviour = {}
+
+    def __init__(self, token=None):
+        self.token = token['token'] if isinstance(token, dict) else token
+        self.token_for_refresh = token.get('refresh_token') if isinstance(token, dict) else None
+        self.client_id = self.client_secret = None
+
+    async def _act(self):
+        action = self.behaviour.get(self.token)
+        if isinstance(action, Exception):
+            raise action
+        if callable(action):
+            action()
+
+    async def refresh_token(self):
+        await self._act()
+        self.token = self.token + '-renewed'
+
+    async def get_users_profile_info(self):
+        await self._act()
+
+
+@pytest.fixture
+def fake_mes(db_path, monkeypatch):
+    repository = Repository(db_path, window_ms=0)
+    monkeypatch.setattr(auth, 'repository', repository)
+    monkeypatch.setattr(auth, 'new_api', FakeAPI)
+    FakeAPI.behaviour = {}
+    yield FakeAPI.behaviour
+    repository.close()
+
+
+def _add_user(conn, tg, token, expires_at=None):
+    enc = auth.encrypt_token({'token': token, 'refresh_token': 'r-' + token})
+    sql_upsert_token(conn, tg, enc, auth.current_key_id(), expires_at)
+    sql_upsert_identity(conn, tg, tg, f'guid-{tg}', 'student')
+    conn.commit()
+    return enc
+
+
+def _state(conn, tg):
+    status, enc = conn.execute(
+        'SELECT token_status, encrypted_token FROM users WHERE telegram_user_id = ?', (tg,)
+    ).fetchone()
+    return status, auth.decrypt_token(enc)['token']
+
+
+def test_renew_tokens_transitions(conn, fake_mes):
+    soon = int(time.time()) + 60
+    _add_user(conn, 1, 'ok', soon)
+    _add_user(conn, 2, 'rejected', soon)
+    _add_user(conn, 3, 'offline', soon)
+    _add_user(conn, 4, 'expired', int(time.time()) - 1)
+    _add_user(conn, 5, 'later', int(time.time()) + 10 ** 6)
+    fake_mes['rejected'] = AuthError('401')
+    fake_mes['offline'] = OSError('сеть недоступна')
+
+    assert auth.renew_tokens(ahead=3600) == 1
+    assert _state(conn, 1) == ('active', 'ok-renewed')
+    assert _state(conn, 2) == ('needs_relogin', 'rejected')
+    assert _state(conn, 3) == ('active', 'offline')
+    assert _state(conn, 4) == ('needs_relogin', 'expired')
+    assert _state(conn, 5) == ('active', 'later')
+    # Продление — тот же аккаунт: привязка к ученику остаётся
+    assert sql_select_student_id(conn, 1) is not None
+
+
+def test_renew_does_not_overwrite_new_login(conn, fake_mes):
+    _add_user(conn, 1, 'old', int(time.time()) + 60)
+
+    def relogin():
+        # Пользователь заново вошёл, пока запрос продления был в пути
+        auth.save_token_db(1, auth.encrypt_token({'token': 'fresh'}))
+
+    fake_mes['old'] = relogin
+    assert auth.renew_tokens(ahead=3600) == 0
+    assert _state(conn, 1) == ('active', 'fresh')
+
+
+def _checked_at(conn, tg):
+    return conn.execute('SELECT token_checked_at FROM users WHERE telegram_user_id = ?', (tg,)).fetchone()[0]
+
+
+def test_validate_tokens_transitions(conn, fake_mes):
+    _add_user(conn, 1, 'alive')
+    _add_user(conn, 2, 'rejected')
+    _add_user(conn, 3, 'offline')
+    sql_upsert_token(conn, 4, b'not-fernet', 'key')
+    conn.commit()
+    fake_mes['rejected'] = AuthError('401')
+    fake_mes['offline'] = OSError('сеть недоступна')
+
+    assert auth.validate_tokens(concurrency=4, rate=0, max_age=3600) == 2
+    assert _state(conn, 1) == ('active', 'alive')
+    assert _checked_at(conn, 1) is not None
+    assert _state(conn, 2) == ('needs_relogin', 'rejected')
+    assert _state(conn, 3) == ('active', 'offline')
+    assert _checked_at(conn, 3) is None
+    assert conn.execute('SELECT token_status FROM users WHERE telegram_user_id = 4').fetchone()[0] == 'needs_relogin'
+
+    # Недавно проверенные не проверяются снова; с ошибкой сети — проверяются
+    fake_mes['offline'] = None
+    assert auth.validate_tokens(concurrency=4, rate=0, max_age=3600) == 0
+    assert _checked_at(conn, 3) is not None
+
+
+def test_validate_does_not_kill_new_login(conn, fake_mes):
+    _add_user(conn, 1, 'old')
+
+    def relogin():
+        auth.save_token_db(1, auth.encrypt_token({'token': 'fresh'}))
+        raise AuthError('401')
+
+    fake_mes['old'] = relogin
+    assert auth.validate_tokens(concurrency=1, rate=0, max_age=3600) == 0
+    assert _state(conn, 1) == ('active', 'fresh')
+
+
+def test_get_api_client_marks_rejected_token(conn, fake_mes):
+    _add_user(conn, 1, 'rejected')
+    _add_user(conn, 2, 'offline')
+    fake_mes['rejected'] = AuthError('401')
+    fake_mes['offline'] = OSError('сеть недоступна')
+
+    assert asyncio.run(auth.get_api_client(1)) == (None, None)
+    assert asyncio.run(auth.get_api_client(2)) == (None, None)
+    assert _state(conn, 1) == ('needs_relogin', 'rejected')
+    assert _state(conn, 2) == ('active', 'offline')
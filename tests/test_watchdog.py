@@ -0,0 +1,39 @@
+# tests/test_watchdog.py
+
+import asyncio
+import logging
+import time
+
+from bot.executor import run_blocking
+from bot.watchdog import LoopWatchdog
+
+
+def test_blocked_loop_is_measured_and_reported(caplog):
+    watchdog = LoopWatchdog(interval=0.02, threshold=0.05, debug=True)
+
+    async def scenario():
+        watchdog.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)  # блокирующий вызов прямо в loop
+        await asyncio.sleep(0.05)
+        watchdog.stop()
+
+    with caplog.at_level(logging.WARNING, logger='bot.watchdog'):
+        asyncio.run(scenario())
+    assert watchdog.max_lag >= 0.2
+    [record] = [r for r in caplog.records if 'заблокирован' in r.getMessage()]
+    assert 'scenario' in record.getMessage()  # в стеке — заблокировавшая корутина
+
+
+def test_run_blocking_keeps_loop_responsive():
+    watchdog = LoopWatchdog(interval=0.02, threshold=0.05)
+
+    async def scenario():
+        watchdog.start()
+        await asyncio.sleep(0.05)
+        result = await run_blocking(time.sleep, 0.3)
+        watchdog.stop()
+        return result
+
+    assert asyncio.run(scenario()) is None
+    assert watchdog.max_lag < 0.2